@@ -19,7 +19,7 @@ class AliasBot:
                 bot.command(r"^\w*", self.honk, direct=True),
                 bot.command(r"^!learn (?P<abbr>\S+) as (?P<long>.+)$", self.learn, auth_level = 20),
                 bot.command(r"^!forget (?P<abbr>\S+)", self.forget, auth_level = 20),
-                bot.command(r"^!list_abbr$", self.list_abbrievations, private=True),
+                bot.command(r"^!list_abbr$", self.list_abbrievations, private=True, offload=True),
                 bot.command(r"^!(?P<abbr>\S+)$", self.retrieve)
                 ]
         
@@ -121,7 +121,8 @@ class AliasBot:
         List all known abbrievation commands
         """
         try:
-            results = self.db.execute('SELECT * FROM alias_module').fetchall()
+            #offloaded, so it needs its own connection
+            results = self.bot.thread_db().execute('SELECT * FROM alias_module').fetchall()
             if results:
                 self.irc.msg_all(u",".join(map(str, results)), targets)
             
@@ -0,0 +1,607 @@
+'''
+Micro-benchmarks for the hot paths of the bot
+
+Usage is python benchmark.py [--corpus file | --capture file] [--repeat n] [--only name]
+                             [--json] [--save file] [--compare file] [--threshold percent]
+
+The corpus defaults to a generated mix of the traffic a busy network
+sends (channel chatter, JOIN/PART/QUIT churn, WHO and NAMES bursts,
+PINGs and IRCv3 tagged lines). A file of raw irc lines, one per line,
+or a traffic capture (see capture.py) can be given instead. Every other
+fixture is generated from a fixed seed so runs are comparable
+
+Results are operations a second, higher is better. --save writes them as
+json to use as a baseline, --compare shows the change against one and
+exits with 1 if anything got slower by more than --threshold percent
+'''
+import os
+import re
+import sys
+import json
+import platform
+import time
+import random
+import logging
+import argparse
+import Queue
+import ircparse
+import numerics as nu
+import event_util as eu
+from network import Network
+from commandbot import CommandBot
+from aliasbot import AliasBot
+from capture import read_capture
+from msgqueue import LaneQueue, SheddingQueue, outbound_control
+
+def generate_corpus(size=20000, seed=1):
+    '''
+    Build a repeatable list of realistic irc lines
+    '''
+    rand = random.Random(seed)
+    words = [u'the', u'bot', u'is', u'down', u'again', u'anyone', u'seen', u'this', u'error',
+             u'!learn', u'as', u'deploy', u'friday', u'lunch', u'caf\xe9', u'ok', u'lol', u'http://example.com/a/b']
+    nicks = [u'user{0}'.format(i) for i in range(200)]
+    channels = [u'#chan{0}'.format(i) for i in range(20)]
+
+    def source():
+        nick = rand.choice(nicks)
+        return u'{0}!~{0}@host-{1}.example.net'.format(nick, rand.randint(1, 9999))
+
+    def chatter():
+        return u' '.join(rand.choice(words) for i in range(rand.randint(1, 30)))
+
+    kinds = [
+            (55, lambda: u':{0} PRIVMSG {1} :{2}'.format(source(), rand.choice(channels), chatter())),
+            (8, lambda: u'@time=2016-02-01T12:{0:02d}:00.000Z;account={1} :{2} PRIVMSG {3} :{4}'.format(
+                rand.randint(0, 59), rand.choice(nicks), source(), rand.choice(channels), chatter())),
+            (6, lambda: u':{0} JOIN {1}'.format(source(), rand.choice(channels))),
+            (5, lambda: u':{0} PART {1} :{2}'.format(source(), rand.choice(channels), chatter())),
+            (5, lambda: u':{0} QUIT :Quit: {1}'.format(source(), chatter())),
+            (10, lambda: u':irc.example.net 352 bot {0} ~{1} host.example.net irc.example.net {1} H :0 Real Name'.format(
+                rand.choice(channels), rand.choice(nicks))),
+            (4, lambda: u':irc.example.net 353 bot = {0} :{1}'.format(
+                rand.choice(channels), u' '.join(u'@' + n if rand.random() < .1 else n for n in rand.sample(nicks, 40)))),
+            (3, lambda: u'PING :irc.example.net'),
+            (2, lambda: u':ChanServ!ChanServ@services. NOTICE bot :{0}'.format(chatter())),
+            (2, lambda: u':{0} MODE {1} +o {2}'.format(source(), rand.choice(channels), rand.choice(nicks))),
+            ]
+    table = []
+    for weight, kind in kinds:
+        table.extend([kind] * weight)
+
+    return [rand.choice(table)() for i in range(size)]
+
+def load_corpus(path):
+    '''
+    Read raw irc lines from a file, one per line
+    '''
+    with open(path, 'rb') as f:
+        return [line.rstrip('\r\n').decode('utf-8', 'replace') for line in f if line.strip()]
+
+#The regex parser Network used before ircparse, kept here to compare against
+legacy_ircmsg = re.compile(r"(?P<prefix>:\S+ )?(?P<command>(\w+|\d{3}))(?P<params>( [^:]\S+)*)(?P<postfix> :.*)?")
+
+def legacy_parse(message):
+    m = legacy_ircmsg.match(message)
+    if not m:
+        return None
+
+    postfix = m.group('postfix')
+    if postfix:
+        postfix = postfix.strip(' ')
+        postfix = postfix.lstrip(':')
+
+    command = m.group('command')
+
+    prefix = m.group('prefix')
+    if prefix:
+        prefix = prefix.strip(' ')
+        prefix = prefix.lstrip(':')
+
+    params = m.group('params')
+    if params:
+        params = params.strip(' ')
+        params = params.split(' ')
+
+    return command, prefix, params, postfix
+
+def rate(func, items, repeat):
+    '''
+    Run func over every item, repeat times, returning the best items/sec
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for item in items:
+            func(item)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return len(items) / best
+
+def bench_parse(corpus, repeat):
+    '''
+    Lines/sec of the regex parser, ircparse and the full Network.parse_message
+    '''
+    net = Network(Queue.PriorityQueue(), Queue.PriorityQueue(), 'bench', log_level=logging.WARNING)
+    return [
+            ('legacy regex parse', rate(legacy_parse, corpus, repeat)),
+            ('ircparse.parse', rate(ircparse.parse, corpus, repeat)),
+            ('Network.parse_message', rate(net.parse_message, corpus, repeat)),
+            ]
+
+def dispatcher(bot):
+    '''
+    What happens to an inbound line once it has been read off the socket,
+    minus the queue hop between the threads
+    '''
+    net = bot.net
+    def dispatch(line):
+        msg = net.parse_message(line)
+        if msg:
+            for e in net.in_events:
+                e(msg)
+            bot.process_event(msg)
+        #replies (PONGs) would otherwise pile up
+        if net.outq.qsize() > 1000:
+            while not net.outq.empty():
+                net.outq.get(False)
+    return dispatch
+
+def bench_logging(corpus, repeat):
+    '''
+    Events/sec through parsing and dispatch with the traffic logs at DEBUG,
+    at INFO and switched off. Logs are written to /dev/null so the cost of
+    formatting them is counted but not the disk
+    '''
+    results = []
+    devnull = open(os.devnull, 'w')
+    configs = [
+            ('dispatch, logging DEBUG', logging.DEBUG, {}),
+            ('dispatch, logging INFO', logging.INFO, {}),
+            ('dispatch, traffic logs off', logging.INFO, {'network': None, 'identhost': None}),
+            ]
+    for name, level, levels in configs:
+        bot = CommandBot('bench', 'localhost', 6667, db_file=':memory:', log_name='bench_' + str(len(results)),
+                         log_level=level, log_handlers=[logging.StreamHandler(devnull)],
+                         net_options={'log_level': level}, log_levels=levels, threaded=False)
+        bot.registered = True
+        results.append((name, rate(dispatcher(bot), corpus, repeat)))
+        bot.cleanup()
+
+    return results
+
+bots_made = []
+
+def make_bot(alias=False):
+    '''
+    A bot with the default modules (and optionally AliasBot) that isn't
+    connected to anything, with logging quiet
+    '''
+    bot = CommandBot('bench', 'localhost', 6667, db_file=':memory:', log_name='benchbot{0}'.format(len(bots_made)),
+                     log_level=logging.WARNING, net_options={'flood_burst': None, 'log_level': logging.WARNING},
+                     threaded=False)
+    bots_made.append(bot)
+    if alias:
+        AliasBot(bot, log_level=logging.WARNING)
+    #what it queued up to connect
+    drain(bot)
+    bot.registered = True
+    return bot
+
+def drain(bot):
+    '''
+    Throw away everything the bot wanted to send
+    '''
+    while not bot.outq.empty():
+        bot.outq.get(False)
+
+def bench_msg(corpus, repeat):
+    '''
+    Messages/sec through Network.msg, which works out the line budget and
+    splits long messages
+    '''
+    net = Network(Queue.PriorityQueue(), Queue.PriorityQueue(), 'bench', flood_burst=None, log_level=logging.WARNING)
+    rand = random.Random(2)
+    words = [u'short', u'words', u'and', u'some', u'longer', u'ones', u'like', u'configuration', u'caf\xe9', u'\u2603']
+    def message(length):
+        return u' '.join(rand.choice(words) for i in range(length))
+    short = [message(rand.randint(1, 10)) for i in range(2000)]
+    long = [message(rand.randint(100, 400)) for i in range(2000)]
+
+    def send(text):
+        net.msg(text, u'#channel')
+        del net.out_buffer[:]
+
+    return [
+            ('Network.msg short', rate(send, short, repeat)),
+            ('Network.msg long (split)', rate(send, long, repeat)),
+            ]
+
+class ManyCommands(object):
+    '''
+    A module with lots of commands, like a bot with a big plugin collection
+    '''
+
+    def __init__(self, bot, count):
+        self.events = []
+        self.commands = []
+        for i in range(count):
+            if i % 10 == 0:
+                self.commands.append(bot.command(r'do{0} (?P<rest>.*)'.format(i), self.handle, direct=True))
+            else:
+                self.commands.append(bot.command(r'!cmd{0} (?P<rest>.*)'.format(i), self.handle))
+        bot.add_module('many', self)
+
+    def handle(self, nick, nickhost, action, targets, message, m):
+        pass
+
+def linear_dispatch(bot):
+    '''
+    How CommandBot dispatched PRIVMSGs before the command index, trying
+    every command of the core and then of every module
+    '''
+    def dispatch(data):
+        action, source, args, message = data
+        for command in bot.commands:
+            if command(source, action, list(args), message):
+                action = 'COMMAND'
+                break
+        for module in bot.modules.values():
+            for command in module.commands:
+                if command(source, action, list(args), message):
+                    action = 'COMMAND'
+                    break
+        if bot.outq.qsize() > 1000:
+            drain(bot)
+    return dispatch
+
+def indexed_dispatch(bot):
+    def dispatch(data):
+        action, source, args, message = data
+        bot.dispatch_command(source, action, list(args), message)
+        if bot.outq.qsize() > 1000:
+            drain(bot)
+    return dispatch
+
+def bench_commands(corpus, repeat):
+    '''
+    PRIVMSGs/sec through command matching with the default modules and
+    AliasBot, and with 300 more commands loaded, trying every command in
+    turn (how it used to work) and through the command index
+    '''
+    bot = make_bot(alias=True)
+    messages = []
+    for line in corpus:
+        msg = bot.net.parse_message(line)
+        if msg and msg.type == 'PRIVMSG':
+            messages.append(msg.data)
+    rand = random.Random(6)
+    #some of the messages are for the extra commands
+    extra = []
+    for data in messages:
+        if rand.random() < .1:
+            action, source, args, message = data
+            data = (action, source, args, u'!cmd{0} {1}'.format(rand.randint(1, 299), message))
+        extra.append(data)
+
+    results = [
+            ('command matching', rate(indexed_dispatch(bot), messages, repeat)),
+            ('command matching (linear)', rate(linear_dispatch(bot), messages, repeat)),
+            ]
+    ManyCommands(bot, 300)
+    results.extend([
+            ('300 commands, indexed', rate(indexed_dispatch(bot), extra, repeat)),
+            ('300 commands, linear', rate(linear_dispatch(bot), extra, repeat)),
+            ])
+    return results
+
+class ManyEvents(object):
+    '''
+    A module listening for lots of different events, like a bot with a big
+    plugin collection
+    '''
+
+    def __init__(self, bot, count):
+        self.commands = []
+        self.events = []
+        types = [name for name in dir(nu) if name.startswith('RPL_') or name.startswith('ERR_')]
+        for i in range(count):
+            self.events.append(eu.event(getattr(nu, types[i % len(types)]), self.handle))
+        bot.add_module('many_events', self)
+
+    def handle(self, *args):
+        pass
+
+def linear_events(bot):
+    '''
+    How CommandBot called event handlers before the event table, every
+    handler of the core and then of every module for every event
+    '''
+    def dispatch(m_event):
+        for event in bot.events:
+            try:
+                event(m_event)
+            except Exception:
+                pass
+        for module in bot.modules.values():
+            for event in module.events:
+                try:
+                    event(m_event)
+                except Exception:
+                    pass
+        if bot.outq.qsize() > 1000:
+            drain(bot)
+    return dispatch
+
+def table_events(bot):
+    def dispatch(m_event):
+        groups = [(None, bot.events)]
+        groups.extend((name, bot.modules[name].events) for name in bot.modules)
+        bot.event_table.update(groups)
+        for number, position, name, event in bot.event_table.handlers(m_event.type):
+            try:
+                event(m_event)
+            except Exception:
+                pass
+        if bot.outq.qsize() > 1000:
+            drain(bot)
+    return dispatch
+
+def bench_events(corpus, repeat):
+    '''
+    Events/sec through the event handlers with the default modules and
+    AliasBot, and with 300 more handlers loaded, calling every handler
+    (how it used to work) and only those subscribed through the event table
+    '''
+    bot = make_bot(alias=True)
+    #PRIVMSGs would go through the commands as well. The corpus isn't
+    #consistent enough for ident, which raises like it would in process_event
+    messages = [msg for msg in (bot.net.parse_message(line) for line in corpus)
+                if msg and msg.type != 'PRIVMSG']
+
+    results = [
+            ('event handlers', rate(table_events(bot), messages, repeat)),
+            ('event handlers (linear)', rate(linear_events(bot), messages, repeat)),
+            ]
+    ManyEvents(bot, 300)
+    results.extend([
+            ('300 event handlers, table', rate(table_events(bot), messages, repeat)),
+            ('300 event handlers, linear', rate(linear_events(bot), messages, repeat)),
+            ])
+    return results
+
+def bench_logic(corpus, repeat):
+    '''
+    Events/sec through CommandBot.logic, already parsed and on the inbound
+    queue, with the default modules and AliasBot loaded
+    '''
+    bot = make_bot(alias=True)
+    net = bot.net
+    messages = [msg for msg in (net.parse_message(line) for line in corpus) if msg]
+    batch = 100
+    batches = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+
+    def logic(events):
+        for msg in events:
+            bot.inq.put(msg)
+        bot.logic()
+        drain(bot)
+
+    return [('CommandBot.logic', rate(logic, batches, repeat) * batch)]
+
+def bench_queues(corpus, repeat):
+    '''
+    Messages/sec put on and taken off the bot's queues, in bursts of 100
+    with a mix of priorities, for the heap based PriorityQueue the bot used
+    to use and the FIFO lanes it uses now
+    '''
+    rand = random.Random(7)
+    messages = [eu.msg_all(u'line {0}'.format(i), [u'#chan'], rand.choice([1, 2, 3, 3, 3, 3, 5]))
+                for i in range(10000)]
+    batch = 100
+    batches = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+
+    def put_get(queue):
+        def run(events):
+            for msg in events:
+                queue.put(msg)
+            for msg in events:
+                queue.get(False)
+        return run
+
+    return [
+            ('PriorityQueue put/get', rate(put_get(Queue.PriorityQueue()), batches, repeat) * batch),
+            ('LaneQueue put/get', rate(put_get(LaneQueue()), batches, repeat) * batch),
+            ('SheddingQueue put/get', rate(put_get(SheddingQueue(1000, outbound_control)), batches, repeat) * batch),
+            ]
+
+def bench_ident(corpus, repeat):
+    '''
+    JOIN/PART/QUIT/NICK events/sec through IdentHost with a few thousand
+    users in the maps
+    '''
+    bot = make_bot()
+    ident = bot.ident
+    net = bot.net
+    rand = random.Random(3)
+    channels = [u'#chan{0}'.format(i) for i in range(20)]
+    users = 2000
+    #simulate the network so every event makes sense, i.e nobody parts a
+    #channel they aren't in. nicks flip between userN and userN_
+    nicks = [u'user{0}'.format(i) for i in range(users)]
+    member = [set(rand.sample(channels, 3)) for i in range(users)]
+    def source(i):
+        return u'{0}!~user{1}@host-{1}.example.net'.format(nicks[i], i)
+
+    setup = [u':bench!~bench@bot.example.net JOIN {0}'.format(channel) for channel in channels]
+    for i in range(users):
+        for channel in member[i]:
+            setup.append(u':{0} JOIN {1}'.format(source(i), channel))
+
+    #each change is recorded with how to undo it, the undos are played back
+    #in reverse afterwards so every run starts from the same state
+    churn = []
+    undo = []
+    for n in range(10000):
+        i = rand.randrange(users)
+        kind = rand.random()
+        if kind < .4:
+            channel = rand.choice(sorted(set(channels) - member[i]))
+            churn.append(u':{0} JOIN {1}'.format(source(i), channel))
+            undo.append([u':{0} PART {1} :bye'.format(source(i), channel)])
+            member[i].add(channel)
+        elif not member[i]:
+            continue
+        elif kind < .8:
+            channel = rand.choice(sorted(member[i]))
+            churn.append(u':{0} PART {1} :bye'.format(source(i), channel))
+            undo.append([u':{0} JOIN {1}'.format(source(i), channel)])
+            member[i].discard(channel)
+        elif kind < .9:
+            churn.append(u':{0} QUIT :Quit: bye'.format(source(i)))
+            undo.append([u':{0} JOIN {1}'.format(source(i), channel) for channel in sorted(member[i])])
+            member[i] = set()
+        else:
+            old = source(i)
+            nicks[i] = nicks[i][:-1] if nicks[i].endswith(u'_') else nicks[i] + u'_'
+            churn.append(u':{0} NICK :{1}'.format(old, nicks[i]))
+            undo.append([u':{0} NICK :{1}'.format(source(i), old.split(u'!')[0])])
+    for lines in reversed(undo):
+        churn.extend(lines)
+
+    def handle(msg):
+        for event in ident.events:
+            event(msg)
+
+    for line in setup:
+        handle(net.parse_message(line))
+    drain(bot)
+    events = [net.parse_message(line) for line in churn]
+    return [('IdentHost churn', rate(handle, events, repeat))]
+
+def bench_auth(corpus, repeat):
+    '''
+    IdentAuth.is_allowed checks/sec against a thousand users, half the
+    checks are for users who aren't in the db
+    '''
+    bot = make_bot()
+    auth = bot.auth
+    rand = random.Random(4)
+    for i in range(1000):
+        auth.add_user(u'user{0}!~user{0}@host.example.net'.format(i), rand.choice([0, 20, 50, 100]))
+    auth.bootstrapped = True
+    checks = []
+    for i in range(10000):
+        n = rand.randint(0, 1999)
+        checks.append((u'user{0}'.format(n), u'user{0}!~user{0}@host.example.net'.format(n), rand.choice([20, 100])))
+
+    return [('IdentAuth.is_allowed', rate(lambda check: auth.is_allowed(*check), checks, repeat))]
+
+def bench_retrieve(corpus, repeat):
+    '''
+    AliasBot.retrieve lookups/sec against a thousand stored aliases, half
+    of them misses
+    '''
+    bot = make_bot(alias=True)
+    alias = bot.get_module('Alias')
+    rand = random.Random(5)
+    for i in range(1000):
+        bot.db.execute('INSERT OR REPLACE INTO alias_module VALUES (?, ?)', [u'abbr{0}'.format(i), u'expansion {0}'.format(i)])
+    bot.db.commit()
+    expr = re.compile(r"^!(?P<abbr>\S+)$")
+    lookups = [expr.match(u'!abbr{0}'.format(rand.randint(0, 1999))) for i in range(10000)]
+
+    def retrieve(m):
+        alias.retrieve(u'user', u'user!~user@host', 'PRIVMSG', [u'#chan'], m.group(0), m)
+        if bot.outq.qsize() > 1000:
+            drain(bot)
+
+    return [('AliasBot.retrieve', rate(retrieve, lookups, repeat))]
+
+benchmarks = [
+        ('parse', bench_parse),
+        ('msg', bench_msg),
+        ('commands', bench_commands),
+        ('events', bench_events),
+        ('logic', bench_logic),
+        ('queues', bench_queues),
+        ('ident', bench_ident),
+        ('auth', bench_auth),
+        ('retrieve', bench_retrieve),
+        ('logging', bench_logging),
+        ]
+
+def compare(results, baseline, threshold):
+    '''
+    Print each result against the baseline, returns the names of those
+    that got slower by more than threshold percent
+    '''
+    regressions = []
+    print('{0:<30} {1:>12} {2:>12} {3:>8}'.format('benchmark', 'baseline', 'now', 'change'))
+    for name, result in results:
+        if name not in baseline:
+            print('{0:<30} {1:>12} {2:>12.0f}'.format(name, '-', result))
+            continue
+        change = (result - baseline[name]) / baseline[name] * 100
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{0:<30} {1:>12.0f} {2:>12.0f} {3:>+7.1f}%{4}'.format(name, baseline[name], result, change, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the bot hot paths')
+    parser.add_argument('--corpus', help='file of raw irc lines to use instead of the generated corpus')
+    parser.add_argument('--capture', help='traffic capture to use instead of the generated corpus')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best is reported')
+    parser.add_argument('--only', action='append', help='run just the named benchmark (can be repeated)')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--save', help='write the results to this file as a baseline')
+    parser.add_argument('--compare', help='compare against a baseline written with --save')
+    parser.add_argument('--threshold', type=float, default=10, help='percent slower that counts as a regression')
+    options = parser.parse_args()
+    #modules log their start up, we don't want to hear it
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    if options.corpus:
+        corpus = load_corpus(options.corpus)
+    elif options.capture:
+        corpus = [line for timestamp, line in read_capture(options.capture)]
+    else:
+        corpus = generate_corpus()
+
+    results = []
+    for bench_name, bench in benchmarks:
+        if options.only and bench_name not in options.only:
+            continue
+        for name, result in bench(corpus, options.repeat):
+            results.append((name, result))
+            if not (options.json or options.compare):
+                print('{0:<30} {1:>12.0f} /sec'.format(name, result))
+
+    for bot in bots_made:
+        bot.cleanup()
+
+    report = {
+            'results': dict(results),
+            'unit': 'operations/sec',
+            'corpus_lines': len(corpus),
+            'repeat': options.repeat,
+            'python': platform.python_version(),
+            'time': time.time(),
+            }
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
@@ -0,0 +1,44 @@
+'''
+Reading and writing raw traffic captures
+
+A capture is every line the server sent, as it came off the socket, each
+preceded by the time it was read:
+
+    1454328000.123 :nick!user@host PRIVMSG #chan :hello
+
+Lines are the bytes exactly as the server sent them (\r\n terminated,
+not decoded) so nothing is lost, not even invalid utf-8. A path ending
+in .gz is gzipped
+'''
+import gzip
+
+def open_capture(path, mode='rb'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def write_lines(capture, lines, timestamp):
+    '''
+    Append raw lines (LineBuffer.raw, without the \r\n) read at timestamp
+    '''
+    stamp = b'{0:.3f} '.format(timestamp)
+    capture.write(b''.join(stamp + line + b'\r\n' for line in lines))
+
+def read_capture(path, decode=True):
+    '''
+    Returns the list of (timestamp, line) in a capture, with decode=False
+    the lines are left as the raw bytes
+    '''
+    with open_capture(path) as capture:
+        data = capture.read()
+
+    entries = []
+    for raw in data.split(b'\r\n'):
+        if not raw:
+            continue
+        stamp, _, line = raw.partition(b' ')
+        if decode:
+            line = line.decode('utf-8', 'replace')
+        entries.append((float(stamp), line))
+
+    return entries
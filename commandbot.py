@@ -1,29 +1,48 @@
 from network import Network
+import os
+import tempfile
 import shelve
 import sys
 import re
 import sqlite3
 from datetime import datetime, timedelta
 import time
+import random
 import logging
 import event_util as eu
 import Queue
+import select
+import errno
 import threading
 from authentication import IdentAuth
 from ircmodule import IRC_Wrapper
 import numerics as nu
 from ident import IdentHost
 from identcontrol import IdentControl
+from lagmonitor import LagMonitor
+from workers import WorkerPool
+from metrics import Metrics
+from profiler import Profiler
+from msgqueue import SheddingQueue, inbound_control, outbound_control
+from dispatch import CommandIndex, EventTable, literal_prefix
 import signal
 class CommandBot():
     '''
     A simple IRC bot with command processing, event processing and timed event functionalities
     A framework for adding more modules to do more complex stuff
+
+    By default the network runs in its own thread, with threaded=False the bot
+    drives the network from its own loop instead, so everything happens in
+    one thread with no cross thread hand offs
     '''
 
     def __init__(self, nick, network, port, max_log_len = 100, authmodule=None, ircmodule=None,
                  db_file = "bot.db", module_name="core", log_name="core", log_level=logging.DEBUG,
-                 log_handlers = None):
+                 log_handlers = None, net_options = None, threaded = True, max_reconnects = None,
+                 reconnect_delay = 2, max_reconnect_delay = 300, stable_session = 600,
+                 lag_options = None, log_levels = None, worker_options = None,
+                 metrics_options = None, profiler_options = None, inq_size = 10000,
+                 outq_size = 1000):
         #register a signal handler (closes bot no matter what)
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -35,6 +54,9 @@ class CommandBot():
         self.module_name = module_name
         self.log = logging.getLogger(self.log_name)
         self.log.setLevel(log_level)
+        #per module overrides, module name => level (None switches it off)
+        #i.e {'network': logging.WARNING, 'identhost': None}
+        self.log_levels = log_levels or {}
         
         #if handlers were given we need to add them
         if log_handlers:
@@ -42,15 +64,24 @@ class CommandBot():
                 self.log.addHandler(handler)
                 
         #set up network stuff
-        #IO queues
-        self.inq = Queue.PriorityQueue()
-        self.outq = Queue.PriorityQueue()
-        #Set up network class
-        net = Network(self.inq, self.outq, self.log_name)
-        #Dispatch the thread
-        self.log.debug("Dispatching network thread")
-        thread = threading.Thread(target=net.loop)
-        thread.start()
+        #IO queues, bounded so a flood sheds the least important events rather
+        #than growing forever (see msgqueue.py), a size of 0 is no limit
+        self.inq = SheddingQueue(inq_size, inbound_control)
+        self.outq = SheddingQueue(outq_size, outbound_control)
+        #Set up network class, net_options are passed through as keyword args
+        #i.e {'b_size': 65536}
+        self.net = Network(self.inq, self.outq, self.log_name, **(net_options or {}))
+        self.set_log_level(self.net.module_name, self.net.log)
+        #what the server supports (RPL_ISUPPORT), kept up to date by the network
+        self.isupport = self.net.isupport
+        #IRCv3 capabilities the server has enabled for us
+        self.caps = self.net.caps
+        self.threaded = threaded
+        if self.threaded:
+            #Dispatch the thread
+            self.log.debug("Dispatching network thread")
+            thread = threading.Thread(target=self.net.loop)
+            thread.start()
         #params for connection
         self.nick = nick
         self.network = network
@@ -60,11 +91,36 @@ class CommandBot():
 
         #TODO a lot of these need to be made into config options, along with most of the
         #kwarg params
-        self.max_reconnects = 3
+        #reconnection backs off exponentially from reconnect_delay up to
+        #max_reconnect_delay seconds, max_reconnects=None keeps trying forever
+        self.max_reconnects = max_reconnects
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
         self.times_reconnected = 0
+        #a session that lasts stable_session seconds resets the backoff
+        self.stable_session = stable_session
+        self.connected_since = None
+        self.reconnect_pending = False
+        #before the modules, they may add their own
+        self.timed_events = []
+        #commands by literal prefix, rebuilt when modules change
+        self.command_index = CommandIndex()
+        #event handlers by event type, see unhandled_events
+        self.event_table = EventTable()
         self.is_running=True
-
-        #create a ref to the db connection
+        #longest we block waiting for events, so signal handlers still get a
+        #chance to run on an idle bot. None blocks until the next event
+        self.max_wait = 1.0
+
+        #create a ref to the db connection, it belongs to the thread that made
+        #the bot, other threads get their own from thread_db
+        self.main_thread = threading.current_thread()
+        self.local = threading.local()
+        self.temp_db = None
+        if db_file == ':memory:':
+            #a plain :memory: db only exists on one connection
+            db_file = self.shared_memory_db()
+        self.db_file = db_file
         self.db = sqlite3.connect(db_file)
 
         #irc module bootstrapped before auth and ident, as auth uses it
@@ -76,6 +132,18 @@ class CommandBot():
         
         self.ident = IdentHost(self, log_level=log_level)#set up ident
         self.identcontrol = IdentControl(self) # module for controlling it
+        #measures server lag, lag_options are passed through as keyword args
+        #i.e {'interval': 60, 'max_lag': 120}
+        self.lag = LagMonitor(self, **(lag_options or {}))
+        #runs offloaded commands, worker_options are passed through as keyword args
+        #i.e {'workers': 8, 'timeout': 60}
+        self.workers = WorkerPool(self, **(worker_options or {}))
+        #times the handlers, metrics_options are passed through as keyword args
+        #i.e {'port': 9100}
+        self.metrics = Metrics(self, **(metrics_options or {}))
+        #profiles on request, profiler_options are passed through as keyword args
+        #i.e {'directory': '/tmp'}
+        self.profiler = Profiler(self, **(profiler_options or {}))
 
         #if no authmodule is passed through, use the default host/ident module
         if not authmodule:
@@ -112,15 +180,13 @@ class CommandBot():
                 #self.event("PRIVMSG", self.handle_priv),
                 ]
 
-        self.timed_events = []
-
         #send out events to connect and send USER and NICK commands
         self.irc.connect(self.network, self.port)
         self.irc.user(self.nick, "Python Robot")
         self.irc.nick(self.nick)
 
     def command(self, expr, func, direct=False, can_mute=True, private=False,
-                auth_level=100):
+                auth_level=100, offload=False, timeout=None):
         '''
         Helper function that constructs a command handler suitable for CommandBot.
         Theres are essentially an extension of the EVENT concept from message_util.py
@@ -137,6 +203,10 @@ class CommandBot():
             private - Is this message always going to a private channel?
             auth_level - Level of auth this command requires (users who do not have
                          this level will be ignored
+            offload - Run func on the worker pool instead of the main loop, for
+                      handlers that can take a while (see workers.py)
+            timeout - Seconds an offloaded func gets before it is abandoned,
+                      None uses the pool's default
 
         These are intended to be evaluated against user messages and when a match is found
         it calls the associated function, passing through the match object to allow you to
@@ -144,6 +214,7 @@ class CommandBot():
         '''
         guard = re.compile(expr)
         bot = self
+        name = getattr(func, '__name__', expr)
         def process(source, action, args, message):
             #grab nick and nick host
             nick, nickhost = source.split("!")
@@ -192,16 +263,82 @@ class CommandBot():
                     return True #Auth failed but was command
 
             #call the function
-            func(nick, nickhost, action, args, message, m)
+            if offload:
+                if not bot.workers.submit(name, func, (nick, nickhost, action, args, message, m),
+                                          args, timeout):
+                    bot.irc.msg_all(u"Too busy right now, try again later", args)
+            else:
+                func(nick, nickhost, action, args, message, m)
             return True
 
+        #so the command index knows which messages to try it on
+        process.expr = expr
+        process.direct = direct
+        process.prefix = literal_prefix(expr)
+        process.handler = name
         return process
     
+    def has_cap(self, cap):
+        '''
+        Returns true if the server enabled this IRCv3 capability for us
+        '''
+        return cap in self.caps
+
     def in_event(self, event):
         self.inq.put(event)
     
     def out_event(self, event):
+        #an offloaded command that ran out of time has already been answered
+        if self.workers.suppressed():
+            return
         self.outq.put(event)
+        #let the network thread know there is something to send
+        self.net.wakeup()
+
+    def thread_db(self):
+        '''
+        The database connection for the calling thread, sqlite connections
+        can't be shared between threads so offloaded commands use this
+        instead of self.db
+        '''
+        if threading.current_thread() is self.main_thread:
+            return self.db
+
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_file)
+            self.local.db = db
+        return db
+
+    def shared_memory_db(self):
+        '''
+        The name of an in memory database that every thread can open its own
+        connection to, or of a temporary file if this sqlite doesn't
+        understand uri file names
+        '''
+        name = 'file:bot{0}?mode=memory&cache=shared'.format(id(self))
+        probe = sqlite3.connect(name)
+        #(seq, name, file), file is empty for an in memory db
+        in_memory = not probe.execute('PRAGMA database_list').fetchone()[2]
+        probe.close()
+        if in_memory:
+            return name
+
+        #it was taken as a plain file name
+        os.remove(name)
+        fd, self.temp_db = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.log.warning(u'No in memory database shared between threads, using {0}'.format(self.temp_db))
+        return self.temp_db
+
+    def close_thread_db(self):
+        '''
+        Close the calling thread's connection from thread_db, if it has one
+        '''
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
 
     def add_module(self, name, module):
         '''
@@ -211,6 +348,19 @@ class CommandBot():
         if name in self.modules:
             raise KeyError(u"Module name:{0} already in use".format(name))
         self.modules[name] = module
+        if hasattr(module, 'log'):
+            self.set_log_level(name, module.log)
+
+    def set_log_level(self, name, log):
+        '''
+        Apply the log_levels override for a module (or the network) if there is one
+        '''
+        if name not in self.log_levels:
+            return
+
+        level = self.log_levels[name]
+        #one past CRITICAL so nothing gets through
+        log.setLevel(logging.CRITICAL + 1 if level is None else level)
 
     def get_module(self, name):
         '''
@@ -260,18 +410,95 @@ class CommandBot():
         in a subclass
         '''
         while self.is_running:
+            self.wait_for_events(self.next_timeout())
             self.logic()
-            time.sleep(.1)
+
+        if not self.threaded:
+            self.finish_network()
 
         self.cleanup()
         self.log.info("Bot ending")
 
+    def wait_for_events(self, timeout=None):
+        '''
+        Block until there is an event on the inbound queue or timeout seconds
+        have passed, whichever comes first. A timeout of None waits for the
+        next inbound event (capped at max_wait)
+        '''
+        if self.max_wait is not None and (timeout is None or timeout > self.max_wait):
+            timeout = self.max_wait
+
+        if not self.threaded:
+            #we are the network loop, don't sleep if there is already work to do
+            if not self.inq.empty():
+                timeout = 0
+            self.net.run_once(timeout)
+            return
+
+        #the network thread makes the pipe readable when it queues something,
+        #a timed Condition.wait would poll every few ms on python 2
+        wakeup = self.inq.wakeup_fd()
+        self.inq.clear_wakeup()
+        if self.inq.qsize():
+            return
+
+        try:
+            select.select([wakeup], [], [], timeout)
+        except select.error as e:
+            #interrupted by a signal, the loop will come back around
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def finish_network(self, timeout=5):
+        '''
+        When not threaded nobody else runs the network, so after the loop ends
+        keep it going until it has processed the KILL from close (sending
+        anything queued before it, i.e QUIT) or timeout seconds pass
+        '''
+        deadline = time.time() + timeout
+        while self.net.is_running and time.time() < deadline:
+            self.net.run_once(.1)
+
+        self.net.finish()
+
+    def next_timeout(self):
+        '''
+        Returns how many seconds until the next timed event needs to be looked at
+        or None if there are no timed events
+        '''
+        if not self.timed_events:
+            return None
+
+        soonest = min(min(event.next_timeout, event.ed) for event in self.timed_events)
+        remaining = (soonest - datetime.now()).total_seconds()
+        return max(remaining, 0)
+
     def logic(self):
         '''
         Simple logic processing.
 
-        Examines all messages received, then attempts to match commands against any messages, in 
-        the following order
+        Processes every message waiting on the inbound queue (see process_event)
+        and then evaluates all timed events and triggers them appropriately
+        '''
+        #only take what is already queued so a busy server can't starve the timers
+        for i in xrange(self.inq.qsize()):
+            if not self.is_running:
+                break
+
+            try:
+                m_event = self.inq.get(False)
+
+            except Queue.Empty:
+                #nothing to do
+                break
+
+            self.process_event(m_event)
+
+        self.run_timed_events()
+
+    def process_event(self, m_event, skip=frozenset()):
+        '''
+        Attempts to match commands against a message, in the following order
 
         if a privmsg
             commands local to commandbot
@@ -281,84 +508,129 @@ class CommandBot():
         events local to commandbot
         events in modules loaded
 
-        It also evaluates all timed events and triggers them appropriately
+        The events of the groups (by number, the core is 0) in skip are
+        left out, see the end of this for why
         '''
-        try:
-            #try to grab an event from the inbound queue
-            m_event = self.inq.get(False)
-            self.log.debug(u"Inbound event {0}".format(m_event))
-            was_event = False
-            #this is the cleaned data from an irc msg
-            #i.e PRIVMSG francis!francis@localhost [#bots] "hey all"
-            #if a priv message we first pass it through the command handlers
-            if m_event.type == nu.BOT_PRIVMSG:
-                was_event=True
-                #unpack the data!
-                action, source, args, message = m_event.data
-                for command in self.commands:
-                    try:
-                        if command(source, action, args, message):
-                            action = nu.BOT_COMM #we set the action to command so valid commands can be identified by modules
-                            break #TODO, should we break, needs a lot more thought
-
-                    except Exception as e:
-                        self.log.exception(u"Error in bot command handler")
-                        self.irc.msg_all(u"Unable to complete request due to internal error", args)
-                        
-
-                for module_name in self.modules:
-                    module = self.modules[module_name]
-                    for command in module.commands:
-                        try:
-                            if command(source, action, args, message):
-                                action = nu.BOT_COMM
-                                break
-
-                        except Exception as e:
-                            self.log.exception("Error in module command handler:{0}".format(module_name))
-                            self.irc.msg_all("Unable to complete request due to internal error", args)
-
-            #check it against the event commands
-            for event in self.events:
-                try:
-                    if event(m_event):
-                        was_event = True
-
-                except Exception as e:
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(u"Inbound event %s", m_event)
+        was_event = False
+        #this is the cleaned data from an irc msg
+        #i.e PRIVMSG francis!francis@localhost [#bots] "hey all"
+        #if a priv message we first pass it through the command handlers
+        if m_event.type == nu.BOT_PRIVMSG:
+            was_event=True
+            #unpack the data!
+            action, source, args, message = m_event.data
+            try:
+                self.dispatch_command(source, action, args, message)
+            except Exception:
+                #the handlers have their own, this is the dispatching itself
+                self.log.exception(u"Error dispatching {0}".format(m_event))
+
+        #then the event handlers subscribed to this type of event
+        groups = [(None, self.events)]
+        groups.extend((name, self.modules[name].events) for name in self.modules)
+        self.event_table.update(groups)
+        for number, position, module_name, event in self.event_table.handlers(m_event.type):
+            if number in skip:
+                continue
+            start = time.time()
+            try:
+                if event(m_event):
+                    was_event = True
+                    self.metrics.observe('event', module_name, getattr(event, 'handler', '?'),
+                                         time.time() - start)
+
+            except Exception as e:
+                self.metrics.observe('event', module_name, getattr(event, 'handler', '?'),
+                                     time.time() - start)
+                if module_name is None:
                     self.log.exception("Error in bot event handler")
+                else:
+                    self.log.exception(u"Error in module event handler: {0}".format(module_name))
 
-            for module_name in self.modules:
-                module = self.modules[module_name]
-                for event in module.events:
-                    try:
-                        if event(m_event):
-                            was_event = True
+        if m_event.type == nu.BOT_BATCH_GROUP:
+            #hand over what was in the batch to everyone that didn't take it
+            #as a whole, the ones that did have already seen it
+            skip = skip | self.event_table.subscribers(nu.BOT_BATCH_GROUP)
+            for message in m_event.data[2]:
+                self.process_event(message, skip)
 
-                    except Exception as e:
-                        self.log.exception(u"Error in module event handler: {0}".format(module_name))
+        elif not was_event:
+            self.log.debug(u"Unhandled event %s", m_event)
 
-            if not was_event:
-                self.log.debug(u"Unhandled event {0}".format(m_event))
+    def dispatch_command(self, source, action, args, message):
+        '''
+        Try a PRIVMSG against the commands, the core's then each module's.
+        Within each of those the first command that matches wins, and the
+        ones after a match see the action as BOT_COMM.
+        Only the commands whose literal prefix fits the message are tried
+        (see dispatch.py), which gives the same result as trying them all
+        '''
+        #what every command closure does first, done once here as the
+        #index may not run any of them (event handlers see it too)
+        if self.nick in args and '!' in source:
+            nick = source.split('!')[0]
+            for i, channel in enumerate(args):
+                if channel == self.nick:
+                    args[i] = nick
 
-        except Queue.Empty:
-            #nothing to do
-            pass
+        groups = [(None, self.commands)]
+        groups.extend((name, self.modules[name].commands) for name in self.modules)
+        self.command_index.update(groups)
+
+        matched = None
+        for number, position, module_name, command in self.command_index.candidates(message, self.nick):
+            if number == matched:
+                continue
+            start = time.time()
+            try:
+                if command(source, action, args, message):
+                    action = nu.BOT_COMM #we set the action to command so valid commands can be identified by modules
+                    matched = number
+                    self.metrics.observe('command', module_name, getattr(command, 'handler', '?'),
+                                         time.time() - start)
+
+            except Exception as e:
+                self.metrics.observe('command', module_name, getattr(command, 'handler', '?'),
+                                     time.time() - start)
+                if module_name is None:
+                    self.log.exception(u"Error in bot command handler")
+                else:
+                    self.log.exception("Error in module command handler:{0}".format(module_name))
+                self.irc.msg_all(u"Unable to complete request due to internal error", args)
+
+    def unhandled_events(self):
+        '''
+        The inbound event types nothing has subscribed to, with how many of
+        each have arrived, most common first
+        '''
+        return self.event_table.unsubscribed_types()
 
+    def run_timed_events(self):
+        '''
+        Trigger any timed events that are due and remove expired ones
+        '''
+        #one now for the whole pass, a one shot event (run_event_in) is due
+        #and expires at the same moment, so with two clocks it could expire
+        #without ever having triggered
+        now = datetime.now()
         #clone timed events list and go through the clone
         for event in self.timed_events[:]:
-            if event.should_trigger():
+            if event.should_trigger(now):
+                start = time.time()
                 try:
                     event.func(*event.func_args, **event.func_kwargs)
 
                 except Exception as e:
                     self.log.exception("Error in timed event handler")
+                self.metrics.observe('timed', None, getattr(event.func, '__name__', '?'),
+                                     time.time() - start)
 
-            if event.is_expired():
+            if event.is_expired(now):
                 #remove from the original list
                 self.timed_events.remove(event)
 
-        return
-
     def syntax (self, nick, nickhost, action, targets, message, m):
         '''
         either lists all module names or if a modulename is provided
@@ -407,6 +679,9 @@ class CommandBot():
         '''
         self.log.info('Cleaning up after myself')
         self.db.close()
+        self.inq.close_wakeup()
+        if self.temp_db:
+            os.remove(self.temp_db)
 
     def mute(self, nick, nickhost, action, targets, message, m):
         '''
@@ -432,6 +707,7 @@ class CommandBot():
         #TODO: what else do we need to extend this too?
         #messages/privmsgs
         self.registered = True
+        self.connected_since = time.time()
         for channel in self.channels:
             self.join(channel)
 
@@ -446,33 +722,65 @@ class CommandBot():
         else:
             self.channels.append(channel)
 
-    def reconnect(self, source, event, args, message):
+    def reconnect(self, command, prefix, params, message):
         '''
-        Handles disconnection by trying to reconnect 3 times
-        before quitting
+        Handles disconnection by scheduling a reconnection attempt, backing
+        off exponentially (with jitter) each time it fails. Everything else
+        keeps running while we wait
         '''
         #if we have been kicked, don"t attempt a reconnect
         #TODO : send a rejoin for every channel in our ident list
         #TODO : purge ident mappings  (module handle reconnect event?)
-        if  event == "KILL":
+        if command == nu.BOT_KILL:
             self.log.info("No reconnection attempt due to being killed")
             self.close()
-            
-        self.log.error("Lost connection to server:{0}".format(message))
-        if self.times_reconnected >= self.max_reconnects:
-            self.log.error("Unable to reconnect to server on third attempt")
+            return
+
+        self.log.error(u"Lost connection to server:{0}".format(message))
+        self.registered = False
+        #a server ERROR is normally followed by the socket closing, one attempt will do
+        if self.reconnect_pending:
+            self.log.debug("Reconnection attempt already scheduled")
+            return
+
+        #we were connected for a good while, so this is a fresh problem
+        if self.connected_since and time.time() - self.connected_since >= self.stable_session:
+            self.times_reconnected = 0
+        self.connected_since = None
+
+        if self.max_reconnects is not None and self.times_reconnected >= self.max_reconnects:
+            self.log.error(u"Unable to reconnect to server after {0} attempts".format(self.times_reconnected))
             self.close()
-        
-        else:
-            self.log.info(u"Sleeping before reconnection attempt, {0} seconds".format(self.times_reconnected*60))
-            time.sleep((self.times_reconnected+1)*60)
-            self.registered = False
-            self.log.info(u"Attempting reconnection, attempt no: {0}".format(self.times_reconnected))
-            self.times_reconnected += 1
-            #set up events to connect and send USER and NICK commands
-            self.irc.connect(self.network, self.port)
-            self.irc.user(self.nick, "Python Robot")
-            self.irc.nick(self.nick)
+            return
+
+        delay = self.reconnect_backoff(self.times_reconnected)
+        self.log.info(u"Reconnection attempt in {0:.1f} seconds".format(delay))
+        self.reconnect_pending = True
+        self.run_event_in(delay, self.attempt_reconnect)
+
+    def reconnect_backoff(self, attempt):
+        '''
+        Seconds to wait before the given reconnection attempt, doubling each
+        time up to max_reconnect_delay. Half of it is random so a netsplit
+        doesn't have every bot coming back at the same moment
+        '''
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempt)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def attempt_reconnect(self):
+        '''
+        Timed event from reconnect, send the events to connect and register again
+        '''
+        self.reconnect_pending = False
+        if not self.is_running:
+            return
+
+        self.times_reconnected += 1
+        self.log.info(u"Attempting reconnection, attempt no: {0}".format(self.times_reconnected))
+        #set up events to connect and send USER and NICK commands
+        self.irc.connect(self.network, self.port)
+        self.irc.user(self.nick, "Python Robot")
+        self.irc.nick(self.nick)
     
     def ping(self, source, action, args, message):
         '''
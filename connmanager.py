@@ -0,0 +1,134 @@
+import time
+import errno
+import select
+import signal
+import logging
+
+class ConnectionManager(object):
+    '''
+    Runs many bots (one per irc network) in a single thread, multiplexing all
+    their connections over one select call instead of a network thread and
+    a polling loop per bot
+
+    Each bot keeps its own modules, database and queues, it just has to be
+    created with threaded=False so it doesn't start its own network thread
+
+    i.e
+        manager = ConnectionManager()
+        for server in servers:
+            bot = CommandBot('mybot', server, 6667, db_file=server + '.db', threaded=False)
+            AliasBot(bot)
+            bot.join('#bots')
+            manager.add_bot(bot)
+        manager.loop()
+    '''
+
+    def __init__(self, module_name='manager', log_level=logging.INFO, max_wait=1.0,
+                 shutdown_timeout=5):
+        self.log = logging.getLogger(module_name)
+        self.log.setLevel(log_level)
+        self.bots = []
+        #bots that have closed but whose network is still sending the QUIT
+        self.closing = {}
+        #longest we sit in select, so signal handlers get to run
+        self.max_wait = max_wait
+        self.shutdown_timeout = shutdown_timeout
+
+    def add_bot(self, bot):
+        '''
+        Add a bot to be run by this manager
+        '''
+        if bot.threaded:
+            raise ValueError(u'Bot {0} runs its own network thread, create it with threaded=False'.format(bot.nick))
+        self.bots.append(bot)
+
+    def loop(self):
+        '''
+        Run every bot until they have all been closed
+        '''
+        #the bots each registered a handler, we want one that closes all of them
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGQUIT, self.signal_handler)
+
+        while self.bots:
+            self.run_once(self.next_timeout())
+
+        self.log.info('All bots ended')
+
+    def next_timeout(self):
+        '''
+        The longest we can sleep in select without making any bot late
+        '''
+        timeout = self.max_wait
+        for bot in self.bots:
+            if not bot.inq.empty():
+                return 0
+
+            for bot_timeout in (bot.next_timeout(), bot.net.next_timeout()):
+                if bot_timeout is not None and (timeout is None or bot_timeout < timeout):
+                    timeout = bot_timeout
+
+        return timeout
+
+    def run_once(self, timeout=None):
+        '''
+        One select over every connection, then let each bot process what
+        came in
+        '''
+        inputs, outputs, errors = [], [], []
+        #which network each selectable belongs to
+        owners = {}
+        for bot in self.bots:
+            if not bot.net.is_running:
+                continue
+
+            readable, writable, exceptional = bot.net.select_sets()
+            for item in readable + writable + exceptional:
+                owners[item] = bot.net
+            inputs.extend(readable)
+            outputs.extend(writable)
+            errors.extend(exceptional)
+
+        try:
+            readable, writable, exceptional = select.select(inputs, outputs, errors, timeout)
+        except select.error as e:
+            #interrupted by a signal, come back around
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        ready = dict((bot.net, ([], [], [])) for bot in self.bots)
+        for index, items in enumerate((readable, writable, exceptional)):
+            for item in items:
+                ready[owners[item]][index].append(item)
+
+        for bot in self.bots[:]:
+            if bot.net.is_running:
+                bot.net.handle_ready(*ready[bot.net])
+
+            if bot.is_running:
+                bot.logic()
+            else:
+                self.finish_bot(bot)
+
+    def finish_bot(self, bot):
+        '''
+        A bot has closed, once its network has sent everything (or we gave up
+        waiting) clean it up and stop running it
+        '''
+        deadline = self.closing.setdefault(bot, time.time() + self.shutdown_timeout)
+        if bot.net.is_running and time.time() < deadline:
+            return
+
+        bot.net.finish()
+        bot.cleanup()
+        bot.log.info("Bot ending")
+        del self.closing[bot]
+        self.bots.remove(bot)
+
+    def signal_handler(self, signum, frame):
+        self.log.info('Received signal, closing all bots')
+        for bot in self.bots:
+            if bot.is_running:
+                bot.close()
@@ -0,0 +1,224 @@
+'''
+Lookup tables that let CommandBot skip handlers that can't apply to a
+message instead of calling every one of them
+
+CommandIndex finds command closures (see CommandBot.command) by the
+literal text their regex starts with, EventTable finds event closures
+(see event_util.event) by the event type they subscribed to
+'''
+import re
+from collections import defaultdict, Counter
+import numerics as nu
+
+#characters that end the literal start of a regex
+special = set('.^$*+?{}[]\\|()')
+#inline flags, i.e (?i), apply to the whole expression wherever they are
+inline_flags = re.compile(r'\(\?[iLmsux]+\)')
+
+def top_level_alternation(expr):
+    '''
+    True if expr has a | outside any group, i.e a|b, which means it has
+    no single literal prefix
+    '''
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+def literal_prefix(expr):
+    '''
+    The literal text every match of expr (with re.match) must start with,
+    i.e '!learn ' for r"^!learn (?P<abbr>\S+) as (?P<long>.+)$", or '' if
+    it can start with anything
+    '''
+    if top_level_alternation(expr) or inline_flags.search(expr):
+        return u''
+
+    i = 1 if expr.startswith('^') else 0
+    prefix = []
+    while i < len(expr):
+        c = expr[i]
+        if c == '\\':
+            #escaped punctuation is literal, \d \S etc are not
+            if i + 1 >= len(expr) or expr[i + 1].isalnum():
+                break
+            literal, step = expr[i + 1], 2
+        elif c in special:
+            break
+        else:
+            literal, step = c, 1
+
+        following = expr[i + step:i + step + 1]
+        #a quantifier makes the character optional (or repeated)
+        if following and following in '*?{':
+            break
+        prefix.append(literal)
+        if following == '+':
+            break
+        i += step
+
+    prefix = u''.join(prefix) if isinstance(expr, unicode) else ''.join(prefix)
+    try:
+        #str and unicode only hash the same when they are ascii
+        return unicode(prefix)
+    except UnicodeDecodeError:
+        return u''
+
+
+class CommandIndex(object):
+    '''
+    Commands grouped like CommandBot.process_event tries them (the core's
+    then each module's), indexed by literal prefix. Direct commands are
+    indexed on what follows the bot's nick
+
+    Commands that weren't made by CommandBot.command (so have no prefix)
+    are always candidates
+    '''
+
+    def __init__(self):
+        self.signature = None
+        #prefix => [(group number, position, group name, command)]
+        self.plain = defaultdict(list)
+        self.direct = defaultdict(list)
+        #the prefix lengths present, so a lookup is one dict get per length
+        self.plain_lengths = []
+        self.direct_lengths = []
+        self.size = 0
+
+    def update(self, groups):
+        '''
+        Rebuild the index if the groups ([(name, commands)]) have changed
+        since the last time
+        '''
+        signature = [(name, id(commands), len(commands)) for name, commands in groups]
+        if signature != self.signature:
+            self.build(groups)
+            self.signature = signature
+
+    def build(self, groups):
+        self.plain.clear()
+        self.direct.clear()
+        self.size = 0
+        for number, (name, commands) in enumerate(groups):
+            for position, command in enumerate(commands):
+                prefix = getattr(command, 'prefix', u'')
+                index = self.direct if getattr(command, 'direct', False) else self.plain
+                index[prefix].append((number, position, name, command))
+                self.size += 1
+
+        self.plain_lengths = sorted(set(len(prefix) for prefix in self.plain))
+        self.direct_lengths = sorted(set(len(prefix) for prefix in self.direct))
+
+    def candidates(self, message, nick):
+        '''
+        The commands that might match message, in the order they would have
+        been tried, as (group number, position, group name, command)
+        '''
+        found = []
+        self.lookup(self.plain, self.plain_lengths, message, found)
+        if self.direct and message.startswith(nick):
+            #the same stripping the command closure does
+            self.lookup(self.direct, self.direct_lengths, message[len(nick):].lstrip(': '), found)
+        found.sort()
+        return found
+
+    def lookup(self, index, lengths, message, found):
+        for length in lengths:
+            if length > len(message):
+                break
+            entries = index.get(message[:length])
+            if entries:
+                found.extend(entries)
+
+
+class EventTable(object):
+    '''
+    Event closures grouped like CommandBot.process_event calls them (the
+    core's then each module's), keyed on the event type they were made for.
+    Closures subscribed to nu.BOT_ANY, and any that weren't made by
+    event_util.event, get every event
+
+    Also counts the event types that arrived with nobody subscribed
+    '''
+
+    def __init__(self):
+        self.signature = None
+        #event type => [(group number, position, group name, event)]
+        self.by_type = defaultdict(list)
+        self.wildcard = []
+        #event type => the handlers to call, in order, wildcards included
+        self.cache = {}
+        self.unsubscribed = Counter()
+
+    def update(self, groups):
+        '''
+        Rebuild the table if the groups ([(name, events)]) have changed
+        since the last time
+        '''
+        signature = [(name, id(events), len(events)) for name, events in groups]
+        if signature != self.signature:
+            self.build(groups)
+            self.signature = signature
+
+    def build(self, groups):
+        self.by_type.clear()
+        self.cache.clear()
+        self.wildcard = []
+        for number, (name, events) in enumerate(groups):
+            for position, event in enumerate(events):
+                event_id = getattr(event, 'event_id', nu.BOT_ANY)
+                entry = (number, position, name, event)
+                if event_id == nu.BOT_ANY:
+                    self.wildcard.append(entry)
+                else:
+                    self.by_type[event_id].append(entry)
+
+    def handlers(self, event_type):
+        '''
+        The (group number, position, group name, event) subscribed to
+        event_type, in the order they would have been called
+        '''
+        handlers = self.cache.get(event_type)
+        if handlers is None:
+            handlers = sorted(self.by_type.get(event_type, []) + self.wildcard)
+            self.cache[event_type] = handlers
+        if not handlers:
+            self.unsubscribed[event_type] += 1
+        return handlers
+
+    def subscribers(self, event_type):
+        '''
+        The group numbers with a handler made for event_type itself,
+        wildcards not included
+        '''
+        return frozenset(entry[0] for entry in self.by_type.get(event_type, []))
+
+    def subscribed_types(self):
+        '''
+        Event type => number of handlers for it (wildcards not included)
+        '''
+        return dict((event_type, len(entries)) for event_type, entries in self.by_type.items())
+
+    def unsubscribed_types(self):
+        '''
+        Event types that have arrived with no handler at all, with how many
+        times, most common first
+        '''
+        return self.unsubscribed.most_common()
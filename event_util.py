@@ -1,4 +1,5 @@
 import collections
+from datetime import datetime
 from functools import total_ordering
 import numerics as nu
 
@@ -14,26 +15,34 @@ class M_ordering(object):
         return self.priority < other.priority
 
 
-class Message(M_ordering, collections.namedtuple('Message', 'type data priority')):
+class Message(M_ordering, collections.namedtuple('Message', 'type data priority tags')):
     """
-    Our data type
+    Our data type, tags holds the IRCv3 message tags (if any) the
+    server sent with an inbound message
     """
-    pass
+
+    def __new__(cls, type, data, priority, tags=None):
+        return super(Message, cls).__new__(cls, type, data, priority, tags)
 
 def event(event_id, func):
     """
     This function will take a function and an event_id, when an inbound message"s action
     matches the event_id it will call the function with the data argument and return True
     it returns False if they don"t match
+    An event_id of nu.BOT_ANY matches every message
     """
     event_id = event_id
+    any_event = event_id == nu.BOT_ANY
 
     def process(message):
-        if not event_id == message.type:
+        if not (any_event or event_id == message.type):
             return False
         func(*message.data)
         return True
 
+    #so CommandBot can file it under its event type, and time it
+    process.event_id = event_id
+    process.handler = getattr(func, '__name__', event_id)
     return process
 
 
@@ -59,25 +68,28 @@ class TimedEvent:
         self.func_kwargs = func_kwargs
         self.next_timeout = self.sd + self.interval
 
-    def should_trigger(self):
+    def should_trigger(self, current_time=None):
         """
         Returns true if the timed event interval has elapsed and we need
         to trigger the function. It also updates when the next timeout
         should occur
         """
-        current_time = datetime.now()
+        if current_time is None:
+            current_time = datetime.now()
         if current_time > self.next_timeout:
             self.next_timeout = current_time + self.interval
             return True
         else:
             return False
 
-    def is_expired(self):
+    def is_expired(self, current_time=None):
         """
         Returns true if the current time is greater than the end_time for
         this event
         """
-        if datetime.now() > self.ed:
+        if current_time is None:
+            current_time = datetime.now()
+        if current_time > self.ed:
             return True
         else:
             return False
@@ -90,12 +102,12 @@ again, where you don't need to explicitly insert the returned
 events.
 '''
 
-def irc_msg(command, data, priority=3):
+def irc_msg(command, data, priority=3, tags=None):
     '''
     Network uses this to store the inbound events
     from the server on the in queue of the main bot
     '''
-    return Message(command, data, priority)
+    return Message(command, data, priority, tags)
 
 def join(channel, priority = 3):
     return Message(nu.BOT_JOIN_CHAN, (channel,), priority)
@@ -133,11 +145,27 @@ def kill(priority = 0):
 def pong(msg, priority = 1):
     return Message(nu.BOT_PONG, (msg,), priority)
 
-def error(msg, priority = 1):
-    return Message(nu.BOT_ERROR, (msg,), priority)
+def ping(token, priority = 1):
+    return Message(nu.BOT_PING, (token,), priority)
+
+def disconnect(reason, priority = 1):
+    return Message(nu.BOT_DISCONNECT, (reason,), priority)
+
+def profile(path, priority = 1):
+    return Message(nu.BOT_PROFILE, (path,), priority)
 
 def name(channel, priority):
     return Message(nu.BOT_NAMES, (channel,), priority)
 
 def who(param, priority = 3):
     return Message(nu.BOT_WHO, (param,), priority)
+
+def cap_req(caps, priority = 1):
+    return Message(nu.BOT_CAP_REQ, (caps,), priority)
+
+def batch(batch_type, params, messages, priority = 3):
+    '''
+    Network uses this to hand over a whole server BATCH at once,
+    messages are the events that were inside it
+    '''
+    return Message(nu.BOT_BATCH_GROUP, (batch_type, params, messages), priority)
@@ -0,0 +1,576 @@
+'''
+A stand-in irc server for load testing the bot on one machine
+
+It speaks just enough of the protocol for a bot: CAP negotiation,
+registration, JOIN, PART, NAMES, WHO, PRIVMSG, PING and QUIT, and kills
+clients that flood it like a real ircd would. It makes up a network of
+simulated users spread over a number of channels which can chatter,
+join/part and send the bot commands at the given rates. The time between
+a command going out and the bot's next message to that channel is recorded
+as the command latency
+
+In process:
+    server = FakeIRCd(channels=10, users=500, chatter_rate=50).start()
+    bot = CommandBot('loadbot', '127.0.0.1', server.port, ...)
+    ...
+    print(server.stats())
+    server.stop()
+
+As a script, python fakeircd.py [--port 6667] [--channels n] [--users n] ...
+serves until interrupted, with --bot it runs a bot against itself for
+--duration seconds and prints the results
+'''
+import ssl
+import time
+import errno
+import random
+import select
+import socket
+import logging
+import argparse
+import threading
+import ircparse
+from collections import deque
+
+class Client(object):
+    '''
+    A connection to the fake server
+    '''
+
+    def __init__(self, sock, address, flood_burst):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        self.out = bytearray()
+        self.nick = None
+        self.user = None
+        self.host = 'localhost'
+        self.registered = False
+        self.cap_negotiating = False
+        self.caps = set()
+        self.channels = set()
+        self.closing = False
+        #flood protection, like FloodControl but on the server side
+        self.tokens = flood_burst
+        self.last_line = time.time()
+        #channel => times of commands sent there that are waiting on a reply
+        self.pending = {}
+        #the last (target, text) it sent PRIVMSG or NOTICE to
+        self.received = deque(maxlen=100)
+
+    def source(self):
+        return '{0}!{1}@{2}'.format(self.nick, self.user, self.host)
+
+
+class FakeIRCd(object):
+    '''
+    A single threaded select based irc server, see the module docstring
+
+    Rates are events a second across the whole network, only traffic in
+    channels the client has joined is sent to it. flood_burst=None turns
+    off the flood kill
+    '''
+    caps = set(['multi-prefix', 'userhost-in-names', 'batch'])
+
+    def __init__(self, host='127.0.0.1', port=0, channels=10, users=100, channels_per_user=3,
+                 chatter_rate=0, churn_rate=0, command=u'!syntax', command_rate=0,
+                 flood_burst=10, flood_rate=2.0, certfile=None, keyfile=None,
+                 name='irc.fake', seed=1, log_level=logging.INFO):
+        self.log = logging.getLogger('fakeircd')
+        self.log.setLevel(log_level)
+        self.name = name
+        self.rand = random.Random(seed)
+        self.flood_burst = flood_burst
+        self.flood_rate = flood_rate
+        self.chatter_rate = chatter_rate
+        self.churn_rate = churn_rate
+        self.command = command
+        self.command_rate = command_rate
+        self.tls_context = None
+        if certfile:
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.tls_context.load_cert_chain(certfile, keyfile)
+
+        #the simulated network, nick => user@host and channel => nicks in it
+        self.channel_names = ['#chan{0}'.format(i) for i in range(channels)]
+        self.users = {}
+        self.members = dict((channel, set()) for channel in self.channel_names)
+        for i in range(users):
+            nick = 'user{0}'.format(i)
+            self.users[nick] = '~{0}@host-{1}.fake'.format(nick, i)
+            for channel in self.rand.sample(self.channel_names, min(channels_per_user, channels)):
+                self.members[channel].add(nick)
+        self.words = ['the', 'bot', 'is', 'down', 'again', 'anyone', 'seen', 'this', 'error',
+                      'deploy', 'friday', 'lunch', 'ok', 'lol', 'http://example.com/a/b']
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.setblocking(0)
+        self.port = self.listener.getsockname()[1]
+        self.clients = {}
+        self.is_running = False
+        self.thread = None
+
+        #fractions of an event owed to each of the simulations
+        self.owed = {'chatter': 0.0, 'churn': 0.0, 'command': 0.0}
+        self.last_tick = time.time()
+
+        #counters
+        self.lines_in = 0
+        self.lines_out = 0
+        self.commands_sent = 0
+        self.flood_kills = 0
+        self.latencies = []
+
+    def start(self):
+        '''
+        Serve from a background thread, returns self
+        '''
+        #set here rather than on the thread, so a stop straight after sticks
+        self.is_running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.is_running = False
+        if self.thread:
+            self.thread.join(5)
+
+    def serve_forever(self):
+        self.is_running = True
+        self.serve()
+
+    def serve(self):
+        '''
+        Serve until stopped
+        '''
+        self.log.info('Fake ircd listening on port {0}'.format(self.port))
+        while self.is_running:
+            self.run_once(0.01)
+
+        for client in self.clients.values():
+            client.sock.close()
+        self.listener.close()
+
+    def run_once(self, timeout):
+        readable = [self.listener] + list(self.clients)
+        writable = [sock for sock, client in self.clients.items() if client.out]
+        try:
+            readable, writable, _ = select.select(readable, writable, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for sock in readable:
+            if sock is self.listener:
+                self.accept()
+            elif sock in self.clients:
+                self.read(self.clients[sock])
+
+        for sock in writable:
+            if sock in self.clients:
+                self.write(self.clients[sock])
+
+        self.simulate()
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+
+        if self.tls_context:
+            #a blocking handshake is fine for a test server
+            sock.settimeout(5)
+            try:
+                sock = self.tls_context.wrap_socket(sock, server_side=True)
+            except (ssl.SSLError, socket.error) as e:
+                self.log.warning('TLS handshake failed: {0}'.format(e))
+                sock.close()
+                return
+        sock.setblocking(0)
+        self.clients[sock] = Client(sock, address, self.flood_burst)
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(65536)
+            #select can't see data already decrypted by the TLS layer
+            while self.tls_context and client.sock.pending():
+                data += client.sock.recv(65536)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+
+        if not data:
+            self.remove(client)
+            return
+
+        client.buffer += data
+        while not client.closing:
+            end = client.buffer.find(b'\r\n')
+            if end < 0:
+                break
+            line = client.buffer[:end].decode('utf-8', 'replace')
+            del client.buffer[:end + 2]
+            self.lines_in += 1
+            if self.flooded(client):
+                self.kill(client, 'Excess Flood')
+                self.flood_kills += 1
+                break
+            self.handle(client, line)
+
+    def write(self, client):
+        try:
+            sent = client.sock.send(client.out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.remove(client)
+            return
+
+        del client.out[:sent]
+        if client.closing and not client.out:
+            self.remove(client)
+
+    def remove(self, client):
+        self.clients.pop(client.sock, None)
+        for channel in client.channels:
+            self.members[channel].discard(client.nick)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def send(self, client, line):
+        client.out += line.encode('utf-8') + b'\r\n'
+        self.lines_out += 1
+
+    def reply(self, client, numeric, text):
+        self.send(client, u':{0} {1} {2} {3}'.format(self.name, numeric, client.nick or '*', text))
+
+    def kill(self, client, reason):
+        self.send(client, u'ERROR :Closing Link: {0} ({1})'.format(client.host, reason))
+        client.closing = True
+
+    def flooded(self, client):
+        '''
+        Token bucket per client, True once it has sent too much too fast
+        '''
+        if self.flood_burst is None:
+            return False
+        now = time.time()
+        client.tokens = min(self.flood_burst, client.tokens + (now - client.last_line) * self.flood_rate)
+        client.last_line = now
+        client.tokens -= 1
+        return client.tokens < 0
+
+    #the protocol
+    def handle(self, client, line):
+        parsed = ircparse.parse(line)
+        if not parsed:
+            return
+        tags, prefix, command, params, postfix = parsed
+        if postfix is not None:
+            params = params + [postfix]
+        handler = getattr(self, 'irc_' + command.upper(), None)
+        if handler:
+            handler(client, params)
+        elif client.registered:
+            self.reply(client, '421', u'{0} :Unknown command'.format(command))
+
+    def irc_CAP(self, client, params):
+        sub = params[0].upper() if params else ''
+        if sub == 'LS':
+            client.cap_negotiating = True
+            self.send(client, u':{0} CAP * LS :{1}'.format(self.name, u' '.join(sorted(self.caps))))
+        elif sub == 'REQ' and len(params) > 1:
+            wanted = params[1].split()
+            answer = 'ACK' if set(wanted) <= self.caps else 'NAK'
+            if answer == 'ACK':
+                client.caps.update(wanted)
+            self.send(client, u':{0} CAP * {1} :{2}'.format(self.name, answer, params[1]))
+        elif sub == 'END':
+            client.cap_negotiating = False
+            self.register(client)
+
+    def irc_NICK(self, client, params):
+        if not params:
+            return
+        if client.registered:
+            self.send(client, u':{0} NICK :{1}'.format(client.source(), params[0]))
+        client.nick = params[0]
+        self.register(client)
+
+    def irc_USER(self, client, params):
+        if params:
+            client.user = params[0]
+        self.register(client)
+
+    def register(self, client):
+        if client.registered or client.cap_negotiating or not (client.nick and client.user):
+            return
+        client.registered = True
+        self.reply(client, '001', u':Welcome to the fake network {0}'.format(client.source()))
+        self.reply(client, '005', u'CHANTYPES=# PREFIX=(ov)@+ NICKLEN=30 CASEMAPPING=rfc1459 '
+                                  u'TARGMAX=PRIVMSG:4,NOTICE:4,NAMES:1 :are supported by this server')
+        self.reply(client, '375', u':- {0} Message of the day -'.format(self.name))
+        self.reply(client, '376', u':End of /MOTD command.')
+
+    def irc_PING(self, client, params):
+        self.send(client, u':{0} PONG {0} :{1}'.format(self.name, params[-1] if params else ''))
+
+    def irc_PONG(self, client, params):
+        pass
+
+    def irc_JOIN(self, client, params):
+        if not params:
+            return
+        for channel in params[0].split(','):
+            if channel not in self.members:
+                self.members[channel] = set()
+            self.members[channel].add(client.nick)
+            client.channels.add(channel)
+            self.send(client, u':{0} JOIN {1}'.format(client.source(), channel))
+            self.irc_NAMES(client, [channel])
+
+    def irc_PART(self, client, params):
+        if not params:
+            return
+        for channel in params[0].split(','):
+            if channel in client.channels:
+                client.channels.discard(channel)
+                self.members[channel].discard(client.nick)
+                self.send(client, u':{0} PART {1}'.format(client.source(), channel))
+
+    def irc_NAMES(self, client, params):
+        channel = params[0] if params else '*'
+        names = []
+        for nick in sorted(self.members.get(channel, ())):
+            name = nick
+            if nick in self.users and 'userhost-in-names' in client.caps:
+                name = u'{0}!{1}'.format(nick, self.users[nick])
+            names.append(name)
+            if len(names) == 40:
+                self.reply(client, '353', u'= {0} :{1}'.format(channel, u' '.join(names)))
+                names = []
+        if names:
+            self.reply(client, '353', u'= {0} :{1}'.format(channel, u' '.join(names)))
+        self.reply(client, '366', u'{0} :End of /NAMES list.'.format(channel))
+
+    def irc_WHO(self, client, params):
+        channel = params[0] if params else '*'
+        for nick in sorted(self.members.get(channel, ())):
+            if nick == client.nick:
+                user, host = client.user, client.host
+            else:
+                user, host = self.users.get(nick, '~x@x').split('@')
+            self.reply(client, '352', u'{0} {1} {2} {3} {4} H :0 {4}'.format(channel, user, host, self.name, nick))
+        self.reply(client, '315', u'{0} :End of /WHO list.'.format(channel))
+
+    def irc_PRIVMSG(self, client, params):
+        if not params:
+            return
+        now = time.time()
+        text = params[-1] if len(params) > 1 else u''
+        #the bot can put several targets in one line (we advertise TARGMAX)
+        for target in params[0].split(','):
+            client.received.append((target, text))
+            #the bot answering one of our commands
+            sent = client.pending.get(target)
+            if sent:
+                self.latencies.append(now - sent.pop(0))
+
+    irc_NOTICE = irc_PRIVMSG
+
+    def irc_QUIT(self, client, params):
+        self.kill(client, u'Quit: {0}'.format(params[0] if params else ''))
+
+    #the simulated users
+    def simulate(self):
+        '''
+        Send whatever chatter, churn and commands are due
+        '''
+        now = time.time()
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        for kind, rate, func in (('chatter', self.chatter_rate, self.chatter),
+                                 ('churn', self.churn_rate, self.churn),
+                                 ('command', self.command_rate, self.send_command)):
+            if not rate:
+                continue
+            self.owed[kind] += elapsed * rate
+            while self.owed[kind] >= 1:
+                self.owed[kind] -= 1
+                func()
+
+    def audience(self):
+        '''
+        A random (client, channel) for the next simulated event, None if no
+        client has joined a simulated channel yet
+        '''
+        clients = [client for client in self.clients.values() if client.registered and client.channels]
+        if not clients:
+            return None
+        client = self.rand.choice(clients)
+        return client, self.rand.choice(sorted(client.channels))
+
+    def speaker(self, channel):
+        members = [nick for nick in self.members[channel] if nick in self.users]
+        if not members:
+            return None
+        nick = self.rand.choice(members)
+        return u'{0}!{1}'.format(nick, self.users[nick])
+
+    def broadcast(self, channel, line):
+        for client in self.clients.values():
+            if channel in client.channels:
+                self.send(client, line)
+
+    def chatter(self):
+        target = self.audience()
+        if not target:
+            return
+        channel = target[1]
+        source = self.speaker(channel)
+        if source:
+            text = u' '.join(self.rand.choice(self.words) for i in range(self.rand.randint(1, 20)))
+            self.broadcast(channel, u':{0} PRIVMSG {1} :{2}'.format(source, channel, text))
+
+    def churn(self):
+        '''
+        A simulated user joins or leaves (sometimes quits)
+        '''
+        target = self.audience()
+        if not target:
+            return
+        channel = target[1]
+        nick = self.rand.choice(sorted(self.users))
+        source = u'{0}!{1}'.format(nick, self.users[nick])
+        if nick not in self.members[channel]:
+            self.members[channel].add(nick)
+            self.broadcast(channel, u':{0} JOIN {1}'.format(source, channel))
+        elif self.rand.random() < .2:
+            line = u':{0} QUIT :Quit: bye'.format(source)
+            for client in self.clients.values():
+                if any(nick in self.members[c] for c in client.channels):
+                    self.send(client, line)
+            for members in self.members.values():
+                members.discard(nick)
+        else:
+            self.members[channel].discard(nick)
+            self.broadcast(channel, u':{0} PART {1} :bye'.format(source, channel))
+
+    def send_command(self, text=None, client=None, channel=None, source=None):
+        '''
+        Have a simulated user send a command to a channel the bot is in,
+        and start timing how long the bot takes to answer
+        '''
+        if client is None or channel is None:
+            target = self.audience()
+            if not target:
+                return
+            client, channel = target
+        source = source or self.speaker(channel)
+        if not source:
+            return
+        self.send(client, u':{0} PRIVMSG {1} :{2}'.format(source, channel, text or self.command))
+        client.pending.setdefault(channel, []).append(time.time())
+        self.commands_sent += 1
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(percent):
+            if not latencies:
+                return None
+            return latencies[int(round(percent / 100.0 * (len(latencies) - 1)))]
+
+        return {
+                'clients': len(self.clients),
+                'lines_in': self.lines_in,
+                'lines_out': self.lines_out,
+                'commands_sent': self.commands_sent,
+                'replies': len(latencies),
+                'latency_p50': percentile(50),
+                'latency_p95': percentile(95),
+                'latency_max': latencies[-1] if latencies else None,
+                'flood_kills': self.flood_kills,
+                }
+
+def run_bot(server, options):
+    '''
+    Run a bot against server for options.duration seconds
+    '''
+    from commandbot import CommandBot
+    net_options = {}
+    if options.no_flood:
+        net_options['flood_burst'] = None
+    if options.certfile:
+        net_options.update(tls=True, tls_verify=False)
+    bot = CommandBot('loadbot', '127.0.0.1', server.port, db_file=':memory:', log_level=logging.WARNING,
+                     net_options=net_options, threaded=not options.inline,
+                     log_levels={'network': logging.WARNING, 'identhost': logging.WARNING})
+    #anyone not in the auth db gets level 100, enough for ordinary commands
+    bot.auth.add_user('admin!admin@fake', 0)
+    bot.auth.bootstrapped = True
+    for channel in server.channel_names:
+        bot.join(channel)
+    bot.run_event_in(options.duration, bot.close)
+    start = time.time()
+    bot.loop()
+    return time.time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake irc server for load testing')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--chatter-rate', type=float, default=0, help='channel messages a second')
+    parser.add_argument('--churn-rate', type=float, default=0, help='joins/parts/quits a second')
+    parser.add_argument('--command', default=u'!syntax', help='command the simulated users send')
+    parser.add_argument('--command-rate', type=float, default=0, help='commands a second')
+    parser.add_argument('--flood-burst', type=int, default=10)
+    parser.add_argument('--flood-rate', type=float, default=2.0)
+    parser.add_argument('--no-flood', action='store_true', help='no flood kill (and no bot flood control with --bot)')
+    parser.add_argument('--certfile', help='serve TLS with this certificate')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--bot', action='store_true', help='run a bot against the server and report')
+    parser.add_argument('--inline', action='store_true', help='run the bot with threaded=False')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run the bot for')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeIRCd(port=options.port, channels=options.channels, users=options.users,
+                      chatter_rate=options.chatter_rate, churn_rate=options.churn_rate,
+                      command=options.command.decode('utf-8'), command_rate=options.command_rate,
+                      flood_burst=None if options.no_flood else options.flood_burst,
+                      flood_rate=options.flood_rate, certfile=options.certfile, keyfile=options.keyfile)
+    if options.bot:
+        server.start()
+        elapsed = run_bot(server, options)
+        server.stop()
+    else:
+        start = time.time()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.time() - start
+
+    stats = server.stats()
+    print('{0:.1f}s, {1} lines from clients, {2} lines to clients ({3:.0f}/sec)'.format(
+            elapsed, stats['lines_in'], stats['lines_out'], stats['lines_out'] / max(elapsed, 1e-9)))
+    print('{0} commands sent, {1} answered, flood kills {2}'.format(
+            stats['commands_sent'], stats['replies'], stats['flood_kills']))
+    if stats['replies']:
+        print('command latency p50 {0:.1f}ms p95 {1:.1f}ms max {2:.1f}ms'.format(
+                stats['latency_p50'] * 1000, stats['latency_p95'] * 1000, stats['latency_max'] * 1000))
@@ -0,0 +1,132 @@
+import time
+from collections import deque
+
+class FloodControl(object):
+    '''
+    Paces outbound lines with a token bucket so we stay under the server's
+    flood limits instead of getting killed for Excess Flood
+
+    The bucket holds up to burst tokens and refills at rate tokens a second,
+    each line costs one token. If penalty_bytes is set long lines cost more,
+    an extra token for every penalty_bytes bytes, like the ircd penalty system
+
+    Lines that can't go yet wait (in order) until release hands them back,
+    urgent lines (PONG etc) are charged but never wait
+    '''
+
+    def __init__(self, burst=5, rate=1.0, penalty_bytes=None):
+        self.burst = burst
+        self.rate = rate
+        self.penalty_bytes = penalty_bytes
+        self.tokens = burst
+        self.last_refill = time.time()
+        #(data, time queued, held back) for lines waiting their turn
+        self.waiting = deque()
+        self.waiting_bytes = 0
+        self.waiting_cost = 0
+
+        #counters
+        self.lines_sent = 0
+        self.lines_delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def cost(self, data):
+        '''
+        How many tokens sending data costs
+        '''
+        if self.penalty_bytes:
+            return 1 + len(data) // self.penalty_bytes
+        return 1
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reset(self):
+        '''
+        Fresh connection, full bucket and nothing waiting
+        '''
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.waiting.clear()
+        self.waiting_bytes = 0
+        self.waiting_cost = 0
+
+    def charge(self, data):
+        '''
+        Take the tokens for a line that is being sent straight away regardless,
+        the bucket can go negative which holds back the lines after it
+        '''
+        self.refill(time.time())
+        self.tokens -= self.cost(data)
+        self.lines_sent += 1
+
+    def queue(self, data):
+        '''
+        Add a line to wait its turn, it counts as delayed if the tokens we
+        have now won't cover it and everything ahead of it
+        '''
+        now = time.time()
+        self.refill(now)
+        cost = self.cost(data)
+        held_back = self.tokens - self.waiting_cost < min(cost, self.burst)
+        self.waiting.append((data, now, held_back))
+        self.waiting_bytes += len(data)
+        self.waiting_cost += cost
+
+    def release(self):
+        '''
+        Returns the list of waiting lines that can be sent now, oldest first
+        '''
+        if not self.waiting:
+            return []
+
+        now = time.time()
+        self.refill(now)
+        released = []
+        while self.waiting:
+            data, queued, held_back = self.waiting[0]
+            cost = self.cost(data)
+            #a line costing more than the burst still goes once the bucket is full
+            if self.tokens < min(cost, self.burst):
+                break
+
+            self.waiting.popleft()
+            self.waiting_bytes -= len(data)
+            self.waiting_cost -= cost
+            self.tokens -= cost
+            self.lines_sent += 1
+            waited = now - queued
+            if held_back:
+                self.lines_delayed += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            released.append(data)
+
+        return released
+
+    def next_release(self):
+        '''
+        Seconds until the next waiting line can go, or None if nothing is waiting
+        '''
+        if not self.waiting:
+            return None
+
+        self.refill(time.time())
+        needed = min(self.cost(self.waiting[0][0]), self.burst) - self.tokens
+        return max(needed / float(self.rate), 0)
+
+    def stats(self):
+        '''
+        Counters for how much pacing has been going on
+        '''
+        return {
+                'lines_sent': self.lines_sent,
+                'lines_delayed': self.lines_delayed,
+                'lines_waiting': len(self.waiting),
+                'bytes_waiting': self.waiting_bytes,
+                'total_wait': self.total_wait,
+                'average_wait': self.total_wait / self.lines_delayed if self.lines_delayed else 0.0,
+                'max_wait': self.max_wait,
+                }
@@ -22,6 +22,8 @@ class IdentHost:
                         eu.event(nu.RPL_WHOREPLY, self.users_who),
                         eu.event(nu.BOT_QUIT, self.user_quit),
                         eu.event(nu.BOT_NICK, self.user_changed_nick),
+                        eu.event(nu.RPL_NAMREPLY, self.users_names),
+                        eu.event(nu.BOT_BATCH_GROUP, self.batch),
                         ]
         self.bot.add_module(module_name, self)
 
@@ -31,7 +33,7 @@ class IdentHost:
         return true if there are mappings already present for this nickhost
         otherwise false
         '''
-        self.log.debug(u'Checked if user {0} is in my identity map'.format(user))
+        self.log.debug(u'Checked if user %s is in my identity map', user)
         return self.hostmap[user] != ''
 
     def add_user(self, nick, user, channel):
@@ -41,9 +43,9 @@ class IdentHost:
         #store mapping between nick and user
         self.nickmap[nick] = user
         self.hostmap[user] = nick
-        self.log.debug(u'Adding user mapping {1}=>{0}'.format(user, nick, channel))
+        self.log.debug(u'Adding user mapping %s=>%s', nick, user)
         if not self.is_user_in_channel(user, channel):
-            self.log.debug(u'Adding user {0} to channel {1}'.format(user, channel))
+            self.log.debug(u'Adding user %s to channel %s', user, channel)
             self.channel2user[channel].append(user)
             self.user2channel[user].append(channel)
 
@@ -52,19 +54,21 @@ class IdentHost:
         Remove all channel and nick mappings
         for this user
         '''
-        #remove appropriate mappings
-        del self.nickmap[nick]
-        del self.hostmap[user]
-        self.log.debug('Removing user mapping {1}=>{0}'.format(user, nick))
-        for channel in self.user2channel[user]:
-            self.log.debug(u'Removing {0} from channel {1}'.format(user, channel))
+        #remove appropriate mappings, a user we never saw has none
+        nick = self.hostmap.pop(user, '')
+        if not nick:
+            self.log.debug(u'No mappings to remove for %s', user)
+            return
+
+        self.nickmap.pop(nick, None)
+        self.log.debug('Removing user mapping %s=>%s', nick, user)
+        for channel in self.user2channel.pop(user, []):
+            self.log.debug(u'Removing %s from channel %s', user, channel)
             self.channel2user[channel].remove(user)
-        
-        del self.user2channel[user]
 
     def change_user_nick(self, user, newnick):
         oldnick = self.nick_of_user(user)
-        self.log.debug(u'Changing {0}=>{1} to {2}=>{1}'.format(oldnick, user, newnick))
+        self.log.debug(u'Changing %s=>%s to %s=>%s', oldnick, user, newnick, user)
         self.hostmap[user] = newnick
         del self.nickmap[oldnick]
         self.nickmap[newnick] = user
@@ -73,7 +77,7 @@ class IdentHost:
         '''
         Unmap user from this channel
         '''
-        self.log.debug('Removing {0} from {1}'.format(user, channel))
+        self.log.debug('Removing %s from %s', user, channel)
         self.channel2user[channel].remove(user)
         self.user2channel[user].remove(channel)
 
@@ -82,7 +86,7 @@ class IdentHost:
         Map user to this channel
         '''
         if not self.is_user_in_channel(user, channel):
-            self.log.debug(u'Adding user {0} to {1}'.format(user, channel))
+            self.log.debug(u'Adding user %s to %s', user, channel)
             self.channel2user[channel].append(user)
             self.user2channel[user].append(channel)
 
@@ -120,14 +124,14 @@ class IdentHost:
         '''
         Add channel to list of channels bot is in
         '''
-        self.log.debug(u'Adding {0} to list of channels im in'.format(channel))
+        self.log.debug(u'Adding %s to list of channels im in', channel)
         self.channels.append(channel)
 
     def remove_channel(self, channel):
         '''
         Remove channel from list of channels bot is in
         '''
-        self.log.debug(u'Removing {0} from list of channels im in'.format(channel))
+        self.log.debug(u'Removing %s from list of channels im in', channel)
         self.channels.remove[channel]
 
     def nick_of_user(self, user):
@@ -150,8 +154,9 @@ class IdentHost:
         User changed their nick, update the mapping
         '''
         nick, nickhost = prefix.split('!')
-        newnick = postfix
-        self.log.debug(u'User {0} changed nick to {1}'.format(nickhost, newnick))
+        #servers send both NICK :newnick and NICK newnick
+        newnick = postfix or params[0]
+        self.log.debug(u'User %s changed nick to %s', nickhost, newnick)
         self.change_user_nick(nickhost, newnick)
         
     def user_join(self, command, prefix, params, postfix):
@@ -159,8 +164,8 @@ class IdentHost:
         A new user has joined a channel, store their hostname - nick mapping in the appropriate location
         '''
         nick, nickhost = prefix.split('!')
-        channel = postfix
-        self.log.debug(u'User {0} joined channel {1} with nick {2}'.format(nickhost, channel, nick))
+        channel = postfix or params[0]
+        self.log.debug(u'User %s joined channel %s with nick %s', nickhost, channel, nick)
         if self.is_user(nickhost):
             self.add_user_to_channel(nickhost, channel)
         else:
@@ -171,7 +176,7 @@ class IdentHost:
         User quit server, remove all mappings
         '''
         nick, nickhost = prefix.split('!')
-        self.log.debug(u'User {0} quit, deleted all mappings'.format(nickhost))
+        self.log.debug(u'User %s quit, deleted all mappings', nickhost)
         self.delete_user(nickhost)
 
     def user_part(self, command, prefix, params, postfix):
@@ -180,12 +185,12 @@ class IdentHost:
         '''
         nick, nickhost = prefix.split('!')
         channel = params[0]
-        self.log.debug(u'User {0} left channel {1}'.format(nickhost, channel))
+        self.log.debug(u'User %s left channel %s', nickhost, channel)
 
         if self.is_user_in_channel(nickhost, channel):
             self.remove_user_from_channel(nickhost, channel)
         else:
-            self.log.warning(u'User {0} left channel {1} but was not mapped'.format(nickhost, channel))
+            self.log.warning(u'User %s left channel %s but was not mapped', nickhost, channel)
 
     def user_msg(self, command, prefix, params, postfix):
         '''
@@ -198,29 +203,30 @@ class IdentHost:
             pass
         else:
             self.add_user(nick, nickhost, channel)
-            self.log.warning(u'User {0} talked in channel {1} as {2} but was not mapped'.format(nickhost, channel, nick))
+            self.log.warning(u'User %s talked in channel %s as %s but was not mapped', nickhost, channel, nick)
 
     def part_channel(self, channel):
         '''
         we just left this channel, nuke the mappings
         '''
         if self.in_channel(channel):
-            self.log.debug(u'Parting channel {0}'.format(channel))
+            self.log.debug(u'Parting channel %s', channel)
             self.remove_channel(channel)
             for user in self.channel2user:
                 self.remove_user_from_channel(user, channel)
             del (self.channel2user[channel])
         else:
-            self.log.warning(u'Just left channel {0} but was never marked as in it'.format(channel))
+            self.log.warning(u'Just left channel %s but was never marked as in it', channel)
 
     def join_channel(self, channel):
         '''
         We just joined a channel, deal with the list of users we are getting
         '''
-        self.log.debug(u'Joined channel {0}'.format(channel))
+        self.log.debug(u'Joined channel %s', channel)
         self.add_channel(channel)
-        self.irc.who(channel)
-        pass
+        #with userhost-in-names the NAMES reply to our JOIN has everything
+        if not self.bot.has_cap('userhost-in-names'):
+            self.irc.who(channel)
 
     def users_who(self, command, prefix, params, postfix):
         '''
@@ -231,8 +237,42 @@ class IdentHost:
         nick = params[5]
         channel = params[1]
         nickhost = '{0}@{1}'.format(params[2], params[3])
-        self.log.debug(u'Who response from {0}=>{1}'.format(nick, nickhost))
+        self.log.debug(u'Who response from %s=>%s', nick, nickhost)
         if not self.is_user(nickhost):
             self.add_user(nick, nickhost, channel)
         else:
             self.add_user_to_channel(nickhost, channel)
+
+    def users_names(self, command, prefix, params, postfix):
+        '''
+        Deal with a NAMES reply, with userhost-in-names each entry is a full
+        nick!user@host (multi-prefix means there may be several mode symbols
+        in front of it). Plain nicks are left to the WHO reply
+        '''
+        channel = params[-1]
+        modes, symbols = self.bot.isupport.prefix()
+        for entry in (postfix or u'').split():
+            entry = entry.lstrip(symbols)
+            if '!' not in entry:
+                continue
+
+            nick, nickhost = entry.split('!', 1)
+            if not self.is_user(nickhost):
+                self.add_user(nick, nickhost, channel)
+            else:
+                self.add_user_to_channel(nickhost, channel)
+
+    def batch(self, batch_type, params, messages):
+        '''
+        A server BATCH (i.e a netsplit full of QUITs), update the mappings
+        for everything inside it
+        '''
+        self.log.debug(u'Batch %s of %s messages', batch_type, len(messages))
+        for message in messages:
+            #one bad message mustn't cost us the rest of the batch
+            try:
+                for event in self.events:
+                    event(message)
+
+            except Exception:
+                self.log.exception(u'Error handling {0} in batch {1}'.format(message.type, batch_type))
\ No newline at end of file
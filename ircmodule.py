@@ -152,6 +152,37 @@ class IRC_Wrapper:
         '''
         self.bot.out_event(eu.pong(msg, priority))
     
+    def ping(self, token, priority=1):
+        '''
+        Send a PING to the server, it answers with a PONG carrying the token
+        args:
+            token = the ping key
+        kwargs:
+            priority = how quickly to process the event
+        '''
+        self.bot.out_event(eu.ping(token, priority))
+
+    def disconnect(self, reason, priority=1):
+        '''
+        Drop the connection to the server, the bot core then reconnects
+        the same way as if the connection had been lost
+        args:
+            reason = why, sent as the QUIT message
+        kwargs:
+            priority = how quickly to process the event
+        '''
+        self.bot.out_event(eu.disconnect(reason, priority))
+
+    def profile(self, path, priority=1):
+        '''
+        Start profiling the network thread, or stop and write the profile
+        args:
+            path = where to write the profile when it stops, None stops it
+        kwargs:
+            priority = how quickly to process the event
+        '''
+        self.bot.out_event(eu.profile(path, priority))
+
     def error(self, msg, priority=1):
         '''
         Used to handle disconnection Events from the network
@@ -174,4 +205,13 @@ class IRC_Wrapper:
         '''
         Send the IRC WHO command with given parameter
         '''
-        self.bot.out_event(eu.who(param, priority))
\ No newline at end of file
+        self.bot.out_event(eu.who(param, priority))
+
+    def request_cap(self, caps, priority=1):
+        '''
+        Ask the server for IRCv3 capabilities, see bot.has_cap to check
+        if they were enabled
+        args:
+            caps = list of capability names
+        '''
+        self.bot.out_event(eu.cap_req(caps, priority))
\ No newline at end of file
@@ -0,0 +1,86 @@
+'''
+Hand written irc line parser, used by Network for every line the server
+sends so it avoids regexes and only does the minimum of splitting
+
+Understands IRCv3 message tags, the source prefix, middle params and
+the trailing param, i.e
+
+@time=2014-01-01T00:00:00.000Z :nick!user@host PRIVMSG #bots :hey all
+'''
+
+#escaped characters in IRCv3 tag values
+tag_escapes = {
+        ':': ';',
+        's': ' ',
+        'r': '\r',
+        'n': '\n',
+        '\\': '\\',
+        }
+
+def unescape_tag_value(value):
+    '''
+    Undo the IRCv3 escaping of a tag value, unknown escapes lose the backslash
+    and a trailing lone backslash is dropped
+    '''
+    if '\\' not in value:
+        return value
+
+    result = []
+    i = 0
+    length = len(value)
+    while i < length:
+        char = value[i]
+        if char == '\\':
+            i += 1
+            if i < length:
+                result.append(tag_escapes.get(value[i], value[i]))
+        else:
+            result.append(char)
+        i += 1
+
+    return u''.join(result)
+
+def parse_tags(raw):
+    '''
+    Turn the tag section of a line (without the leading @) into a dict,
+    tags with no value map to an empty string
+    '''
+    tags = {}
+    for tag in raw.split(';'):
+        if not tag:
+            continue
+        key, _, value = tag.partition('=')
+        tags[key] = unescape_tag_value(value)
+
+    return tags
+
+def parse(line):
+    '''
+    Split an irc line into (tags, prefix, command, params, postfix)
+
+    tags is a dict or None if the line had none, prefix is the source without
+    the leading : or None, params is a (possibly empty) list of the middle
+    params and postfix is the trailing param or None if there wasn't one.
+    An empty trailing param (PRIVMSG #bots :) gives a postfix of ''
+
+    Returns None if the line has no command
+    '''
+    tags = None
+    if line[:1] == '@':
+        raw_tags, _, line = line.partition(' ')
+        tags = parse_tags(raw_tags[1:])
+        line = line.lstrip(' ')
+
+    prefix = None
+    if line[:1] == ':':
+        prefix, _, line = line.partition(' ')
+        prefix = prefix[1:]
+
+    #middle params end at the first ' :', anything after is the trailing param
+    middle, has_trailing, postfix = line.partition(' :')
+    params = middle.split()
+    if not params:
+        return None
+
+    command = params.pop(0)
+    return tags, prefix, command, params, postfix if has_trailing else None
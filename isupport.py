@@ -0,0 +1,131 @@
+import re
+import sys
+
+class ISupport(object):
+    '''
+    The features a server advertises in RPL_ISUPPORT (005), i.e
+
+    :irc.example.net 005 bot CHANTYPES=# NICKLEN=30 TARGMAX=PRIVMSG:4 :are supported by this server
+
+    Tokens the server hasn't sent fall back to the RFC 1459 behaviour.
+    Values are kept as the raw strings, with helpers for the ones the bot uses
+    '''
+    defaults = {
+            'CASEMAPPING': 'rfc1459',
+            'CHANTYPES': '#&',
+            'LINELEN': '512',
+            'NICKLEN': '9',
+            'USERLEN': '10',
+            'HOSTLEN': '63',
+            'PREFIX': '(ov)@+',
+            }
+
+    escape = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+    def __init__(self):
+        self.tokens = {}
+
+    def update(self, tokens):
+        '''
+        Store the tokens from one 005 line (without the leading nick or the
+        trailing text). -TOKEN removes a previously advertised token
+        '''
+        for token in tokens:
+            if token.startswith('-'):
+                self.tokens.pop(token[1:].upper(), None)
+                continue
+            key, _, value = token.partition('=')
+            self.tokens[key.upper()] = self.escape.sub(lambda m: unichr(int(m.group(1), 16)), value)
+
+    def clear(self):
+        '''
+        Forget everything, for a new connection
+        '''
+        self.tokens.clear()
+
+    def get(self, key, default=None):
+        '''
+        Raw value of a token, the RFC default or default if there is neither
+        '''
+        key = key.upper()
+        if key in self.tokens:
+            return self.tokens[key]
+        return self.defaults.get(key, default)
+
+    def __contains__(self, key):
+        return key.upper() in self.tokens
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def linelen(self):
+        return self.get_int('LINELEN', 512)
+
+    def nicklen(self):
+        return self.get_int('NICKLEN', 9)
+
+    def userlen(self):
+        return self.get_int('USERLEN', 10)
+
+    def hostlen(self):
+        return self.get_int('HOSTLEN', 63)
+
+    def chantypes(self):
+        return self.get('CHANTYPES')
+
+    def casemapping(self):
+        return self.get('CASEMAPPING')
+
+    def is_channel(self, name):
+        '''
+        True if name looks like a channel on this server
+        '''
+        return bool(name) and name[0] in self.chantypes()
+
+    def prefix(self):
+        '''
+        Returns (modes, symbols) for channel membership prefixes
+        i.e ('ov', '@+')
+        '''
+        value = self.get('PREFIX')
+        if not value.startswith('('):
+            return '', ''
+        modes, _, symbols = value[1:].partition(')')
+        return modes, symbols
+
+    def targmax(self, command):
+        '''
+        Most targets command may be sent to at once, from TARGMAX or the
+        older MAXTARGETS, sys.maxint if the server says there is no limit
+        and 1 if it hasn't told us
+        '''
+        command = command.upper()
+        if 'TARGMAX' in self.tokens:
+            for limit in self.tokens['TARGMAX'].split(','):
+                limit_command, _, number = limit.partition(':')
+                if limit_command.upper() == command:
+                    return int(number) if number else sys.maxint
+            return 1
+
+        if 'MAXTARGETS' in self.tokens:
+            value = self.tokens['MAXTARGETS']
+            return int(value) if value else sys.maxint
+
+        return 1
+
+    def lower(self, name):
+        '''
+        Lowercase a nick or channel using the server's casemapping, so
+        names can be compared the way the server compares them
+        '''
+        name = name.lower()
+        casemapping = self.casemapping()
+        if casemapping == 'rfc1459':
+            return name.replace('[', '{').replace(']', '}').replace('\\', '|').replace('~', '^')
+        if casemapping == 'strict-rfc1459':
+            return name.replace('[', '{').replace(']', '}').replace('\\', '|')
+        return name
@@ -0,0 +1,173 @@
+import time
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+import event_util as eu
+import numerics as nu
+
+class LagMonitor:
+    '''
+    Measures how far behind the server we are by sending our own PINGs every
+    interval seconds and timing the PONG that comes back
+
+    Lag is the time from the PING leaving the socket to the PONG arriving on
+    it, how long the PONG then waited for the bot to get to it is kept
+    separately (dispatch delay) so a slow network and a slow bot can be told apart
+
+    If the lag stays over max_lag for sustained pings in a row (an unanswered
+    PING counts once it is older than max_lag) the connection is dropped so
+    the bot reconnects
+    '''
+
+    def __init__(self, bot, module_name='lag', log_level=logging.INFO, interval=30,
+                 max_lag=30, sustained=3, samples=100):
+        self.bot = bot
+        self.log = logging.getLogger('{0}.{1}'.format(bot.log_name, module_name))
+        self.log.setLevel(log_level)
+        self.irc = bot.irc
+        self.module_name = module_name
+        self.interval = interval
+        self.max_lag = max_lag
+        self.sustained = sustained
+
+        #most recent measurements in seconds, oldest first
+        self.lags = deque(maxlen=samples)
+        self.delays = deque(maxlen=samples)
+        #token and send time of the PING we are waiting on
+        self.outstanding = None
+        self.sent_at = None
+        #pings in a row that were over max_lag
+        self.strikes = 0
+        self.reconnects = 0
+
+        self.commands = [
+                        self.bot.command(r'!lag$', self.lag_command, auth_level=20),
+                        ]
+        self.events = [
+                      eu.event(nu.BOT_PONG, self.pong),
+                      eu.event(nu.RPL_WELCOME, self.reset),
+                      eu.event(nu.BOT_ERR, self.reset),
+                      ]
+        self.bot.add_timed_event(datetime.now(), datetime.max, timedelta(seconds=interval), self.send_ping)
+        self.bot.add_module(module_name, self)
+
+    def send_ping(self):
+        '''
+        Timed event, PING the server unless we are still waiting on the last one
+        '''
+        if not self.bot.registered:
+            return
+
+        if self.outstanding:
+            waited = time.time() - self.sent_at
+            if waited > self.max_lag:
+                self.log.warning(u'No PONG after {0:.1f} seconds'.format(waited))
+                self.strike()
+            return
+
+        self.sent_at = time.time()
+        self.outstanding = u'lag{0:.6f}'.format(self.sent_at)
+        self.irc.ping(self.outstanding)
+
+    def pong(self, command, prefix, params, postfix):
+        token = postfix or (params[-1] if params else None)
+        if not token or token != self.outstanding:
+            return
+
+        now = time.time()
+        #the network noted when it really went out and came back, failing that
+        #(it was cleared by a reconnect) go by when we asked for it
+        sent, received = self.bot.net.pongs.pop(token, (self.sent_at, now))
+        self.outstanding = None
+        lag = received - sent
+        self.lags.append(lag)
+        self.delays.append(now - received)
+        self.log.debug(u'Lag {0:.3f}s, dispatch delay {1:.3f}s'.format(lag, now - received))
+
+        if lag > self.max_lag:
+            self.strike()
+        else:
+            self.strikes = 0
+
+    def strike(self):
+        '''
+        Another ping over max_lag, reconnect once there have been enough in a row
+        '''
+        self.strikes += 1
+        if self.strikes < self.sustained:
+            return
+
+        self.log.error(u'Lag over {0} seconds for {1} pings, reconnecting'.format(self.max_lag, self.strikes))
+        self.reconnects += 1
+        self.irc.disconnect(u'Lagged out')
+        self.reset()
+
+    def reset(self, *args):
+        '''
+        New connection (or lost the old one), stop waiting on old PINGs
+        '''
+        if self.outstanding:
+            self.bot.net.pongs.pop(self.outstanding, None)
+        self.outstanding = None
+        self.sent_at = None
+        self.strikes = 0
+
+    def current(self):
+        '''
+        Latest lag in seconds, or how long the PING we are waiting on has
+        been out if that is longer. None before the first measurement
+        '''
+        lag = self.lags[-1] if self.lags else None
+        if self.outstanding:
+            waited = time.time() - self.sent_at
+            if lag is None or waited > lag:
+                lag = waited
+        return lag
+
+    def minimum(self):
+        return min(self.lags) if self.lags else None
+
+    def maximum(self):
+        return max(self.lags) if self.lags else None
+
+    def percentile(self, percent, samples=None):
+        '''
+        The given percentile (0-100) of the recent lag samples, nearest rank
+        '''
+        samples = sorted(self.lags if samples is None else samples)
+        if not samples:
+            return None
+        rank = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[rank]
+
+    def stats(self):
+        return {
+                'current': self.current(),
+                'min': self.minimum(),
+                'max': self.maximum(),
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'samples': len(self.lags),
+                'dispatch_p50': self.percentile(50, self.delays),
+                'dispatch_max': max(self.delays) if self.delays else None,
+                'reconnects': self.reconnects,
+                }
+
+    def lag_command(self, nick, nickhost, action, targets, message, m):
+        stats = self.stats()
+        if not stats['samples']:
+            self.irc.msg_all(u'No lag measured yet', targets)
+            return
+
+        ms = lambda seconds: u'{0:.0f}ms'.format(seconds * 1000)
+        self.irc.msg_all(u'Lag {0} (min {1}, p50 {2}, p95 {3}, max {4} over {5} pings), '
+                         u'dispatch delay p50 {6} max {7}'.format(
+                             ms(stats['current']), ms(stats['min']), ms(stats['p50']),
+                             ms(stats['p95']), ms(stats['max']), stats['samples'],
+                             ms(stats['dispatch_p50']), ms(stats['dispatch_max'])), targets)
+
+    def syntax(self):
+        return  '''
+                Lag module supports
+                !lag
+                '''
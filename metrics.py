@@ -0,0 +1,261 @@
+import time
+import logging
+import threading
+import BaseHTTPServer
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+#histogram bucket upper bounds in seconds, 10us doubling up to ~10s
+buckets = [0.00001 * 2 ** i for i in range(21)]
+
+class Histogram:
+    '''
+    Counts of how long something took, in buckets, plus the count, total
+    and the longest. Percentiles are estimated from the buckets
+    '''
+
+    def __init__(self, bounds=buckets):
+        self.bounds = bounds
+        #one past the last bound for anything longer
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        '''
+        Estimate of the time percent% of observations came in under,
+        interpolated within the bucket it lands in
+        '''
+        if not self.count:
+            return 0.0
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(estimate, self.max)
+            seen += count
+        return self.max
+
+def escape(value):
+    '''
+    Escape a prometheus label value
+    '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    '''
+    Times every command, event and timed event handler the bot runs, per
+    module and handler, and keeps the line rates and queue depths
+
+    !metrics gives the handlers that took the most time in total (or all of
+    one module's), with port set the same is served in prometheus text
+    format from http://host:port/metrics. It only listens on localhost
+    unless told otherwise
+    '''
+
+    def __init__(self, bot, module_name='metrics', log_level=logging.INFO, port=None,
+                 host='127.0.0.1', interval=10, top=5):
+        self.bot = bot
+        self.log = logging.getLogger('{0}.{1}'.format(bot.log_name, module_name))
+        self.log.setLevel(log_level)
+        self.irc = bot.irc
+        self.module_name = module_name
+        self.top = top
+
+        #(kind, module, handler) => Histogram, workers add to it too
+        self.handlers = {}
+        self.lock = threading.Lock()
+        #lines a second over the last interval
+        self.interval = interval
+        self.last_sample = (time.time(), 0, 0)
+        self.rates = (0.0, 0.0)
+
+        self.server = None
+        if port is not None:
+            self.serve(host, port)
+
+        self.commands = [
+                        self.bot.command(r'!metrics ?(?P<module>\S+)?$', self.metrics_command, auth_level=20),
+                        ]
+        self.events = []
+        self.bot.add_timed_event(datetime.now(), datetime.max, timedelta(seconds=interval), self.sample_rates)
+        self.bot.add_module(module_name, self)
+
+    def observe(self, kind, module, handler, seconds):
+        '''
+        Record that a handler took seconds, module None is the bot core
+        '''
+        key = (kind, module or self.bot.module_name, handler)
+        with self.lock:
+            histogram = self.handlers.get(key)
+            if histogram is None:
+                histogram = self.handlers[key] = Histogram()
+            histogram.observe(seconds)
+
+    def sample_rates(self):
+        '''
+        Timed event, work out the line rates since the last time
+        '''
+        net = self.bot.net
+        now = time.time()
+        then, lines_in, lines_out = self.last_sample
+        elapsed = now - then
+        if elapsed > 0:
+            self.rates = ((net.lines_in - lines_in) / elapsed, (net.lines_out - lines_out) / elapsed)
+        self.last_sample = (now, net.lines_in, net.lines_out)
+
+    def queues(self):
+        '''
+        How much is waiting right now, queue name => depth
+        '''
+        return {
+               'in': self.bot.inq.qsize(),
+               'out': self.bot.outq.qsize(),
+               'workers': self.bot.workers.jobs.qsize(),
+               }
+
+    def snapshot(self):
+        '''
+        A copy of the histograms, so they can be read without the lock
+        '''
+        with self.lock:
+            copies = {}
+            for key, histogram in self.handlers.items():
+                copy = Histogram(histogram.bounds)
+                copy.counts = list(histogram.counts)
+                copy.count = histogram.count
+                copy.total = histogram.total
+                copy.max = histogram.max
+                copies[key] = copy
+        return copies
+
+    def summary(self, module=None):
+        '''
+        Lines describing the handlers that took the most time in total, or
+        all of module's
+        '''
+        handlers = self.snapshot().items()
+        if module:
+            handlers = [(key, histogram) for key, histogram in handlers if key[1] == module]
+        handlers.sort(key=lambda (key, histogram): histogram.total, reverse=True)
+        if not module:
+            handlers = handlers[:self.top]
+
+        ms = lambda seconds: u'{0:.2f}ms'.format(seconds * 1000)
+        lines = []
+        for (kind, module_name, handler), histogram in handlers:
+            lines.append(u'{0}.{1} ({2}): {3} calls, p50 {4} p95 {5} p99 {6} max {7}, {8:.2f}s total'.format(
+                    module_name, handler, kind, histogram.count, ms(histogram.percentile(50)),
+                    ms(histogram.percentile(95)), ms(histogram.percentile(99)), ms(histogram.max),
+                    histogram.total))
+        return lines
+
+    def prometheus(self):
+        '''
+        Everything in the prometheus text format
+        '''
+        net = self.bot.net
+        out = []
+        out.append('# HELP simplepybot_handler_seconds Time spent in each handler')
+        out.append('# TYPE simplepybot_handler_seconds histogram')
+        handlers = sorted(self.snapshot().items())
+        for (kind, module, handler), histogram in handlers:
+            labels = u'kind="{0}",module="{1}",handler="{2}"'.format(escape(kind), escape(module), escape(handler))
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                out.append(u'simplepybot_handler_seconds_bucket{{{0},le="{1:g}"}} {2}'.format(labels, bound, cumulative))
+            out.append(u'simplepybot_handler_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, histogram.count))
+            out.append(u'simplepybot_handler_seconds_sum{{{0}}} {1!r}'.format(labels, histogram.total))
+            out.append(u'simplepybot_handler_seconds_count{{{0}}} {1}'.format(labels, histogram.count))
+
+        out.append('# HELP simplepybot_handler_max_seconds Longest time spent in each handler')
+        out.append('# TYPE simplepybot_handler_max_seconds gauge')
+        for (kind, module, handler), histogram in handlers:
+            out.append(u'simplepybot_handler_max_seconds{{kind="{0}",module="{1}",handler="{2}"}} {3!r}'.format(
+                    escape(kind), escape(module), escape(handler), histogram.max))
+
+        out.append('# HELP simplepybot_lines_total Lines received from and sent to the server')
+        out.append('# TYPE simplepybot_lines_total counter')
+        out.append('simplepybot_lines_total{{direction="in"}} {0}'.format(net.lines_in))
+        out.append('simplepybot_lines_total{{direction="out"}} {0}'.format(net.lines_out))
+        out.append('# HELP simplepybot_queue_depth Events waiting on each queue')
+        out.append('# TYPE simplepybot_queue_depth gauge')
+        for name, depth in sorted(self.queues().items()):
+            out.append('simplepybot_queue_depth{{queue="{0}"}} {1}'.format(name, depth))
+        out.append('# HELP simplepybot_queue_shed_total Events shed from a full queue, by how')
+        out.append('# TYPE simplepybot_queue_shed_total counter')
+        for name, queue in (('in', self.bot.inq), ('out', self.bot.outq)):
+            for how, count in sorted(queue.stats().items()):
+                out.append('simplepybot_queue_shed_total{{queue="{0}",how="{1}"}} {2}'.format(name, how, count))
+        out.append('# HELP simplepybot_bytes_pending Bytes waiting to be written to the server')
+        out.append('# TYPE simplepybot_bytes_pending gauge')
+        out.append('simplepybot_bytes_pending {0}'.format(net.bytes_pending()))
+        return u'\n'.join(out) + u'\n'
+
+    def serve(self, host, port):
+        '''
+        Serve prometheus() over http on its own thread
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics.log.debug(format, *args)
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        self.log.info('Serving metrics on http://%s:%s/metrics', *self.server.server_address)
+
+    def metrics_command(self, nick, nickhost, action, targets, message, m):
+        module = m.group('module')
+        lines = self.summary(module)
+        if not lines:
+            lines = [u'Nothing timed for {0} yet'.format(module) if module else u'Nothing timed yet']
+
+        if not module:
+            rate_in, rate_out = self.rates
+            queues = self.queues()
+            shed_in = sum(self.bot.inq.stats().values())
+            shed_out = sum(self.bot.outq.stats().values())
+            lines.append(u'{0:.1f} lines/s in, {1:.1f} lines/s out, queued in {2} out {3} workers {4}, '
+                         u'shed in {5} out {6}'.format(rate_in, rate_out, queues['in'], queues['out'],
+                                                     queues['workers'], shed_in, shed_out))
+        self.irc.msgs_all(lines, targets)
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def syntax(self):
+        return  '''
+                Metrics module supports
+                !metrics [module]
+                '''
@@ -0,0 +1,295 @@
+'''
+Queues for the events passed between the bot core and the network
+'''
+import os
+import fcntl
+import errno
+import Queue
+import threading
+from bisect import insort
+from collections import Counter, deque
+import numerics as nu
+
+#inbound events that are never shed, keeping the connection alive and
+#getting registered matter more than any amount of channel traffic
+inbound_control = frozenset([nu.BOT_PING, nu.BOT_PONG, nu.BOT_ERR, nu.BOT_KILL, nu.BOT_CAP,
+                             nu.RPL_WELCOME, nu.RPL_ENDOFMOTD, nu.ERR_NOMOTD])
+#outbound events that are never shed
+outbound_control = frozenset([nu.BOT_CONN, nu.BOT_KILL, nu.BOT_DISCONNECT, nu.BOT_PING, nu.BOT_PONG,
+                              nu.BOT_QUIT, nu.BOT_USER, nu.BOT_NICK, nu.BOT_CAP_REQ, nu.BOT_PROFILE])
+
+class LaneQueue(Queue.Queue):
+    '''
+    A priority queue of event_util.Messages, lowest priority number first,
+    that keeps a FIFO lane for each priority. Messages of the same priority
+    come out in the order they went in (a heap doesn't promise that, so the
+    lines of a multi line reply could go out of order) and put and get are
+    O(1) for the handful of priorities in use
+
+    Works as a drop in for Queue.PriorityQueue, with the same locking. It
+    can also be waited on with select, see wakeup_fd
+    '''
+
+    def _init(self, maxsize):
+        #priority => deque, lanes are kept once made
+        self.lanes = {}
+        #the priorities with a lane, in order
+        self.priorities = []
+        self.size = 0
+        #pipe written to when the queue stops being empty, see wakeup_fd
+        self.wake_r = None
+        self.wake_w = None
+
+    def wakeup_fd(self):
+        '''
+        A file descriptor select sees as readable once something is put on
+        the queue while it was empty, so the queue can be waited on without
+        Condition.wait (which polls on python 2). Call clear_wakeup and then
+        check the queue before waiting on it
+        '''
+        if self.wake_r is None:
+            wake_r, wake_w = os.pipe()
+            for fd in (wake_r, wake_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            with self.mutex:
+                self.wake_r, self.wake_w = wake_r, wake_w
+                if self.size:
+                    self.wakeup()
+        return self.wake_r
+
+    def wakeup(self):
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError as e:
+            #a full pipe means a wakeup is already pending
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close_wakeup(self):
+        '''
+        Close the wakeup pipe, if there is one, once nobody waits on the queue
+        '''
+        with self.mutex:
+            if self.wake_r is not None:
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.wake_r = self.wake_w = None
+
+    def clear_wakeup(self):
+        '''
+        Empty the wakeup pipe so select blocks again
+        '''
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def head_priority(self):
+        '''
+        The priority of the message get would return next, None if empty
+        '''
+        with self.mutex:
+            for priority in self.priorities:
+                if self.lanes[priority]:
+                    return priority
+        return None
+
+    def take(self, types):
+        '''
+        Remove and return the queued messages of the given types, leaving
+        everything else where it was. O(n), for when the queue can't be
+        read in order
+        '''
+        taken = []
+        with self.mutex:
+            for priority in self.priorities:
+                lane = self.lanes[priority]
+                if not any(item.type in types for item in lane):
+                    continue
+
+                kept = deque()
+                for item in lane:
+                    (taken if item.type in types else kept).append(item)
+                self.lanes[priority] = kept
+
+            self.size -= len(taken)
+            for item in taken:
+                self._removed(item)
+        return taken
+
+    def _removed(self, item):
+        '''
+        Called with the mutex held for a message taken out other than by get
+        '''
+        pass
+
+    def _qsize(self, len=len):
+        return self.size
+
+    def _put(self, item):
+        lane = self.lanes.get(item.priority)
+        if lane is None:
+            lane = self.lanes[item.priority] = deque()
+            insort(self.priorities, item.priority)
+        lane.append(item)
+        self.size += 1
+        if self.size == 1 and self.wake_w is not None:
+            self.wakeup()
+
+    def _get(self):
+        for priority in self.priorities:
+            lane = self.lanes[priority]
+            if lane:
+                self.size -= 1
+                return lane.popleft()
+        raise IndexError('get from an empty LaneQueue')
+
+class SheddingQueue(LaneQueue):
+    '''
+    A LaneQueue that holds at most capacity messages (0 is no limit) and
+    never blocks on put. Once it is full a new message is shed instead of
+    waiting for room:
+
+    - if the same message is already queued it is collapsed into that one
+    - otherwise the oldest queued message of the worst priority number is
+      dropped to make room, if that is worse than the new one, if not the
+      new one is dropped
+
+    Both are O(1), queued messages are indexed by type and data for the
+    first and the second takes the head of a lane
+
+    Messages at protected_priority or better, and those of a control type,
+    are never dropped and are let in even when the queue is full
+    '''
+
+    def __init__(self, capacity=0, control=frozenset(), protected_priority=1):
+        #the base class is unbounded, the limit is enforced in put
+        LaneQueue.__init__(self)
+        self.capacity = capacity
+        self.control = control
+        self.protected_priority = protected_priority
+        self.stats_lock = threading.Lock()
+        #event type => count, for each way a message can be shed
+        self.shed = {'dropped': Counter(), 'collapsed': Counter(), 'evicted': Counter()}
+        #collapse_key => how many of those are queued, kept when there is a capacity
+        self.index = {}
+
+    def put(self, item, block=True, timeout=None):
+        '''
+        Add item unless it gets shed, block and timeout are ignored as this
+        never waits. Returns True if item was queued
+        '''
+        with self.mutex:
+            if self.capacity and self._qsize() >= self.capacity and not self.protected(item):
+                if not self.make_room(item):
+                    return False
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        return True
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def _put(self, item):
+        LaneQueue._put(self, item)
+        if self.capacity:
+            key = self.collapse_key(item)
+            if key is not None:
+                self.index[key] = self.index.get(key, 0) + 1
+
+    def _get(self):
+        item = LaneQueue._get(self)
+        if self.capacity:
+            self.forget(item)
+        return item
+
+    def _removed(self, item):
+        if self.capacity:
+            self.forget(item)
+
+    def forget(self, item):
+        '''
+        Take a message that is leaving the queue out of the index
+        '''
+        key = self.collapse_key(item)
+        if key is None:
+            return
+        count = self.index.pop(key) - 1
+        if count:
+            self.index[key] = count
+
+    def collapse_key(self, item):
+        '''
+        Hashable (type, data) of a message, None if it can't be had
+        '''
+        try:
+            key = (item.type, tuple(tuple(part) if isinstance(part, list) else part for part in item.data))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def protected(self, item):
+        return item.priority <= self.protected_priority or item.type in self.control
+
+    def make_room(self, item):
+        '''
+        Called with the mutex held when the queue is full, returns True if
+        item should still go in
+        '''
+        key = self.collapse_key(item)
+        if key is not None and key in self.index:
+            self.count('collapsed', item)
+            return False
+
+        evicted = self.evict(item.priority)
+        if evicted is None:
+            self.count('dropped', item)
+            return False
+
+        self.count('evicted', evicted)
+        #our qsize went down by one without a get, so a task went away too
+        self.unfinished_tasks -= 1
+        return True
+
+    def evict(self, priority):
+        '''
+        Take out the oldest unprotected message with the worst priority
+        number worse than priority, returns it or None if there isn't one
+        '''
+        for worse in reversed(self.priorities):
+            if worse <= priority:
+                break
+            lane = self.lanes[worse]
+            #protected messages are rare, so this is nearly always the head
+            for i, queued in enumerate(lane):
+                if not self.protected(queued):
+                    del lane[i]
+                    self.size -= 1
+                    self._removed(queued)
+                    return queued
+        return None
+
+    def count(self, how, item):
+        with self.stats_lock:
+            self.shed[how][item.type] += 1
+
+    def stats(self):
+        '''
+        How many messages were shed each way, how => total
+        '''
+        with self.stats_lock:
+            return dict((how, sum(counts.values())) for how, counts in self.shed.items())
+
+    def shed_types(self, how):
+        '''
+        Event type => how many of them were shed that way, how being
+        dropped, collapsed or evicted
+        '''
+        with self.stats_lock:
+            return dict(self.shed[how])
@@ -1,13 +1,129 @@
-import re
+import os
+import fcntl
 import socket
+import ssl
+import cProfile
 import errno
 import select
 import logging
+import threading
 import Queue as q
 import event_util as eu
+import ircparse
+import capture
+from floodcontrol import FloodControl
+from isupport import ISupport
 import time
 import numerics as nu
 
+#inbound commands the bot core should get to before anything else queued
+urgent = frozenset([nu.BOT_PING, nu.BOT_ERR])
+#outbound events that can't wait for the TLS handshake to finish
+handshake_events = frozenset([nu.BOT_KILL, nu.BOT_DISCONNECT, nu.BOT_PROFILE])
+#messages whose text is the last parameter, with or without the colon
+texts = frozenset([nu.BOT_PRIVMSG, 'NOTICE'])
+
+def split_text(text, max_bytes, encoding='utf-8'):
+    '''
+    Split text into pieces that each encode to at most max_bytes, breaking
+    at a space where that doesn't waste more than half the line and never
+    in the middle of a multibyte character
+    '''
+    data = text.encode(encoding)
+    if len(data) <= max_bytes:
+        return [text]
+
+    max_bytes = max(max_bytes, 1)
+    pieces = []
+    while len(data) > max_bytes:
+        cut = data.rfind(b' ', 0, max_bytes + 1)
+        if cut > max_bytes // 2:
+            pieces.append(data[:cut].decode(encoding))
+            #the space we broke on isn't needed
+            data = data[cut + 1:]
+            continue
+
+        #back up to the start of a character
+        cut = max_bytes
+        while cut > 0 and ord(data[cut:cut + 1]) & 0xC0 == 0x80:
+            cut -= 1
+        if cut == 0:
+            #budget smaller than one character, send it anyway
+            cut = 1
+            while cut < len(data) and ord(data[cut:cut + 1]) & 0xC0 == 0x80:
+                cut += 1
+        pieces.append(data[:cut].decode(encoding))
+        data = data[cut:]
+
+    if data:
+        pieces.append(data.decode(encoding))
+    return pieces
+
+class LineBuffer(object):
+    '''
+    Accumulates raw bytes from the socket and splits them into irc lines on
+    \r\n, a line is only decoded once all of it has arrived so multibyte
+    characters split across reads come out intact
+
+    An unterminated line longer than max_line_length is thrown away (along
+    with the rest of it when it does end) so a broken server can't make us
+    buffer forever
+
+    If raw is set to a list the undecoded bytes of every complete line are
+    appended to it too, for captures
+    '''
+
+    def __init__(self, max_line_length=16384, encoding='utf-8'):
+        self.buffer = bytearray()
+        self.max_line_length = max_line_length
+        self.encoding = encoding
+        self.discarding = False
+        self.discarded = 0
+        self.raw = None
+
+    def feed(self, data):
+        '''
+        Add bytes read from the socket and return a list of the complete
+        lines (decoded and without the \r\n) they finished
+        '''
+        buf = self.buffer
+        buf += data
+        lines = []
+        start = 0
+        while True:
+            end = buf.find(b'\r\n', start)
+            if end < 0:
+                break
+
+            if self.discarding:
+                #tail end of an overlong line
+                self.discarding = False
+            elif end > start:
+                if self.raw is not None:
+                    self.raw.append(bytes(buf[start:end]))
+                lines.append(buf[start:end].decode(self.encoding, 'replace'))
+            start = end + 2
+
+        if start:
+            del buf[:start]
+
+        if len(buf) > self.max_line_length:
+            #keep a trailing \r in case its \n is in the next read
+            keep = 1 if buf[-1:] == b'\r' else 0
+            self.discarded += len(buf) - keep
+            del buf[:len(buf) - keep]
+            self.discarding = True
+
+        return lines
+
+    def clear(self):
+        '''
+        Forget any partial line, used when the connection is reset
+        '''
+        del self.buffer[:]
+        self.discarding = False
+
+
 class Network(object):
     '''
     Handles messages to the socket
@@ -15,16 +131,38 @@ class Network(object):
     Consists of a few basic functions aside from sending/receiving.
     Sending NICK, USER, message parsing, and sending PONG responses.
     '''
-    #Really long regex to match and split most irc messages correctly (No guarantees though as I haven"t fully roadtested it)
-    ircmsg = re.compile(r"(?P<prefix>:\S+ )?(?P<command>(\w+|\d{3}))(?P<params>( [^:]\S+)*)(?P<postfix> :.*)?")
-
-    def __init__(self, inqueue, outqueue, botname, module_name="network", b_size = 1024, log_level=logging.INFO):
+    def __init__(self, inqueue, outqueue, botname, module_name="network", b_size = 65536,
+                 max_line_length = 16384, out_buffer_size = 65536, flood_burst = 5, flood_rate = 1.0,
+                 flood_penalty_bytes = None, flood_exempt_priority = 1, tls = False, tls_verify = True,
+                 tls_cafile = None, tls_certfile = None, tls_keyfile = None, tls_timeout = 30,
+                 capture_file = None, log_level=logging.INFO):
+        #a fresh socket is made for every connection
         self.socket = None
         self.module_name = module_name
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setblocking(0)
-        self.incomplete_buffer = ""
+        #we recv straight into a preallocated buffer and frame lines at the byte level
         self.buffer_size = b_size
+        self.recv_buffer = bytearray(b_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.lines = LineBuffer(max_line_length)
+        #everything the server sends is appended here when set, see capture.py and replay.py
+        self.capture = None
+        if capture_file:
+            self.capture = capture.open_capture(capture_file, 'ab')
+            #captured before decoding so invalid utf-8 is kept as it was sent
+            self.lines.raw = []
+        #encoded lines waiting for the socket to accept them, we stop pulling
+        #events off the outbound queue while it is over out_buffer_size
+        self.out_buffer = bytearray()
+        self.out_buffer_size = out_buffer_size
+        #outbound pacing, lines from events with a priority <= flood_exempt_priority
+        #(PONG, connecting) skip the wait. flood_burst=None turns it off
+        if flood_burst:
+            self.flood = FloodControl(flood_burst, flood_rate, flood_penalty_bytes)
+        else:
+            self.flood = None
+        self.flood_exempt_priority = flood_exempt_priority
+        #priority of the outbound event being handled, send uses it for pacing
+        self.current_priority = 3
         self.log = logging.getLogger(u"{0}.{1}".format(botname, module_name))
         self.log.setLevel(log_level)
         self.is_running = True
@@ -34,11 +172,82 @@ class Network(object):
         self.outq = outqueue
 
         #list of our sockets
-        self.inputs = [self.socket]
-        self.outputs = [self.socket]
+        self.inputs = []
+        self.outputs = []
+
+        #TLS, the context lives as long as we do so sessions can be resumed
+        #on reconnect (where the ssl module supports it)
+        self.tls = tls
+        self.tls_context = None
+        if tls:
+            self.tls_context = ssl.create_default_context(cafile=tls_cafile)
+            if not tls_verify:
+                self.tls_context.check_hostname = False
+                self.tls_context.verify_mode = ssl.CERT_NONE
+            if tls_certfile:
+                #client certificate, i.e for CertFP
+                self.tls_context.load_cert_chain(tls_certfile, tls_keyfile)
+        self.tls_session = None
+        self.server = None
+        #true from connect until the TLS handshake is done, no irc traffic meanwhile
+        self.handshaking = False
+        self.handshake_wants_write = True
+        self.handshake_started = None
+        #seconds a handshake gets before we give up on the connection
+        self.tls_timeout = tls_timeout
+        #seconds the last handshake took and whether it resumed a session
+        self.handshake_time = None
+        self.handshake_resumed = False
+
+        #self-pipe the bot core writes to whenever it queues an outbound event
+        #so we can sleep in select until there is actually something to do
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        #other threads can still be waking us while finish closes the pipe
+        self.wake_lock = threading.Lock()
+
+        #what the server told us it supports in RPL_ISUPPORT, the bot core
+        #shares this object
+        self.isupport = ISupport()
+        #longest comma joined target list we will put in one line
+        self.max_targets_length = 256
+        #the nick we registered with and our nick!user@host as the server sees
+        #it, used to work out how much room the server's prefix takes up
+        self.nick_name = None
+        self.source = None
 
-        #Events coming out of the network - unused for now
-        self.in_events = []
+        #IRCv3 capabilities, we ask for anything in wanted_caps the server offers
+        #and caps is what ended up enabled (the bot core shares this set)
+        self.wanted_caps = set(['multi-prefix', 'userhost-in-names', 'batch', 'cap-notify'])
+        self.available_caps = {}
+        self.caps = set()
+        #true until we send CAP END and let registration finish
+        self.cap_negotiating = False
+        self.cap_pending = 0
+        #open server BATCHes, reference => (type, params, messages, outer reference)
+        self.batches = {}
+        #our own PINGs, token => time sent, and the answered ones
+        #token => (time sent, time answered) waiting for the lag monitor
+        self.pings = {}
+        self.pongs = {}
+        #lines received and queued for sending since we started
+        self.lines_in = 0
+        self.lines_out = 0
+        #profile of this thread and where it goes, see profile
+        self.profiler = None
+        self.profile_path = None
+
+        #Events coming out of the network, seen before the bot core gets them
+        self.in_events = [
+                         eu.event(nu.RPL_ISUPPORT, self.isupport_event),
+                         eu.event(nu.RPL_WELCOME, self.welcome_event),
+                         eu.event(nu.BOT_JOIN, self.join_event),
+                         eu.event(nu.BOT_NICK, self.nick_event),
+                         eu.event(nu.BOT_CAP, self.cap_event),
+                         eu.event(nu.BOT_PONG, self.pong_event),
+                         ]
 
         #Event coming in from the ircbot core
         self.out_events =   [
@@ -53,42 +262,208 @@ class Network(object):
                             eu.event(nu.BOT_QUIT, self.quit),
                             eu.event(nu.BOT_KILL, self.kill),
                             eu.event(nu.BOT_PONG, self.pong),
+                            eu.event(nu.BOT_PING, self.ping),
+                            eu.event(nu.BOT_DISCONNECT, self.disconnect),
+                            eu.event(nu.BOT_PROFILE, self.profile),
                             eu.event(nu.BOT_NAMES, self.names),
                             eu.event(nu.BOT_WHO, self.who),
+                            eu.event(nu.BOT_CAP_REQ, self.request_caps),
                             ]
         self.log.info('network initialised')
 
     def loop(self):
         self.log.debug('Looping started')
         while self.is_running:
-            if not self.connected:
-                try:
-                    m_event = self.outq.get(False)
-                    if m_event.type == nu.BOT_CONN:
-                        self.log.debug('Connection event!')
-                        self.connect(*m_event.data)
-                    else:
-                        pass
-                except q.Empty as e:
-                    pass
-            else:
-                self.poll_sockets()
-                time.sleep(.1)
+            self.run_once()
+
+        self.finish()
+
+    def finish(self):
+        '''
+        Called once the loop is over
+        '''
+        #get out anything we were told to send before dying (i.e QUIT), what
+        #flood control is still holding back has missed its chance
+        if self.connected and not self.handshaking:
+            if self.flood and self.flood.waiting:
+                self.log.warning(u'Ending with {0} lines held back by flood control'.format(
+                        len(self.flood.waiting)))
+            self.flush()
+
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+
+        if self.socket:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+        self.connected = False
+        self.inputs = []
+        self.outputs = []
+
+        with self.wake_lock:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_r = self.wake_w = None
 
         self.log.info('network ending')
 
-    def poll_sockets(self):
+    def run_once(self, timeout=None):
+        '''
+        A single pass of the network loop, sleeping at most timeout seconds
+        (forever if None) waiting for the socket or a wakeup
+        '''
+        inputs, outputs, errors = self.select_sets()
+        pacing = self.next_timeout()
+        if pacing is not None and (timeout is None or pacing < timeout):
+            timeout = pacing
+
+        try:
+            readable, writable, exceptional = select.select(inputs, outputs, errors, timeout)
+        except select.error as e:
+            #interrupted by a signal, the caller will come back around
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        self.handle_ready(readable, writable, exceptional)
+
+    def select_sets(self):
         '''
-        Uses select to get readable/writable sockets then calls
-        read or write on them
+        Returns the (readable, writable, exceptional) lists we want select to
+        watch, split out from run_once so one select can serve many networks
+
+        We only ask about writability when there is something to write,
+        otherwise select would return straight away on an idle connection
         '''
-        readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs)
+        if not self.connected:
+            return [self.wake_r], [], []
+
+        if self.handshaking:
+            outputs = self.outputs if self.handshake_wants_write else []
+            return self.inputs + [self.wake_r], outputs, self.inputs
+
+        outputs = self.outputs if self.out_buffer or self.wants_event() else []
+        return self.inputs + [self.wake_r], outputs, self.inputs
+
+    def next_timeout(self):
+        '''
+        Seconds until flood control lets the next waiting line go, or None
+        '''
+        if self.handshaking:
+            return max(self.handshake_started + self.tls_timeout - time.time(), 0)
+        if self.flood and self.connected:
+            return self.flood.next_release()
+        return None
+
+    def handle_ready(self, readable, writable, exceptional):
+        '''
+        Deal with whatever select said was ready out of our select_sets
+        '''
+        if self.wake_r in readable:
+            self.clear_wakeup()
+            readable = [r for r in readable if r is not self.wake_r]
+
+        if not self.connected:
+            self.handle_connect_events()
+        else:
+            self.handle_sockets(readable, writable, exceptional)
+
+    def wakeup(self):
+        '''
+        Wake the network loop out of select, the bot core calls this every time
+        it puts something on the outbound queue
+        '''
+        with self.wake_lock:
+            if self.wake_w is None:
+                #finished, there is nothing to wake
+                return
+            try:
+                os.write(self.wake_w, b'x')
+            except OSError as e:
+                #a full pipe means a wakeup is already pending
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def clear_wakeup(self):
+        '''
+        Empty the wakeup pipe so select blocks again
+        '''
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def handle_connect_events(self):
+        '''
+        While disconnected the only events we care about are connecting,
+        being told to die, capability requests and profiling, everything else
+        is dropped
+        '''
+        while self.is_running and not self.connected:
+            try:
+                m_event = self.outq.get(False)
+            except q.Empty as e:
+                break
+
+            if m_event.type == nu.BOT_CONN:
+                self.log.debug('Connection event!')
+                self.connect(*m_event.data)
+            elif m_event.type == nu.BOT_KILL:
+                self.kill()
+            elif m_event.type == nu.BOT_CAP_REQ:
+                self.request_caps(*m_event.data)
+            elif m_event.type == nu.BOT_PROFILE:
+                self.profile(*m_event.data)
+            else:
+                self.log.debug(u'Dropping %s event while disconnected', m_event.type)
+
+    def handle_handshake_events(self):
+        '''
+        Nothing can be sent until the TLS handshake is done so the outbound
+        queue waits for it, apart from the events that shouldn't have to
+        '''
+        for m_event in self.outq.take(handshake_events):
+            if m_event.type == nu.BOT_KILL:
+                self.kill()
+            elif m_event.type == nu.BOT_DISCONNECT:
+                #no QUIT, there is no irc connection to send it over yet
+                self.log.warning(u'Disconnecting during TLS handshake: {0}'.format(*m_event.data))
+                self.connection_lost(*m_event.data)
+            elif m_event.type == nu.BOT_PROFILE:
+                self.profile(*m_event.data)
+
+    def handle_sockets(self, readable, writable, exceptional):
+        '''
+        Calls read or write on the sockets select told us about
+        '''
+        if self.handshaking:
+            self.handle_handshake_events()
+            if not (self.is_running and self.handshaking):
+                return
+            if readable or writable:
+                self.handshake()
+            if self.handshaking and time.time() - self.handshake_started > self.tls_timeout:
+                self.log.error(u'TLS handshake with {0} timed out'.format(self.server))
+                self.connection_lost(u'TLS handshake timed out')
+                return
+            readable = writable = []
+
+        #lines flood control was holding back may be allowed out now
+        elif self.release_paced():
+            self.flush()
+
         if readable:
             for r in readable:
                 #read from r, placing the messages in the given queue 
                 self.handle_input(r, self.inq)
 
-        if writable and not self.outq.empty():
+        if writable:
             for w in writable:
                 #write to w with items pulled from the given queue
                 self.handle_output(w, self.outq)
@@ -96,26 +471,111 @@ class Network(object):
         if exceptional:
             for e in exceptional:
                 #TODO can we get the error to log as well?
-                self.log.error(u'Exceptional socket {0}'.format(e.getpeername()))
-                self.inputs.remove(e)
-                self.outputs.remove(e)
+                self.log.error(u'Exceptional socket {0}'.format(e))
+                self.drop_socket(e)
         
         #if we lost all our sockets
         if not self.inputs or not self.outputs:
             self.log.error(u'No sockets left to read/write')
-            self.connected = False
-            #highest priority message that will get client to attempt to reconnect
-            self.inq.put(eu.error('No sockets left to read/write from', priority=1))
+            self.connection_lost(u'No sockets left to read/write from')
 
-    def handle_output(self, socket, outqueue):
+    def connection_lost(self, reason):
+        '''
+        Tidy up after losing the connection and tell the bot core, which
+        normally tries to reconnect
+        '''
+        self.connected = False
+        self.handshaking = False
+        self.inputs = []
+        self.outputs = []
+        if self.socket:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+
+        self.lines.clear()
+        self.batches.clear()
+        self.pings.clear()
+        self.out_buffer = bytearray()
+        if self.flood:
+            self.flood.reset()
+        #highest priority message that will get client to attempt to reconnect
+        #shaped like a server ERROR so the same handlers deal with both
+        self.inq.put(eu.irc_msg(nu.BOT_ERR, (nu.BOT_ERR, None, [], reason), priority=1))
+
+    def handshake(self):
         '''
-        Takes an item from the outbound queue and puts it through our internal
-        event handlers
+        Move the TLS handshake along, called whenever the socket is ready.
+        The first time round the TCP connection has just finished so we
+        wrap the socket, then keep calling do_handshake until it is done
         '''
         try:
-            #grab an item from the outbound queue
-            m_event = self.outq.get(False)
-            self.log.debug(u'Outwards event, {0}, data {1}'.format(m_event.type, m_event.data))
+            if not isinstance(self.socket, ssl.SSLSocket):
+                error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise socket.error(error, os.strerror(error))
+
+                kwargs = {}
+                if self.tls_session is not None:
+                    kwargs['session'] = self.tls_session
+                self.socket = self.tls_context.wrap_socket(self.socket, server_hostname=self.server,
+                                                           do_handshake_on_connect=False, **kwargs)
+                self.inputs = [self.socket]
+                self.outputs = [self.socket]
+
+            self.socket.do_handshake()
+
+        except ssl.SSLWantReadError:
+            self.handshake_wants_write = False
+            return
+
+        except ssl.SSLWantWriteError:
+            self.handshake_wants_write = True
+            return
+
+        except (ssl.SSLError, ssl.CertificateError, socket.error) as e:
+            self.log.error(u'TLS handshake with {0} failed: {1}'.format(self.server, e))
+            self.drop_socket(self.socket)
+            return
+
+        self.handshaking = False
+        self.handshake_time = time.time() - self.handshake_started
+        self.handshake_resumed = getattr(self.socket, 'session_reused', False)
+        #only newer ssl modules let us keep the session for next time
+        self.tls_session = getattr(self.socket, 'session', None)
+        self.log.info(u'TLS handshake took {0:.3f}s ({1}, {2})'.format(
+                self.handshake_time, self.socket.version(),
+                u'resumed' if self.handshake_resumed else u'full'))
+
+    def drop_socket(self, sock):
+        '''
+        Stop selecting on a socket that has broken, once we have none left
+        handle_sockets tells the bot core we lost the connection
+        '''
+        if sock in self.inputs:
+            self.inputs.remove(sock)
+        if sock in self.outputs:
+            self.outputs.remove(sock)
+
+    def handle_output(self, socket, outqueue):
+        '''
+        Takes as many items from the outbound queue as will fit in the output
+        buffer, puts them through our internal event handlers and then writes
+        as much of the buffer as the socket will take
+        '''
+        while self.wants_event():
+            try:
+                #grab an item from the outbound queue
+                m_event = self.outq.get(False)
+            except q.Empty:
+                #nothing left to write
+                break
+
+            self.current_priority = m_event.priority
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(u'Outwards event, %s, data %s', m_event.type, m_event.data)
             #put them through our outbound event handlers
             triggered = False
             for e in self.out_events:
@@ -123,11 +583,23 @@ class Network(object):
                     triggered = True
 
             if not triggered:
-                self.log.debug(u'Unhandled outbound event {0} data:{1}'.format(m_event.type, m_event.data))
+                self.log.debug(u'Unhandled outbound event %s data:%s', m_event.type, m_event.data)
 
-        except q.Empty:
-            #nothing to write
-            pass
+        self.release_paced()
+        self.flush()
+
+    def wants_event(self):
+        '''
+        True if the next event on the outbound queue should be taken off it
+        now. While flood control is holding a full buffer's worth we stop
+        pulling events, apart from urgent ones (PONG, KILL etc) which go
+        ahead of the backlog anyway
+        '''
+        if self.bytes_pending() < self.out_buffer_size:
+            return not self.outq.empty()
+
+        priority = self.outq.head_priority()
+        return priority is not None and priority <= self.flood_exempt_priority
 
     def handle_input(self, socket, inqueue):
         '''
@@ -140,7 +612,8 @@ class Network(object):
         clean = []
         for line in result:
             cleaned_message = self.parse_message(line)
-            clean.append(cleaned_message)
+            if cleaned_message:
+                clean.append(cleaned_message)
         
         #go through the cleaned messages and put them through our internal
         #event handling before they reach client (normally used to tweak priorities)
@@ -148,82 +621,319 @@ class Network(object):
             for event in self.in_events:
                 event(msg) #TODO do I really need this?
 
+            self.deliver(msg)
+
+    def deliver(self, msg):
+        '''
+        Hand an inbound message to the bot core, anything inside a server
+        BATCH is held back and the whole batch goes over as one event when
+        it ends (see eu.batch). Batches can be nested
+        '''
+        reference = msg.tags.get('batch') if msg.tags else None
+        if msg.type == nu.BOT_BATCH:
+            command, prefix, params, postfix = msg.data
+            if not params:
+                return
+
+            if params[0].startswith('+'):
+                batch_type = params[1] if len(params) > 1 else u''
+                self.batches[params[0][1:]] = (batch_type, params[2:], [], reference)
+                return
+
+            if params[0].startswith('-'):
+                batch = self.batches.pop(params[0][1:], None)
+                if batch is None:
+                    self.log.warning(u'End of unknown batch {0}'.format(params[0][1:]))
+                    return
+
+                batch_type, batch_params, messages, reference = batch
+                msg = eu.batch(batch_type, batch_params, messages)
+
+        if reference in self.batches:
+            self.batches[reference][2].append(msg)
+        else:
             self.inq.put(msg)
 
-    def send(self, line, encoding='utf-8'):
-        #send the message out
-        #send takes the form SENDOUT [lines..]
-        self.log.info(u'>> {0}'.format(line))
+    def send(self, line, encoding='utf-8', priority=None):
+        '''
+        Queue a line for sending, it is encoded once and appended to the
+        output buffer which flush writes out when the socket is writable
+        priority defaults to that of the outbound event being handled
+        '''
+        if priority is None:
+            priority = self.current_priority
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(u'>> %s', line)
+        self.lines_out += 1
         line = line.replace('\r', ' ').replace('\n', ' ') + '\r\n'
-        totalsent = 0
-        while totalsent < len(line):
-            sent = self.socket.send(line[totalsent:].encode(encoding))
-            totalsent = totalsent + sent
-                
+        data = line.encode(encoding)
+        if not self.flood:
+            self.out_buffer.extend(data)
+        elif priority <= self.flood_exempt_priority:
+            #urgent, jumps ahead of anything being paced
+            self.flood.charge(data)
+            self.out_buffer.extend(data)
+        else:
+            self.flood.queue(data)
 
-    def recv(self):
+    def release_paced(self):
+        '''
+        Move the lines flood control will let go now into the output buffer,
+        returns true if there were any
         '''
-        Receives data from the server.
+        if not self.flood:
+            return False
+
+        released = self.flood.release()
+        for data in released:
+            self.out_buffer.extend(data)
+        return bool(released)
+
+    def flush(self):
+        '''
+        Write as much of the output buffer as the socket will accept, whatever
+        is left over waits for the next time the socket is writable
         '''
-        buffer_size = self.buffer_size
-        d = self.socket.recv(buffer_size)
+        while self.out_buffer:
+            try:
+                sent = self.socket.send(self.out_buffer)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                #TLS needs another go with the same data
+                break
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
 
-        data = d.decode('utf-8', 'replace')
+                self.log.error(u'Unable to write to socket: {0}'.format(e))
+                self.out_buffer = bytearray()
+                self.drop_socket(self.socket)
+                break
 
+            del self.out_buffer[:sent]
+
+    def bytes_pending(self):
+        '''
+        Number of bytes queued for the socket but not yet written (including
+        lines flood control is holding back), a large number means the server
+        isn't keeping up with us or we are sending faster than we are allowed
         '''
-        Read a stream of data, splitting it into messages separated by \r\n.
+        if self.flood:
+            return len(self.out_buffer) + self.flood.waiting_bytes
+        return len(self.out_buffer)
 
-        The last incomplete message (if any) will be stored in the incomplete
-        buffer variable to be used in the next read of the data stream
-        
-        Every time we get new data we put the incomplete buffer at the front then we 
-        check if the last 2 chars are the delimiter, in which case we have a full
-        irc msg so we can just split the data. Otherwise we have to split the data
-        and put the last incomplete item on the buffer
+    def flood_stats(self):
         '''
-        if self.incomplete_buffer:
-            data = self.incomplete_buffer + data
-            incomplete_buffer = ''
+        Flood control counters (see FloodControl.stats), None if it is off
+        '''
+        if self.flood:
+            return self.flood.stats()
+        return None
 
-        if data[-2:] is '\r\n':
-            split_data = data.split('\r\n')
+    def recv(self):
+        '''
+        Receives data from the server, returning the list of complete
+        irc lines it finished (see LineBuffer)
+        '''
+        lines = []
+        while True:
+            try:
+                received = self.socket.recv_into(self.recv_buffer)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
 
-        else:
-            split_data = data.split('\r\n')
-            self.incomplete_buffer = split_data.pop(-1)
+                self.log.error(u'Unable to read from socket: {0}'.format(e))
+                self.drop_socket(self.socket)
+                break
+
+            if not received:
+                #server closed the connection on us
+                self.log.error(u'Connection closed by server')
+                self.drop_socket(self.socket)
+                break
+
+            lines.extend(self.lines.feed(self.recv_view[:received]))
+            #TLS can have decrypted data waiting that select won't tell us about
+            if not (self.tls and self.socket.pending()):
+                break
 
-        return split_data
+        self.lines_in += len(lines)
+        if self.capture and self.lines.raw:
+            capture.write_lines(self.capture, self.lines.raw, time.time())
+            del self.lines.raw[:]
+
+        return lines
 
     def parse_message(self, message):
         '''
         Takes messages from the socket and converts them into internal events
         '''
-        m = self.ircmsg.match(message)
+        parsed = ircparse.parse(message)
 
-        if not m:
-            self.log.warn(u'Couldn\'t match message {0}'.format(message))
+        if not parsed:
+            self.log.warn(u'Couldn\'t parse message {0}'.format(message))
             return None
 
-        postfix = m.group('postfix')
+        tags, prefix, command, params, postfix = parsed
+        if postfix is None and command in texts:
+            #"PRIVMSG #c hello" is as valid as "PRIVMSG #c :hello"
+            postfix = params.pop() if len(params) > 1 else u''
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(u'<< %s %s %s %s', prefix, command, params, postfix)
+        priority = 1 if command in urgent else 3
+        return eu.irc_msg(command, (command, prefix, params, postfix), priority, tags)
+
+    #Inbound event handlers
+    def isupport_event(self, command, prefix, params, postfix):
+        '''
+        Store the RPL_ISUPPORT tokens, the first param is our nick
+        '''
+        self.isupport.update(params[1:])
+
+    def welcome_event(self, command, prefix, params, postfix):
+        '''
+        RPL_WELCOME tells us our nick and usually ends with our nick!user@host
+        '''
+        #registration is over, so is negotiation (even if the server never answered CAP)
+        self.cap_negotiating = False
+        if params:
+            self.nick_name = params[0]
         if postfix:
-            postfix = postfix.strip(' ')
-            postfix = postfix.lstrip(':')
+            last = postfix.split(' ')[-1]
+            if '!' in last and '@' in last:
+                self.source = last
+
+    def pong_event(self, command, prefix, params, postfix):
+        '''
+        Note when the answer to one of our own PINGs arrived, so lag can be
+        measured without the time it spends waiting in the bot's queue
+        '''
+        token = postfix or (params[-1] if params else None)
+        sent = self.pings.pop(token, None)
+        if sent is not None:
+            self.pongs[token] = (sent, time.time())
 
-        command = m.group('command')
+    def join_event(self, command, prefix, params, postfix):
+        '''
+        The server echoes our own JOINs, which gives us our exact source
+        '''
+        if prefix and self.nick_name and prefix.split('!')[0] == self.nick_name:
+            self.source = prefix
 
-        prefix = m.group('prefix')
-        if prefix:
-            prefix = prefix.strip(' ')
-            prefix = prefix.lstrip(':')
+    def nick_event(self, command, prefix, params, postfix):
+        '''
+        Keep track of our own nick changes
+        '''
+        if prefix and self.nick_name and prefix.split('!')[0] == self.nick_name:
+            newnick = postfix or params[0]
+            self.nick_name = newnick
+            if self.source:
+                self.source = newnick + self.source[self.source.index('!'):]
 
-        params = m.group('params')
-        if params:
-            params = params.strip(' ')
-            params = params.split(' ')
-        
-        self.log.debug(u'Cleaned message, prefix = {0}, command = {1}, params = {2}, postfix = {3}'.format(prefix, command, params, postfix))
-        self.log.info(u'<< {0} {1} {2} {3}'.format(prefix, command, params, postfix))
-        return eu.irc_msg(command, (command, prefix, params, postfix))
+    def cap_event(self, command, prefix, params, postfix):
+        '''
+        Server side of CAP negotiation, params are [nick or *, subcommand]
+        with a * after LS when more lines are coming
+        '''
+        if len(params) < 2:
+            return
+
+        subcommand = params[1].upper()
+        if postfix is not None:
+            caps = postfix.split()
+        elif len(params) > 2 and params[-1] != '*':
+            caps = params[-1].split()
+        else:
+            caps = []
+
+        if subcommand in ('LS', 'NEW'):
+            for cap in caps:
+                name, _, value = cap.partition('=')
+                self.available_caps[name] = value
+
+            if not (len(params) > 2 and params[2] == '*'):
+                self.request_wanted()
+
+        elif subcommand == 'ACK':
+            for cap in caps:
+                if cap.startswith('-'):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            self.log.info(u'Capabilities enabled: {0}'.format(u' '.join(sorted(self.caps))))
+            self.cap_answered()
+
+        elif subcommand == 'NAK':
+            self.log.warning(u'Server refused capabilities {0}'.format(u' '.join(caps)))
+            self.cap_answered()
+
+        elif subcommand == 'DEL':
+            for cap in caps:
+                self.available_caps.pop(cap, None)
+                self.caps.discard(cap)
+
+    def request_wanted(self):
+        '''
+        Ask for the wanted capabilities the server offers that we don't have
+        yet, finishing negotiation if there aren't any
+        '''
+        request = sorted(cap for cap in self.wanted_caps
+                         if cap in self.available_caps and cap not in self.caps)
+        if request:
+            self.cap_pending += 1
+            self.send(u'CAP REQ :{0}'.format(u' '.join(request)), priority=1)
+        elif self.cap_negotiating and not self.cap_pending:
+            self.cap_end()
+
+    def cap_answered(self):
+        self.cap_pending = max(self.cap_pending - 1, 0)
+        if self.cap_negotiating and not self.cap_pending:
+            self.cap_end()
+
+    def cap_end(self):
+        self.cap_negotiating = False
+        self.send(u'CAP END', priority=1)
+
+    def source_length(self):
+        '''
+        Bytes the server's :nick!user@host prefix (and its space) adds to
+        anything we send before relaying it, if we don't know our host yet
+        assume the longest the server allows
+        '''
+        if self.source:
+            return len(self.source.encode('utf-8')) + 2
+
+        nick = self.nick_name.encode('utf-8') if self.nick_name else b'x' * self.isupport.nicklen()
+        #the extra 1 allows for the ~ on an unidentd user
+        return len(nick) + self.isupport.userlen() + 1 + self.isupport.hostlen() + 4
+
+    def target_groups(self, channels):
+        '''
+        Split a list of targets into comma joined groups the server will
+        accept in a single PRIVMSG, duplicates are dropped
+        '''
+        max_targets = self.isupport.targmax(nu.BOT_PRIVMSG)
+        groups = []
+        group = []
+        length = 0
+        seen = set()
+        for channel in channels:
+            if channel in seen:
+                continue
+            seen.add(channel)
+            if group and (len(group) >= max_targets or
+                          length + 1 + len(channel) > self.max_targets_length):
+                groups.append(u','.join(group))
+                group = []
+                length = 0
+            length += len(channel) + (1 if group else 0)
+            group.append(channel)
+
+        if group:
+            groups.append(u','.join(group))
+        return groups
 
     #Everything below this point are handlers for events from botcore
     def msgs_all(self, msgs, channels):
@@ -231,19 +941,21 @@ class Network(object):
         Accepts a list of messages to send to a list of channels
         msgs: A list of messages to send
         channels: A list of targets to send it to
+        Channels are merged into multi target PRIVMSGs where the server allows
         '''
-        for channel in channels:
+        for targets in self.target_groups(channels):
             for message in msgs:
-                self.msg(message, channel)
+                self.msg(message, targets)
 
     def msg_all(self, message, channels):
         '''
         Accepts a message to send to a list of channels
         message: the message to send
         channels: A list of targets to send it to
+        Channels are merged into multi target PRIVMSGs where the server allows
         '''
-        for channel in channels:
-            self.msg(message, channel)
+        for targets in self.target_groups(channels):
+            self.msg(message, targets)
 
     def msg(self, message, channel):
         '''
@@ -251,21 +963,15 @@ class Network(object):
         message: the message to send
         channel: the target to send it to
         
-        This method takes care of enforcing the 512 character limit
-        right now it does it very simply by cutting the message at char 510
-        (leaving space for the \r\n) and calling msg again with the remainder
-        later on it might be improved by finding the nearest space to cut on
-        under the limit
-        '''
-        msg = u'PRIVMSG {0} :{1}'.format(channel, message)
-        if len(msg) > 512:
-            sending = msg[:510]
-            remainder = msg[510:]
-            self.send(sending)
-            self.msg(remainder, channel)
-        
-        else:
-            self.send(msg)
+        Long messages are split into as few lines as possible, each packed up
+        to the server's line length in bytes after allowing for the
+        :nick!user@host prefix the server adds when it relays them
+        '''
+        header = u'PRIVMSG {0} :'.format(channel)
+        budget = (self.isupport.linelen() - len(b'\r\n') - self.source_length() -
+                  len(header.encode('utf-8')))
+        for line in split_text(u'{0}'.format(message), budget):
+            self.send(header + line)
 
     def msgs(self, msgs, channel):
         '''
@@ -284,12 +990,14 @@ class Network(object):
     def quit(self, message):
         '''
         Disconnects from a server with a optional QUIT message.
+        It skips flood control, the lines still held back would only get
+        us killed for flooding before the server saw it
         '''
         if message:
-            self.send(u'QUIT :{0}'.format(message))
+            self.send(u'QUIT :{0}'.format(message), priority=self.flood_exempt_priority)
         
         else:
-            self.send(u'QUIT')
+            self.send(u'QUIT', priority=self.flood_exempt_priority)
     
     def kill(self):
         '''
@@ -311,23 +1019,53 @@ class Network(object):
         '''
         Connect to a server.
         data is the args
+        With TLS on, the handshake happens in the select loop once the
+        TCP connection is up
         '''
+        self.server = server
+        #told to connect again while still connected (i.e after a server ERROR)
+        if self.socket:
+            self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        self.inputs = [self.socket]
+        self.outputs = [self.socket]
+        self.out_buffer = bytearray()
+        self.lines.clear()
+        self.batches.clear()
+        self.handshaking = self.tls
+        self.handshake_wants_write = True
+        self.handshake_started = time.time()
         try:
             self.socket.connect((server,port))
         except socket.error as e:
-            if e.errno == 115:
-                pass
-            elif e.errno == 10035:
-                pass
-            else:
-                raise e
+            if e.errno not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.log.error(u'Unable to connect to {0}:{1} {2}'.format(server, port, e))
+                self.connection_lost(u'Unable to connect: {0}'.format(e))
+                return
 
+        if self.flood:
+            self.flood.reset()
+        #new server, wait for it to tell us its limits
+        self.isupport.clear()
+        self.source = None
         self.connected = True
 
+        #see what IRCv3 capabilities the server has, registration waits
+        #until we send CAP END. Servers without CAP just ignore this
+        self.available_caps.clear()
+        self.caps.clear()
+        self.cap_pending = 0
+        self.cap_negotiating = True
+        self.send(u'CAP LS 302', priority=1)
+
     def nick(self, nick):
         '''
         Send the nick command with the given nick
         '''
+        if not self.nick_name or not self.source:
+            #not registered yet, this is going to be our nick
+            self.nick_name = nick
         self.send(u'NICK {0}'.format(nick))
 
     def user(self, nick, realname):
@@ -339,7 +1077,47 @@ class Network(object):
     
     def pong(self, msg):
         self.send(u'PONG {0}'.format(msg))
+
+    def ping(self, token):
+        '''
+        PING the server with token, remembering when it went out
+        '''
+        self.send(u'PING :{0}'.format(token))
+        self.pings[token] = time.time()
+
+    def disconnect(self, reason):
+        '''
+        Quit and drop the connection, the bot core sees it as a lost
+        connection and reconnects
+        '''
+        self.log.warning(u'Disconnecting: {0}'.format(reason))
+        self.send(u'QUIT :{0}'.format(reason), priority=1)
+        self.flush()
+        self.connection_lost(reason)
         
+    def profile(self, path):
+        '''
+        Profile the thread running the network loop until this is called
+        again with path None, then write the profile to path
+        '''
+        if path:
+            if self.profiler:
+                return
+            self.profile_path = path
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return
+
+        if not self.profiler:
+            return
+        self.profiler.disable()
+        try:
+            self.profiler.dump_stats(self.profile_path)
+            self.log.info('Network profile written to %s', self.profile_path)
+        except (IOError, OSError) as e:
+            self.log.error(u'Unable to write network profile: {0}'.format(e))
+        self.profiler = None
+
     def names(self, channels):
         '''
         Send the NAMES command with the given set of channels to call
@@ -350,6 +1128,15 @@ class Network(object):
         else:
             self.send(u'NAMES')
     
+    def request_caps(self, caps):
+        '''
+        A module wants these capabilities, ask for them now if we are past
+        negotiation, otherwise they get requested along with the rest
+        '''
+        self.wanted_caps.update(caps)
+        if self.connected and not self.cap_negotiating:
+            self.request_wanted()
+
     def who(self, param):
         '''
         send the Who message with given param
@@ -277,4 +277,12 @@ BOT_PRIVMSG = 'PRIVMSG'
 BOT_COMM = 'COMMAND'
 BOT_WHO = 'WHO'
 BOT_PART = 'PART'
-BOT_QUIT = 'QUIT'
\ No newline at end of file
+BOT_QUIT = 'QUIT'
+BOT_CAP = 'CAP'
+BOT_CAP_REQ = 'CAP_REQ'
+BOT_BATCH = 'BATCH'
+BOT_BATCH_GROUP = 'BATCH_GROUP'
+BOT_DISCONNECT = 'DISCONNECT'
+BOT_PROFILE = 'PROFILE'
+#subscribe to this to get every event
+BOT_ANY = '*'
@@ -0,0 +1,127 @@
+import os
+import time
+import pstats
+import cProfile
+import logging
+
+class Profiler:
+    '''
+    Profiles the running bot on request, so a slow bot can be looked at
+    without restarting it
+
+    "botnick profile 30" profiles the main loop for 30 seconds then writes a
+    pstats file to directory and replies with the functions that took the
+    most cumulative time. "botnick profile 30 network" profiles the network
+    thread as well, into a file of its own (with threaded=False the network
+    runs on the main loop so it is in the main profile anyway)
+
+    Nothing is hooked in until a profile is asked for
+    '''
+
+    def __init__(self, bot, module_name='profiler', log_level=logging.INFO, directory='.',
+                 top=10, max_seconds=600):
+        self.bot = bot
+        self.log = logging.getLogger('{0}.{1}'.format(bot.log_name, module_name))
+        self.log.setLevel(log_level)
+        self.irc = bot.irc
+        self.module_name = module_name
+        self.directory = directory
+        self.top = top
+        self.max_seconds = max_seconds
+
+        #the profile running now, if any
+        self.profile = None
+        self.path = None
+        self.targets = None
+        self.network = False
+        #when stop is due, in case its timed event never gets to run
+        self.deadline = None
+
+        self.commands = [
+                        self.bot.command(r'profile (?P<seconds>\d+)(?P<network> network)?$', self.profile_command,
+                                         direct=True, auth_level=20),
+                        ]
+        self.events = []
+        self.bot.add_module(module_name, self)
+
+    def profile_command(self, nick, nickhost, action, targets, message, m):
+        if self.profile and time.time() > self.deadline + 1:
+            self.log.warning('Profile ran past its end, stopping it')
+            self.stop()
+        if self.profile:
+            self.irc.msg_all(u'Already profiling', targets)
+            return
+
+        seconds = min(int(m.group('seconds')), self.max_seconds)
+        network = bool(m.group('network')) and self.bot.threaded
+        self.start(seconds, targets, network)
+        self.irc.msg_all(u'Profiling{0} for {1} seconds'.format(
+                u' and the network' if network else u'', seconds), targets)
+
+    def start(self, seconds, targets, network=False):
+        '''
+        Profile this thread for seconds, and the network thread as well if
+        network is set. Replies to targets when done
+        '''
+        self.path = os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S.pstats'))
+        self.targets = targets
+        self.network = network
+        if network:
+            #the network thread has to start its own
+            self.irc.profile(self.network_path())
+        self.log.info('Profiling for %s seconds into %s', seconds, self.path)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.deadline = time.time() + seconds
+        self.bot.run_event_in(seconds, self.stop)
+
+    def network_path(self):
+        root, ext = os.path.splitext(self.path)
+        return root + '-network' + ext
+
+    def stop(self):
+        '''
+        Timed event, finish the profile and report on it
+        '''
+        if not self.profile:
+            return
+        self.profile.disable()
+        if self.network:
+            self.irc.profile(None)
+
+        try:
+            self.profile.dump_stats(self.path)
+            lines = self.report(pstats.Stats(self.profile))
+            lines.insert(0, u'Profile written to {0}{1}'.format(
+                    self.path, u' and {0}'.format(self.network_path()) if self.network else u''))
+
+        except (IOError, OSError) as e:
+            self.log.exception('Unable to write profile')
+            lines = [u'Unable to write profile: {0}'.format(e)]
+
+        self.profile = None
+        self.irc.msgs_all(lines, self.targets)
+
+    def report(self, stats):
+        '''
+        The top functions by cumulative time, one line each
+        '''
+        #(file, line, function) => (primitive calls, calls, own time, cumulative time, callers)
+        functions = sorted(stats.stats.items(), key=lambda (key, value): value[3], reverse=True)
+        lines = []
+        for (filename, line, function), (primitive, calls, own, cumulative, callers) in functions[:self.top]:
+            where = u'{0}:{1}'.format(os.path.basename(filename), line) if line else filename
+            lines.append(u'{0:.3f}s {1} ({2}) {3} calls, {4:.3f}s own'.format(
+                    cumulative, function, where, calls, own))
+        return lines
+
+    def close(self):
+        if self.profile:
+            self.profile.disable()
+            self.profile = None
+
+    def syntax(self):
+        return  '''
+                Profiler module supports
+                botnick profile seconds [network]
+                '''
@@ -0,0 +1,160 @@
+'''
+Replays a traffic capture through a real bot, so performance problems seen
+in production can be reproduced and measured
+
+Usage is python replay.py capturefile [--speed n] [--nick nick] [--module module.Class]
+
+Capture the traffic with net_options={'capture_file': 'traffic.cap'}, see
+capture.py for the format. Each line goes through Network.parse_message and
+the inbound network handlers, then CommandBot.logic with the default modules
+(plus any given with --module) and finally whatever the bot replied is run
+through the outbound handlers, which is as far as it gets without a socket
+
+--speed 1 keeps the pacing it was captured at, 2 is twice as fast and
+0 (the default) goes as fast as possible. Reports events/sec and how the
+time was split between the stages
+'''
+import sys
+import time
+import logging
+import argparse
+import importlib
+import ircparse
+import numerics as nu
+from capture import read_capture
+from commandbot import CommandBot
+
+#outbound events that would need a real connection
+skip_out = set([nu.BOT_CONN, nu.BOT_KILL, nu.BOT_DISCONNECT])
+
+class Replay(object):
+    '''
+    Drives a bot made with threaded=False one line at a time, timing each stage
+    '''
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.net = bot.net
+        self.stages = ['parse', 'logic', 'output']
+        self.timings = dict((stage, 0.0) for stage in self.stages)
+        self.lines = 0
+        self.lines_out = 0
+        #the bot queued up connecting to the server when it was made
+        self.output()
+
+    def feed(self, raw):
+        '''
+        Put one raw line (bytes, from read_capture with decode=False) through
+        the bot, decoding it the same way the network does
+        '''
+        net = self.net
+        start = time.time()
+        for line in net.lines.feed(raw + b'\r\n'):
+            msg = net.parse_message(line)
+            if msg:
+                for event in net.in_events:
+                    event(msg)
+                net.deliver(msg)
+        parsed = time.time()
+
+        self.bot.logic()
+        processed = time.time()
+
+        self.output()
+        done = time.time()
+
+        self.lines += 1
+        self.timings['parse'] += parsed - start
+        self.timings['logic'] += processed - parsed
+        self.timings['output'] += done - processed
+
+    def output(self):
+        '''
+        Run the bot's replies through the outbound handlers, then throw away
+        what would have been written to the socket
+        '''
+        net = self.net
+        while not net.outq.empty():
+            m_event = net.outq.get(False)
+            if m_event.type in skip_out:
+                continue
+            net.current_priority = m_event.priority
+            for event in net.out_events:
+                event(m_event)
+
+        if net.out_buffer:
+            self.lines_out += net.out_buffer.count(b'\r\n')
+            del net.out_buffer[:]
+
+    def run(self, entries, speed=0):
+        '''
+        Feed every (timestamp, line) from a capture, at speed times the
+        original pace (0 is as fast as possible). Returns the seconds taken
+        '''
+        if not entries:
+            return 0.0
+
+        start = time.time()
+        first = entries[0][0]
+        for timestamp, line in entries:
+            if speed:
+                wait = start + (timestamp - first) / speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self.feed(line)
+
+        return time.time() - start
+
+    def report(self, elapsed):
+        busy = sum(self.timings.values())
+        print('{0} lines in, {1} lines out in {2:.3f}s'.format(self.lines, self.lines_out, elapsed))
+        if busy:
+            print('{0:.0f} events/sec ({1:.0f} events/sec of bot time)'.format(
+                    self.lines / elapsed, self.lines / busy))
+        for stage in self.stages:
+            spent = self.timings[stage]
+            print('{0:<8} {1:>9.3f}s {2:>9.1f}us/line {3:>6.1%}'.format(
+                    stage, spent, spent / max(self.lines, 1) * 1e6, spent / busy if busy else 0))
+
+def find_nick(entries):
+    '''
+    The nick the bot had when the capture was made, from RPL_WELCOME
+    '''
+    for timestamp, line in entries:
+        parsed = ircparse.parse(line.decode('utf-8', 'replace'))
+        if parsed and parsed[2] == nu.RPL_WELCOME and parsed[3]:
+            return parsed[3][0]
+    return None
+
+def load_module(bot, path):
+    '''
+    Create a module from a module.Class path, i.e aliasbot.AliasBot
+    '''
+    module_name, _, class_name = path.rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)(bot)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured irc traffic through the bot')
+    parser.add_argument('capture', help='capture file written with the capture_file network option')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='multiple of the captured pace, 0 (default) is as fast as possible')
+    parser.add_argument('--nick', help='nick of the bot, defaults to the one in the capture')
+    parser.add_argument('--module', action='append', default=[],
+                        help='extra module to load as module.Class, i.e aliasbot.AliasBot (can be repeated)')
+    parser.add_argument('--db', default=':memory:', help='database for the bot, defaults to an empty one')
+    parser.add_argument('--log-level', default='WARNING', help='log level for the bot and its modules')
+    options = parser.parse_args()
+
+    entries = read_capture(options.capture, decode=False)
+    nick = options.nick or find_nick(entries) or 'bot'
+    level = getattr(logging, options.log_level.upper())
+    logging.basicConfig(level=level)
+    bot = CommandBot(nick, 'replay', 6667, db_file=options.db, log_level=level, threaded=False,
+                     net_options={'flood_burst': None, 'log_level': level})
+    for path in options.module:
+        load_module(bot, path)
+
+    replay = Replay(bot)
+    elapsed = replay.run(entries, options.speed)
+    replay.report(elapsed)
+    bot.cleanup()
@@ -0,0 +1,135 @@
+'''
+End to end tests of the ways a bot can be run, each one against a fakeircd:
+the bot registers, joins, answers a command and then quits on being told to
+
+python -m unittest test_backends
+'''
+import time
+import logging
+import unittest
+from fakeircd import FakeIRCd
+from commandbot import CommandBot
+from connmanager import ConnectionManager
+
+#longest a bot gets before it is closed regardless and the test fails
+deadline = 10
+source = u'tester!tester@test.fake'
+
+class ScriptedIRCd(FakeIRCd):
+    '''
+    A FakeIRCd that, once a bot has joined the channel, sends it !hello and
+    then !bye when the answer to that comes back. It all happens on the
+    server's thread between its passes, like its own simulated users
+    '''
+
+    def __init__(self, **kwargs):
+        FakeIRCd.__init__(self, channels=1, users=2, channels_per_user=1, log_level=logging.WARNING, **kwargs)
+        self.channel = self.channel_names[0]
+        #bot nick => how far through the script it is
+        self.stages = {}
+        self.quits = []
+
+    def run_once(self, timeout):
+        FakeIRCd.run_once(self, timeout)
+        for client in self.clients.values():
+            if not client.registered or self.channel not in client.channels:
+                continue
+
+            stage = self.stages.get(client.nick, 0)
+            if stage == 0:
+                self.send_command(u'!hello', client, self.channel, source)
+                self.stages[client.nick] = 1
+            elif stage == 1 and self.answered(client):
+                self.send_command(u'!bye', client, self.channel, source)
+                self.stages[client.nick] = 2
+
+    def answered(self, client):
+        return (self.channel, u'hello tester') in client.received
+
+    def irc_QUIT(self, client, params):
+        self.quits.append(client.nick)
+        FakeIRCd.irc_QUIT(self, client, params)
+
+class Greeter:
+    '''
+    The commands the server's script uses
+    '''
+
+    def __init__(self, bot, module_name='greeter'):
+        self.bot = bot
+        self.irc = bot.irc
+        self.commands = [
+                        self.bot.command(r'!hello$', self.hello),
+                        self.bot.command(r'!bye$', self.bye),
+                        ]
+        self.events = []
+        self.bot.add_module(module_name, self)
+
+    def hello(self, nick, nickhost, action, targets, message, m):
+        self.irc.msg_all(u'hello {0}'.format(nick), targets)
+
+    def bye(self, nick, nickhost, action, targets, message, m):
+        self.bot.close()
+
+    def close(self):
+        pass
+
+    def syntax(self):
+        return '!hello, !bye'
+
+class BackendTest(unittest.TestCase):
+    #extra FakeIRCd and bot network kwargs, for subclasses
+    server_options = {}
+    net_options = {}
+
+    def setUp(self):
+        self.server = ScriptedIRCd(**self.server_options).start()
+        self.overdue = []
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_bot(self, nick, threaded):
+        bot = CommandBot(nick, '127.0.0.1', self.server.port, db_file=':memory:', log_name='test_' + nick,
+                         log_level=logging.WARNING, threaded=threaded, net_options=dict(self.net_options),
+                         log_levels={'network': logging.WARNING, 'identhost': logging.WARNING})
+        bot.auth.bootstrapped = True
+        Greeter(bot)
+        bot.join(self.server.channel)
+        bot.run_event_in(deadline, lambda: self.give_up(bot))
+        return bot
+
+    def give_up(self, bot):
+        self.overdue.append(bot.nick)
+        bot.close()
+
+    def check(self, *nicks):
+        self.assertEqual(self.overdue, [])
+        #the server reads the QUIT on its own thread, after the bot is done
+        end = time.time() + 5
+        while time.time() < end and not set(nicks) <= set(self.server.quits):
+            time.sleep(0.01)
+
+        for nick in nicks:
+            self.assertEqual(self.server.stages.get(nick), 2)
+            self.assertIn(nick, self.server.quits)
+
+    def test_threaded(self):
+        bot = self.make_bot('threadbot', threaded=True)
+        bot.loop()
+        self.check('threadbot')
+
+    def test_inline(self):
+        bot = self.make_bot('inlinebot', threaded=False)
+        bot.loop()
+        self.check('inlinebot')
+
+    def test_connection_manager(self):
+        manager = ConnectionManager(log_level=logging.WARNING)
+        for nick in ('managedbot1', 'managedbot2'):
+            manager.add_bot(self.make_bot(nick, threaded=False))
+        manager.loop()
+        self.check('managedbot1', 'managedbot2')
+
+if __name__ == '__main__':
+    unittest.main()
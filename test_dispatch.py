@@ -0,0 +1,114 @@
+'''
+Tests of the command index, that it finds every command a message could
+match, and of how PRIVMSGs reach it
+
+python -m unittest test_dispatch
+'''
+import re
+import logging
+import unittest
+import Queue
+from dispatch import literal_prefix, CommandIndex
+from network import Network
+
+#regex => literal prefix
+prefixes = [
+        (r'!syntax ?(?P<module>\S+)?', u'!syntax'),
+        (r'^!learn (?P<abbr>\S+) as (?P<long>.+)$', u'!learn '),
+        (r'!list_abbr$', u'!list_abbr'),
+        (r'quit', u'quit'),
+        #escaped punctuation is literal, escaped letters are classes
+        (r'\!\.x', u'!.x'),
+        (r'!a\d', u'!a'),
+        #a quantifier makes the last character optional
+        (r'!ab?c', u'!a'),
+        (r'!ab*', u'!a'),
+        (r'!ab{2}', u'!a'),
+        (r'!a\.?', u'!a'),
+        #at least once, so it is in the prefix
+        (r'!ab+c', u'!ab'),
+        (r'![ab]', u'!'),
+        (r'!(a|b)', u'!'),
+        (r'.*', u''),
+        (r'\S+', u''),
+        #alternation at the top level
+        (r'!a|!b', u''),
+        (r'!a[|]b', u'!a'),
+        #inline flags change the whole expression
+        (r'(?i)!hello', u''),
+        (r'!hello(?i)', u''),
+        (r'!a b(?x)', u''),
+        (u'!caf\xe9', u'!caf\xe9'),
+        ]
+
+class Command(object):
+    '''
+    Just enough of a CommandBot.command closure for the index
+    '''
+
+    def __init__(self, expr, direct=False):
+        self.expr = expr
+        self.regex = re.compile(expr)
+        self.direct = direct
+        self.prefix = literal_prefix(expr)
+
+    def matches(self, message, nick):
+        if self.direct:
+            if not message.startswith(nick):
+                return False
+            message = message[len(nick):].lstrip(': ')
+        return bool(self.regex.match(message))
+
+class CommandIndexTest(unittest.TestCase):
+
+    def test_literal_prefix(self):
+        for expr, expected in prefixes:
+            self.assertEqual(literal_prefix(expr), expected, expr)
+
+    def test_candidates(self):
+        '''
+        Every command that matches is a candidate, in the order they would
+        have been tried
+        '''
+        commands = [Command(expr) for expr, prefix in prefixes]
+        commands.extend(Command(expr, direct=True) for expr in (r'quit', r'profile (?P<seconds>\d+)', r'.*'))
+        groups = [(None, commands[:5]), ('module', commands[5:])]
+        index = CommandIndex()
+        index.update(groups)
+
+        messages = [u'!syntax', u'!syntax alias', u'!learn a as b', u'!list_abbr', u'quit', u'!.x', u'!a1',
+                    u'!ac', u'!abbc', u'!HELLO', u'!hello', u'!ab', u'!b', u'', u'bot: quit', u'bot quit',
+                    u'botquit', u'bot: profile 30', u'bot', u'!caf\xe9']
+        for message in messages:
+            expected = [(number, position) for number, (name, group) in enumerate(groups)
+                        for position, command in enumerate(group) if command.matches(message, u'bot')]
+            found = [(number, position) for number, position, name, command
+                     in index.candidates(message, u'bot')
+                     if command.matches(message, u'bot')]
+            self.assertEqual(found, expected, message)
+
+class ParseMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.net = Network(Queue.Queue(), Queue.Queue(), 'test_dispatch', log_level=logging.WARNING)
+
+    def tearDown(self):
+        self.net.finish()
+
+    def test_text_without_colon(self):
+        #line => (params, postfix) of the event
+        lines = [
+                (u':n!u@h PRIVMSG #c :hello there', ([u'#c'], u'hello there')),
+                (u':n!u@h PRIVMSG #c hello', ([u'#c'], u'hello')),
+                (u':n!u@h PRIVMSG #c', ([u'#c'], u'')),
+                (u':n!u@h PRIVMSG #c :', ([u'#c'], u'')),
+                (u':n!u@h NOTICE bot hi', ([u'bot'], u'hi')),
+                #not a message, the last param is left where it is
+                (u':n!u@h JOIN #c', ([u'#c'], None)),
+                ]
+        for line, (params, postfix) in lines:
+            command, prefix, event_params, event_postfix = self.net.parse_message(line).data
+            self.assertEqual((event_params, event_postfix), (params, postfix), line)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+'''
+Tests of the FloodControl token bucket, on a clock the tests move along
+
+python -m unittest test_floodcontrol
+'''
+import socket
+import logging
+import unittest
+import floodcontrol
+import event_util as eu
+from network import Network
+from floodcontrol import FloodControl
+from msgqueue import LaneQueue, SheddingQueue, outbound_control
+
+class Clock(object):
+    '''
+    Stands in for the time module in floodcontrol
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class FloodControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.real_time = floodcontrol.time
+        floodcontrol.time = self.clock
+
+    def tearDown(self):
+        floodcontrol.time = self.real_time
+
+    def queue(self, flood, *lines):
+        for line in lines:
+            flood.queue(line)
+
+    def test_burst_then_rate(self):
+        flood = FloodControl(burst=3, rate=2.0)
+        self.queue(flood, b'1', b'2', b'3', b'4', b'5')
+        self.assertEqual(flood.release(), [b'1', b'2', b'3'])
+        self.assertEqual(flood.next_release(), 0.5)
+
+        self.clock.advance(0.25)
+        self.assertEqual(flood.release(), [])
+        self.assertEqual(flood.next_release(), 0.25)
+
+        self.clock.advance(0.25)
+        self.assertEqual(flood.release(), [b'4'])
+        self.clock.advance(10)
+        self.assertEqual(flood.release(), [b'5'])
+        self.assertEqual(flood.next_release(), None)
+
+    def test_refill_capped_at_burst(self):
+        flood = FloodControl(burst=2, rate=1.0)
+        self.clock.advance(60)
+        self.queue(flood, b'1', b'2', b'3')
+        self.assertEqual(flood.release(), [b'1', b'2'])
+        self.assertEqual(flood.next_release(), 1.0)
+
+    def test_charge_holds_back_the_rest(self):
+        flood = FloodControl(burst=3, rate=1.0)
+        #urgent lines go regardless, and can take the bucket below zero
+        for i in range(4):
+            flood.charge(b'PONG')
+        self.queue(flood, b'1')
+        self.assertEqual(flood.release(), [])
+        self.assertEqual(flood.next_release(), 2.0)
+        self.clock.advance(2)
+        self.assertEqual(flood.release(), [b'1'])
+
+    def test_penalty_bytes(self):
+        flood = FloodControl(burst=5, rate=1.0, penalty_bytes=10)
+        #costs 3, then 1, then 3 which has to wait for 2 more tokens
+        self.queue(flood, b'x' * 25, b'x', b'x' * 29)
+        self.assertEqual(flood.release(), [b'x' * 25, b'x'])
+        self.assertEqual(flood.next_release(), 2.0)
+
+    def test_line_costing_more_than_burst(self):
+        flood = FloodControl(burst=2, rate=1.0, penalty_bytes=10)
+        #costs 11, it goes once the bucket is full and leaves it in debt
+        self.queue(flood, b'x' * 100, b'y')
+        self.assertEqual(flood.release(), [b'x' * 100])
+        self.assertEqual(flood.next_release(), 10.0)
+
+    def test_stats(self):
+        flood = FloodControl(burst=1, rate=1.0)
+        self.queue(flood, b'12', b'345')
+        self.assertEqual(flood.stats()['bytes_waiting'], 5)
+        flood.release()
+        self.clock.advance(3)
+        flood.release()
+        stats = flood.stats()
+        self.assertEqual(stats['lines_sent'], 2)
+        #only the second had to wait
+        self.assertEqual(stats['lines_delayed'], 1)
+        self.assertEqual(stats['max_wait'], 3.0)
+        self.assertEqual(stats['lines_waiting'], 0)
+        self.assertEqual(stats['bytes_waiting'], 0)
+
+class BacklogTest(unittest.TestCase):
+    '''
+    A Network with more paced output than out_buffer_size waiting
+    '''
+
+    def setUp(self):
+        self.outq = SheddingQueue(1000, outbound_control)
+        self.net = Network(LaneQueue(), self.outq, 'test_backlog', log_level=logging.WARNING)
+        self.sock, self.server = socket.socketpair()
+        self.net.socket = self.sock
+        self.net.inputs = [self.sock]
+        self.net.outputs = [self.sock]
+        self.net.connected = True
+
+    def tearDown(self):
+        self.net.finish()
+        self.server.close()
+
+    def backlog(self):
+        for i in range(200):
+            self.outq.put(eu.msg(u'x' * 400, u'#c'))
+        while self.net.bytes_pending() < self.net.out_buffer_size:
+            self.net.handle_output(self.sock, self.outq)
+        self.assertTrue(self.outq.qsize())
+
+    def test_paced_events_wait(self):
+        self.backlog()
+        queued = self.outq.qsize()
+        self.net.handle_output(self.sock, self.outq)
+        self.assertEqual(self.outq.qsize(), queued)
+        self.assertEqual(self.net.select_sets()[1], [])
+
+    def test_urgent_events_still_go(self):
+        self.backlog()
+        self.outq.put(eu.pong(u'token'))
+        #the socket is watched for writes so it gets taken
+        self.assertEqual(self.net.select_sets()[1], [self.sock])
+        self.net.handle_output(self.sock, self.outq)
+        self.assertEqual(self.outq.head_priority(), 3)
+        self.assertTrue(self.server.recv(1 << 20).endswith(b'PONG token\r\n'))
+
+    def test_quit_goes_ahead(self):
+        self.backlog()
+        self.net.quit(u'bye')
+        self.net.flush()
+        self.assertTrue(self.server.recv(1 << 20).endswith(b'QUIT :bye\r\n'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+'''
+Table driven tests of ircparse
+
+python -m unittest test_ircparse
+'''
+import unittest
+import ircparse
+
+#line => (tags, prefix, command, params, postfix), None if it can't be parsed
+lines = [
+        (u'PING :irc.example.net', (None, None, u'PING', [], u'irc.example.net')),
+        (u':n!u@h PRIVMSG #c :hey all', (None, u'n!u@h', u'PRIVMSG', [u'#c'], u'hey all')),
+        #no trailing param, the text is the last middle one
+        (u':n!u@h PRIVMSG #c hello', (None, u'n!u@h', u'PRIVMSG', [u'#c', u'hello'], None)),
+        (u':n!u@h JOIN #c', (None, u'n!u@h', u'JOIN', [u'#c'], None)),
+        #empty trailing param
+        (u':n!u@h PRIVMSG #c :', (None, u'n!u@h', u'PRIVMSG', [u'#c'], u'')),
+        #only the first ' :' starts the trailing param
+        (u':n!u@h PRIVMSG #c :a :b', (None, u'n!u@h', u'PRIVMSG', [u'#c'], u'a :b')),
+        (u':n!u@h PRIVMSG #c ::)', (None, u'n!u@h', u'PRIVMSG', [u'#c'], u':)')),
+        (u':irc.example.net 005 bot CHANTYPES=# PREFIX=(ov)@+ :are supported',
+         (None, u'irc.example.net', u'005', [u'bot', u'CHANTYPES=#', u'PREFIX=(ov)@+'], u'are supported')),
+        #runs of spaces between middle params
+        (u':irc.example.net  MODE  #c  +o  n', (None, u'irc.example.net', u'MODE', [u'#c', u'+o', u'n'], None)),
+        (u'QUIT', (None, None, u'QUIT', [], None)),
+        #tags
+        (u'@time=2014-01-01T00:00:00.000Z :n!u@h PRIVMSG #c :hi',
+         ({u'time': u'2014-01-01T00:00:00.000Z'}, u'n!u@h', u'PRIVMSG', [u'#c'], u'hi')),
+        (u'@batch=ref;account :n!u@h QUIT :split',
+         ({u'batch': u'ref', u'account': u''}, u'n!u@h', u'QUIT', [], u'split')),
+        (u'@a=b;;c=d PING :x', ({u'a': u'b', u'c': u'd'}, None, u'PING', [], u'x')),
+        (u'@msgid=1  :n!u@h PING :x', ({u'msgid': u'1'}, u'n!u@h', u'PING', [], u'x')),
+        #nothing to parse
+        (u'', None),
+        (u':n!u@h', None),
+        (u'@a=b', None),
+        ]
+
+#escaped tag value => value
+tag_values = [
+        (u'plain', u'plain'),
+        (u'a\\sb', u'a b'),
+        (u'a\\:b', u'a;b'),
+        (u'\\r\\n', u'\r\n'),
+        (u'back\\\\slash', u'back\\slash'),
+        #unknown escapes lose the backslash, a trailing one is dropped
+        (u'\\x', u'x'),
+        (u'end\\', u'end'),
+        ]
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse(self):
+        for line, expected in lines:
+            self.assertEqual(ircparse.parse(line), expected, line)
+
+    def test_unescape_tag_value(self):
+        for value, expected in tag_values:
+            self.assertEqual(ircparse.unescape_tag_value(value), expected, value)
+
+if __name__ == '__main__':
+    unittest.main()
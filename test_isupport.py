@@ -0,0 +1,96 @@
+'''
+Tests of ISupport and of network.split_text, which splits messages to the
+byte budget the server's limits leave
+
+python -m unittest test_isupport
+'''
+import sys
+import unittest
+from isupport import ISupport
+from network import split_text
+
+snowman = u'\u2603'
+
+#(text, max_bytes) => pieces
+splits = [
+        ((u'hello', 10), [u'hello']),
+        ((u'hello', 5), [u'hello']),
+        ((u'', 5), [u'']),
+        #broken at the space, which is dropped
+        ((u'aaaa bbbb cccc', 9), [u'aaaa bbbb', u'cccc']),
+        #no space, cut at the budget
+        ((u'abcdefghij', 4), [u'abcd', u'efgh', u'ij']),
+        #a space that would waste more than half the line isn't used
+        ((u'a bbbbbbbbbb', 8), [u'a bbbbbb', u'bbbb']),
+        #two byte characters, never cut in half
+        ((u'\xe9' * 5, 5), [u'\xe9\xe9', u'\xe9\xe9', u'\xe9']),
+        ((u'ab\xe9cd', 3), [u'ab', u'\xe9c', u'd']),
+        #three byte characters
+        ((snowman * 3, 4), [snowman] * 3),
+        ((u'x' + snowman * 2, 4), [u'x' + snowman, snowman]),
+        #budgets smaller than one character still send it
+        ((snowman * 2, 1), [snowman] * 2),
+        ((snowman * 2, 2), [snowman] * 2),
+        ((u'ab', 0), [u'a', u'b']),
+        ]
+
+class SplitTextTest(unittest.TestCase):
+
+    def test_split_text(self):
+        for (text, max_bytes), expected in splits:
+            self.assertEqual(split_text(text, max_bytes), expected, (text, max_bytes))
+
+    def test_within_budget(self):
+        text = u' '.join([u'caf\xe9', snowman, u'configuration', u'\U0001f600', u'x'] * 40)
+        for max_bytes in (4, 5, 7, 13, 50, 400):
+            pieces = split_text(text, max_bytes)
+            for piece in pieces:
+                self.assertLessEqual(len(piece.encode('utf-8')), max_bytes)
+            #only spaces we broke on go missing
+            self.assertEqual(u''.join(pieces).replace(u' ', u''), text.replace(u' ', u''))
+
+class ISupportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.isupport = ISupport()
+
+    def test_targmax(self):
+        #nothing advertised, one at a time
+        self.assertEqual(self.isupport.targmax('PRIVMSG'), 1)
+
+        self.isupport.update([u'TARGMAX=PRIVMSG:4,NOTICE:,JOIN:'])
+        for command, expected in [('PRIVMSG', 4), ('privmsg', 4), ('NOTICE', sys.maxint),
+                                  ('JOIN', sys.maxint), ('KICK', 1)]:
+            self.assertEqual(self.isupport.targmax(command), expected, command)
+
+    def test_maxtargets(self):
+        self.isupport.update([u'MAXTARGETS=3'])
+        self.assertEqual(self.isupport.targmax('PRIVMSG'), 3)
+        self.isupport.update([u'MAXTARGETS='])
+        self.assertEqual(self.isupport.targmax('NOTICE'), sys.maxint)
+        #TARGMAX wins over the older token
+        self.isupport.update([u'TARGMAX=PRIVMSG:2'])
+        self.assertEqual(self.isupport.targmax('PRIVMSG'), 2)
+
+    def test_prefix(self):
+        self.assertEqual(self.isupport.prefix(), ('ov', '@+'))
+        self.isupport.update([u'PREFIX=(qaohv)~&@%+'])
+        self.assertEqual(self.isupport.prefix(), ('qaohv', '~&@%+'))
+        #no prefixes at all
+        self.isupport.update([u'PREFIX='])
+        self.assertEqual(self.isupport.prefix(), ('', ''))
+        #withdrawn, back to the default
+        self.isupport.update([u'-PREFIX'])
+        self.assertEqual(self.isupport.prefix(), ('ov', '@+'))
+
+    def test_update(self):
+        self.isupport.update([u'nicklen=30', u'NETWORK=Fake\\x20Net', u'SAFELIST'])
+        self.assertEqual(self.isupport.nicklen(), 30)
+        self.assertEqual(self.isupport.get('NETWORK'), u'Fake Net')
+        self.assertIn('SAFELIST', self.isupport)
+        self.assertEqual(self.isupport.get('SAFELIST'), u'')
+        #not advertised, the RFC value
+        self.assertEqual(self.isupport.linelen(), 512)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''
+Tests of the bot's queues, LaneQueue ordering and SheddingQueue's
+collapsing and eviction once full
+
+python -m unittest test_msgqueue
+'''
+import unittest
+import numerics as nu
+import event_util as eu
+from msgqueue import LaneQueue, SheddingQueue
+
+def msg(text, priority=3):
+    return eu.msg(text, u'#c', priority)
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get(False))
+    return items
+
+class LaneQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = LaneQueue()
+        for text, priority in [(u'a', 3), (u'b', 1), (u'c', 3), (u'd', 2), (u'e', 1)]:
+            queue.put(msg(text, priority))
+        self.assertEqual(queue.head_priority(), 1)
+        #by priority, first in first out within one
+        self.assertEqual([item.data[0] for item in drain(queue)], [u'b', u'e', u'd', u'a', u'c'])
+        self.assertEqual(queue.head_priority(), None)
+
+    def test_take(self):
+        queue = LaneQueue()
+        for item in [msg(u'a'), eu.kill(), msg(u'b'), eu.disconnect(u'bye'), msg(u'c')]:
+            queue.put(item)
+        taken = queue.take(frozenset([nu.BOT_KILL, nu.BOT_DISCONNECT]))
+        self.assertEqual([item.type for item in taken], [nu.BOT_KILL, nu.BOT_DISCONNECT])
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([item.data[0] for item in drain(queue)], [u'a', u'b', u'c'])
+
+class SheddingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = SheddingQueue(3, frozenset([nu.BOT_QUIT]))
+
+    def fill(self, *texts):
+        for text in texts:
+            self.assertTrue(self.queue.put(msg(text)))
+
+    def texts(self):
+        return [item.data[0] for item in drain(self.queue)]
+
+    def test_no_capacity(self):
+        queue = SheddingQueue()
+        for i in range(100):
+            self.assertTrue(queue.put(msg(u'same')))
+        self.assertEqual(queue.qsize(), 100)
+
+    def test_collapse(self):
+        self.fill(u'a', u'b', u'c')
+        self.assertFalse(self.queue.put(msg(u'b')))
+        self.assertEqual(self.queue.stats()['collapsed'], 1)
+        self.assertEqual(self.texts(), [u'a', u'b', u'c'])
+
+    def test_collapse_forgets_what_left(self):
+        self.fill(u'a', u'b', u'c')
+        self.queue.get(False)
+        self.fill(u'd')
+        #a is no longer queued so it can't be collapsed into, it evicts instead
+        self.assertFalse(self.queue.put(msg(u'a')))
+        self.assertEqual(self.queue.stats(), {'dropped': 1, 'collapsed': 0, 'evicted': 0})
+        self.assertTrue(self.queue.put(msg(u'a', 2)))
+        self.assertEqual(self.texts(), [u'a', u'c', u'd'])
+
+    def test_evict(self):
+        self.fill(u'a', u'b')
+        self.assertTrue(self.queue.put(msg(u'c', 5)))
+        #full, the oldest of the worst priority goes to make room
+        self.assertTrue(self.queue.put(msg(u'd', 2)))
+        self.assertEqual(self.queue.stats()['evicted'], 1)
+        self.assertEqual(self.queue.shed_types('evicted'), {nu.BOT_MSG: 1})
+        self.assertTrue(self.queue.put(msg(u'e', 2)))
+        self.assertEqual(self.texts(), [u'd', u'e', u'b'])
+        self.assertEqual(self.queue.unfinished_tasks, 3)
+
+    def test_drop(self):
+        self.fill(u'a', u'b', u'c')
+        #nothing queued is worse than it
+        self.assertFalse(self.queue.put(msg(u'd')))
+        self.assertFalse(self.queue.put(msg(u'e', 4)))
+        self.assertEqual(self.queue.stats()['dropped'], 2)
+        self.assertEqual(self.texts(), [u'a', u'b', u'c'])
+
+    def test_protected(self):
+        self.fill(u'a', u'b', u'c')
+        #protected priority and control types are let in over capacity
+        self.assertTrue(self.queue.put(eu.pong(u'token')))
+        self.assertTrue(self.queue.put(eu.quit(u'bye')))
+        self.assertEqual(self.queue.qsize(), 5)
+
+    def test_protected_not_evicted(self):
+        self.assertTrue(self.queue.put(eu.quit(u'bye', 5)))
+        self.assertTrue(self.queue.put(msg(u'a', 5)))
+        self.fill(u'b')
+        self.assertTrue(self.queue.put(msg(u'c', 2)))
+        items = drain(self.queue)
+        self.assertEqual([item.type for item in items], [nu.BOT_MSG, nu.BOT_MSG, nu.BOT_QUIT])
+        self.assertEqual([item.data[0] for item in items[:2]], [u'c', u'b'])
+
+    def test_unhashable(self):
+        queue = SheddingQueue(1)
+        self.assertTrue(queue.put(eu.irc_msg(u'X', ({},), 5)))
+        #can't be collapsed, but can still be evicted
+        self.assertTrue(queue.put(eu.irc_msg(u'X', ({},), 3)))
+        self.assertEqual(queue.stats()['evicted'], 1)
+        self.assertEqual(queue.get(False).priority, 3)
+
+    def test_take_forgets(self):
+        self.fill(u'a', u'b')
+        self.assertTrue(self.queue.put(eu.quit(u'bye')))
+        self.queue.take(frozenset([nu.BOT_MSG]))
+        self.assertEqual(self.queue.index, {(nu.BOT_QUIT, (u'bye',)): 1})
+        self.assertEqual(self.queue.qsize(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+The test_backends scenarios again with the bot connecting over TLS, to a
+fakeircd serving a self-signed certificate made for the run (needs the
+openssl command)
+
+python -m unittest test_tls
+'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+#the module, not the class, or unittest would find and run BackendTest here too
+import test_backends
+
+class SlowIRCd(test_backends.ScriptedIRCd):
+    '''
+    Takes a while to get round to new connections, so the bot's half of the
+    handshake can't finish the first time it is tried
+    '''
+
+    def accept(self):
+        time.sleep(0.2)
+        test_backends.ScriptedIRCd.accept(self)
+
+class TLSBackendTest(test_backends.BackendTest):
+    net_options = {'tls': True, 'tls_verify': False}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='simplepybot-tls')
+        certfile = os.path.join(cls.directory, 'cert.pem')
+        keyfile = os.path.join(cls.directory, 'key.pem')
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                       '-days', '1', '-subj', '/CN=localhost',
+                                       '-keyout', keyfile, '-out', certfile],
+                                      stdout=devnull, stderr=devnull)
+
+        except (OSError, subprocess.CalledProcessError) as e:
+            shutil.rmtree(cls.directory)
+            raise unittest.SkipTest('Unable to make a certificate: {0}'.format(e))
+
+        cls.server_options = {'certfile': certfile, 'keyfile': keyfile}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_handshake_passes(self):
+        '''
+        The handshake doesn't block, it is moved along a bit on each pass of
+        the network loop until it is done
+        '''
+        #on loopback the handshake could be done before we next look
+        self.server.stop()
+        self.server = SlowIRCd(**self.server_options).start()
+        bot = self.make_bot('handshakebot', threaded=False)
+        handshake_passes = 0
+        #CommandBot.loop, counting the passes
+        while bot.is_running:
+            if bot.net.handshaking:
+                handshake_passes += 1
+            bot.wait_for_events(bot.next_timeout())
+            bot.logic()
+        bot.finish_network()
+        bot.cleanup()
+
+        self.assertGreater(handshake_passes, 1)
+        self.assertIsNotNone(bot.net.handshake_time)
+        self.check('handshakebot')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import time
+import Queue
+import logging
+import threading
+from datetime import datetime, timedelta
+
+class Job:
+    '''
+    One offloaded command handler call
+    '''
+
+    def __init__(self, name, func, args, targets, timeout):
+        self.name = name
+        self.func = func
+        self.args = args
+        #where to say it timed out
+        self.targets = targets
+        self.timeout = timeout
+        self.started = None
+        self.timed_out = False
+
+class WorkerPool:
+    '''
+    Runs command handlers made with offload=True (see CommandBot.command) on
+    a pool of threads so a slow one doesn't hold up every other event
+
+    Replies go through the bot's out queue like any other. A handler still
+    running after its timeout can't be stopped, so it is reported as timed
+    out and anything it sends from then on is dropped. At most max_queue
+    handlers wait for a free worker, past that the command is turned away
+
+    Offloaded handlers run alongside the main loop so they should only touch
+    state of their own, use bot.thread_db() rather than bot.db. workers=0
+    runs them inline instead. The threads are only started once something
+    is offloaded, a bot that never does costs none
+    '''
+
+    def __init__(self, bot, module_name='workers', log_level=logging.INFO, workers=4,
+                 max_queue=50, timeout=30, check_interval=1):
+        self.bot = bot
+        self.log = logging.getLogger('{0}.{1}'.format(bot.log_name, module_name))
+        self.log.setLevel(log_level)
+        self.irc = bot.irc
+        self.module_name = module_name
+        self.timeout = timeout
+
+        self.jobs = Queue.Queue(max_queue)
+        #jobs being run right now
+        self.active = set()
+        self.lock = threading.Lock()
+        #the job the current thread is running, if it is a worker
+        self.local = threading.local()
+        self.counts = dict.fromkeys(['submitted', 'completed', 'failed', 'timed_out', 'rejected'], 0)
+        self.max_depth = 0
+
+        self.workers = workers
+        self.threads = []
+
+        self.commands = [
+                        self.bot.command(r'!workers$', self.workers_command, auth_level=20),
+                        ]
+        self.events = []
+        self.bot.add_timed_event(datetime.now(), datetime.max, timedelta(seconds=check_interval),
+                                 self.check_timeouts)
+        self.bot.add_module(module_name, self)
+
+    def submit(self, name, func, args, targets, timeout=None):
+        '''
+        Queue func(*args) for a worker, returns False if the queue is full
+        '''
+        job = Job(name, func, args, targets, self.timeout if timeout is None else timeout)
+        if not self.workers:
+            self.count('submitted')
+            self.run(job)
+            return True
+
+        if not self.threads:
+            self.start()
+
+        try:
+            self.jobs.put(job, False)
+
+        except Queue.Full:
+            self.count('rejected')
+            self.log.warning('Turned away %s, %s jobs already waiting', name, self.jobs.qsize())
+            return False
+
+        with self.lock:
+            self.counts['submitted'] += 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+        return True
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='worker-{0}'.format(i))
+            #a handler that never returns mustn't keep the process alive
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            self.run(job)
+
+        self.bot.close_thread_db()
+
+    def run(self, job):
+        job.started = time.time()
+        with self.lock:
+            self.active.add(job)
+        self.local.job = job
+        try:
+            job.func(*job.args)
+            self.count('completed')
+
+        except Exception as e:
+            self.count('failed')
+            self.log.exception(u'Error in offloaded command handler: {0}'.format(job.name))
+            if not job.timed_out:
+                self.irc.msg_all(u'Unable to complete request due to internal error', job.targets)
+
+        finally:
+            self.local.job = None
+            with self.lock:
+                self.active.discard(job)
+            self.bot.metrics.observe('offloaded', self.module_name, job.name, time.time() - job.started)
+
+        if job.timed_out:
+            self.log.info('%s finished %.1fs after timing out', job.name,
+                          time.time() - job.started - job.timeout)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def suppressed(self):
+        '''
+        True if the calling thread is running a job that has timed out, so
+        whatever it sends should be dropped
+        '''
+        job = getattr(self.local, 'job', None)
+        return job is not None and job.timed_out
+
+    def check_timeouts(self):
+        '''
+        Timed event, tell people about jobs that have run over time
+        '''
+        now = time.time()
+        with self.lock:
+            late = [job for job in self.active
+                    if not job.timed_out and now - job.started > job.timeout]
+            for job in late:
+                job.timed_out = True
+                self.counts['timed_out'] += 1
+
+        for job in late:
+            self.log.warning('%s timed out after %.1fs', job.name, now - job.started)
+            self.irc.msg_all(u'Request took too long and was abandoned', job.targets)
+
+    def stats(self):
+        '''
+        The counters as a dict, plus the jobs waiting and running right now
+        '''
+        with self.lock:
+            stats = dict(self.counts)
+            stats['active'] = len(self.active)
+            stats['max_depth'] = self.max_depth
+        stats['queued'] = self.jobs.qsize()
+        stats['workers'] = self.workers
+        return stats
+
+    def workers_command(self, nick, nickhost, action, targets, message, m):
+        stats = self.stats()
+        self.irc.msg_all(u'{workers} workers, {active} busy, {queued} queued (max {max_depth}). '
+                         u'{submitted} submitted, {completed} completed, {failed} failed, '
+                         u'{timed_out} timed out, {rejected} turned away'.format(**stats), targets)
+
+    def close(self):
+        #workers finish what they are doing, anything still queued is dropped
+        while True:
+            try:
+                self.jobs.get(False)
+            except Queue.Empty:
+                break
+
+        for thread in self.threads:
+            try:
+                self.jobs.put(None, False)
+            except Queue.Full:
+                break
+
+    def syntax(self):
+        return  '''
+                Workers module supports
+                !workers
+                '''